@@ -152,7 +152,7 @@ class Boundaries:
 
     def boundaries_make(self, bin_size: int = 100, radius: int = 200, n_angles: int = 6,
                 normalize: bool = False, normalization_mode: str = 'log', gene_selection: any = None, 
-                n_jobs: int = -1) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+                n_jobs: int = -1, cache: bool = True) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
         """Calculate local similarity to investigate border strenth.
         
         Overlays the sample with a grid of points. For each point the molecules
@@ -181,6 +181,10 @@ class Boundaries:
             gene_selection (list, np.ndarray, optional): Genes 
             n_jobs (int, optional): Number of processes to use. If None, 
                 the max number of cpus is used. Defaults to None.
+            cache (bool, optional): If True, loads the result from the on-disk
+                cache if it has been calculated before with the same 
+                parameters, and saves new results to the cache. 
+                Defaults to True.
         Returns:
             Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
             results: Array with in the first colum the euclidian distance and 
@@ -197,6 +201,20 @@ class Boundaries:
         if n_jobs == None:
             n_jobs = self.cpu_count()
         
+        #Fetch genes to run
+        if type(gene_selection) == type(None):
+            genes = self.unique_genes
+        else:
+            genes = gene_selection
+        
+        #Check cache
+        cache_params = {'bin_size': bin_size, 'radius': radius, 'n_angles': n_angles, 'normalize': normalize,
+                        'normalization_mode': normalization_mode, 'genes': list(genes)}
+        if cache and hasattr(self, 'cache_load'):
+            cached = self.cache_load('boundaries_make', cache_params)
+            if cached != None:
+                return cached
+        
         #Make the grid overlaying the data       
         grid, Xi, Yi = self.square_grid(bin_size, self.x_extent, self.y_extent, 
                                         self.x_min, self.x_max, self.y_min, self.y_max)
@@ -205,16 +223,11 @@ class Boundaries:
         #make lines that bisect a circle for each required angle
         lines = [self.bisect(radius, a) for a in np.linspace(0, 180 - (180 / n_angles), n_angles)]
 
-        #Fetch genes to run
-        if type(gene_selection) == type(None):
-            genes = self.unique_genes
-        else:
-            genes = gene_selection
-        
         #Find number of molecules in each division
+        index = self.spatial_index() if hasattr(self, 'spatial_index') else None
         results = []
         for g in genes:
-            points = self.get_gene(g)
+            points = self.get_gene(g) if index is None else index.gene_points(g, frame=True)
             y = dask.delayed(_worker_bisect)(points, grid, radius, lines, n_angles)
             results.append(y)
 
@@ -274,6 +287,9 @@ class Boundaries:
         image = np.zeros(shape)
         image[filt_grid] = results2[:,0]
         
+        if cache and hasattr(self, 'cache_save'):
+            self.cache_save('boundaries_make', cache_params, (results2, image, grid, grid_filt, filt_grid, shape))
+        
         return results2, image, grid, grid_filt, filt_grid, shape
     
 class Boundaries_Multi:
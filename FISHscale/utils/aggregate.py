@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from typing import Any, Tuple
+
+
+def label_indicator(labels: np.ndarray) -> Tuple[Any, np.ndarray]:
+    """Make a sparse indicator matrix of labels.
+
+    Args:
+        labels (np.ndarray): Array with a label for each sample.
+
+    Returns:
+        Tuple[sp.csr_matrix, np.ndarray]: Sparse matrix with shape
+            (n_samples, n_labels) with a one where a sample has a label, and
+            the sorted unique labels matching the columns.
+    """
+    unique_labels, label_index = np.unique(np.asarray(labels), return_inverse=True)
+    n = label_index.shape[0]
+    indicator = sp.csr_matrix((np.ones(n), (np.arange(n), label_index.ravel())), shape=(n, unique_labels.shape[0]))
+    return indicator, unique_labels
+
+
+def _to_matrix(data: Any) -> Any:
+    """Get the values of a (sparse) DataFrame, array or sparse matrix.
+
+    Args:
+        data (Any): Pandas DataFrame, which can have sparse columns, numpy
+            array or scipy sparse matrix.
+
+    Returns:
+        Union[np.ndarray, sp.csr_matrix]: Numpy array or sparse matrix.
+    """
+    if isinstance(data, pd.DataFrame):
+        if len(data.dtypes) > 0 and all(isinstance(t, pd.SparseDtype) for t in data.dtypes):
+            return data.sparse.to_coo().tocsr()
+        return data.to_numpy()
+    elif sp.issparse(data):
+        return data.tocsr()
+    return np.asarray(data)
+
+
+def label_aggregate(data: Any, labels: np.ndarray, func: str = 'mean') -> Any:
+    """Sum, mean or count samples per label with one sparse matrix product.
+
+    Instead of filtering the data for every label, an indicator matrix of
+    the labels is multiplied with the data, which gives the sums of all
+    labels at once.
+
+    Args:
+        data (Any): Pandas DataFrame, numpy array or scipy sparse matrix with
+            features in rows and samples in columns. DataFrames can be dense
+            or sparse.
+        labels (np.ndarray): Array with a label for each sample (column).
+        func (str, optional): "sum", "mean" or "count". Defaults to 'mean'.
+
+    Returns:
+        pd.DataFrame: Dataframe with features in rows and the sorted unique
+            labels in columns. For "count" a Series with the number of
+            samples per label.
+    """
+    indicator, unique_labels = label_indicator(labels)
+    counts = np.asarray(indicator.sum(axis=0)).ravel()
+    if func == 'count':
+        return pd.Series(counts, index=unique_labels)
+
+    X = _to_matrix(data)
+    if X.shape[1] != indicator.shape[0]:
+        raise Exception(f'Number of labels ({indicator.shape[0]}) does not match the number of samples ({X.shape[1]}).')
+
+    #Sparse matrix times dense is efficient in scipy, so multiply transposed
+    sums = indicator.T @ X.T
+    sums = sums.toarray() if sp.issparse(sums) else np.asarray(sums)
+    sums = sums.T
+
+    if func == 'sum':
+        result = sums
+    elif func == 'mean':
+        result = sums / counts[None, :]
+    else:
+        raise Exception(f'Function "{func}" not implemented, choose from "sum", "mean" or "count".')
+
+    index = data.index if isinstance(data, pd.DataFrame) else None
+    return pd.DataFrame(data=result, index=index, columns=unique_labels)
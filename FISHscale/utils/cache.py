@@ -0,0 +1,323 @@
+from os import path, makedirs, replace, stat
+from glob import glob
+import shutil
+import hashlib
+import pickle
+import time
+import numpy as np
+import pandas as pd
+from typing import Any, Optional
+
+
+class Cache:
+    """Content-addressed on-disk cache for analysis results.
+
+    Results are stored in the "cache" folder inside the FISHscale data folder
+    of the dataset. Every entry is addressed by a key that is made from the
+    fingerprint of the dataset, the name of the function and its parameters.
+    When the parsed data or the (temporary) coordinates change, the
+    fingerprint changes and old entries will not be used anymore. These
+    remain on disk until they are evicted by the size limit, in least
+    recently used order, or removed with `cache_invalidate()`.
+
+    Numeric Pandas Dataframes and numpy arrays are stored as .npy, other
+    Pandas Dataframes as .parquet and all other objects are pickled.
+    """
+
+    def _cache_folder(self) -> str:
+        """Get the cache folder of the dataset, and make it if needed.
+
+        Returns:
+            str: Path to cache folder.
+        """
+        folder = path.join(self.FISHscale_data_folder, 'cache')
+        makedirs(folder, exist_ok=True)
+        return folder
+
+    def _cache_hashable(self, obj: Any) -> Any:
+        """Convert an object to a deterministic representation for hashing.
+
+        Args:
+            obj (Any): Object to convert. Numpy arrays are represented by their
+                dtype, shape and the hash of their content.
+
+        Returns:
+            Any: Nested tuples that have a stable repr().
+        """
+        if isinstance(obj, dict):
+            return tuple((str(k), self._cache_hashable(obj[k])) for k in sorted(obj.keys(), key=str))
+        elif isinstance(obj, (list, tuple)):
+            return tuple(self._cache_hashable(i) for i in obj)
+        elif isinstance(obj, np.ndarray):
+            if obj.dtype == object:
+                obj = obj.astype('str')
+            return ('ndarray', obj.dtype.str, obj.shape, hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest())
+        elif isinstance(obj, (np.integer, np.floating, np.bool_)):
+            return obj.item()
+        else:
+            return obj
+
+    def _cache_fingerprint(self) -> str:
+        """Fingerprint of the current state of the dataset.
+
+        Uses the name, size and modification time of the parsed data files,
+        the coordinate properties, the genes and the temporary coordinate
+        transformations like offsets and flips.
+
+        Returns:
+            str: Hash of the dataset state.
+        """
+        files = []
+        for f in sorted(glob(path.join(self.FISHscale_data_folder, '*.parquet'))):
+            s = stat(f)
+            files.append((path.basename(f), s.st_size, s.st_mtime_ns))
+
+        state = {'files': files,
+                 'extent': [self.x_min, self.x_max, self.y_min, self.y_max],
+                 'z': getattr(self, 'z', 0),
+                 'unique_genes': np.asarray(self.unique_genes),
+                 'transforms': getattr(self, 'coordinate_transforms', [])}
+
+        return hashlib.sha1(repr(self._cache_hashable(state)).encode()).hexdigest()
+
+    def _cache_key(self, name: str, params: dict) -> str:
+        """Make the key of a cache entry.
+
+        Args:
+            name (str): Name of the cached function.
+            params (dict): Parameters of the function call.
+
+        Returns:
+            str: Key of the cache entry.
+        """
+        key = (self._cache_fingerprint(), name, self._cache_hashable(params))
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def _cache_index_file(self) -> str:
+        return path.join(self._cache_folder(), 'cache_index.pkl')
+
+    def _cache_index_read(self) -> dict:
+        """Read the cache index.
+
+        Returns:
+            dict: Dictionary with keys of the cache entries and a dictionary
+                with the name, parameters, size and access time of each entry.
+        """
+        try:
+            with open(self._cache_index_file(), 'rb') as pf:
+                return pickle.load(pf)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return {}
+
+    def _cache_index_write(self, index: dict):
+        """Write the cache index.
+
+        Writes to a temporary file first so that the index is never left half
+        written.
+
+        Args:
+            index (dict): Cache index.
+        """
+        file_name = self._cache_index_file()
+        tmp_file = file_name + f'.{time.time_ns()}.tmp'
+        with open(tmp_file, 'wb') as pf:
+            pickle.dump(index, pf)
+        replace(tmp_file, file_name)
+
+    def _cache_write_item(self, item: Any, file_base: str) -> str:
+        """Write a single object to disk in a format that fits its type.
+
+        Dataframes with one numeric dtype, like the genes by tiles matrix of
+        `hexbin_make()`, are stored as a .npy file with the values and a small
+        pickle with the index and columns. Parquet stores every column
+        separately, which is slow for frames with many columns.
+
+        Args:
+            item (Any): Object to save.
+            file_base (str): Path and name of the file without extension.
+
+        Returns:
+            str: Name of the file.
+        """
+        if isinstance(item, pd.DataFrame) and item.shape[1] > 0 and not hasattr(item, 'sparse') \
+           and len(set(item.dtypes)) == 1 and isinstance(item.dtypes.iloc[0], np.dtype) \
+           and np.issubdtype(item.dtypes.iloc[0], np.number):
+            file_name = file_base + '.frame.npy'
+            np.save(file_name, item.to_numpy())
+            with open(file_base + '.axes.pkl', 'wb') as pf:
+                pickle.dump((item.index, item.columns), pf)
+        elif isinstance(item, pd.DataFrame) and all(isinstance(c, str) for c in item.columns) \
+           and not hasattr(item, 'sparse'):
+            file_name = file_base + '.parquet'
+            item.to_parquet(file_name)
+        elif isinstance(item, np.ndarray) and item.dtype != object:
+            file_name = file_base + '.npy'
+            np.save(file_name, item)
+        else:
+            file_name = file_base + '.pkl'
+            with open(file_name, 'wb') as pf:
+                pickle.dump(item, pf)
+        return path.basename(file_name)
+
+    def _cache_read_item(self, file_name: str) -> Any:
+        """Read a single object that was written by `_cache_write_item()`.
+
+        Args:
+            file_name (str): Full name of the file.
+
+        Returns:
+            Any: Loaded object.
+        """
+        if file_name.endswith('.frame.npy'):
+            with open(file_name[:-len('.frame.npy')] + '.axes.pkl', 'rb') as pf:
+                index, columns = pickle.load(pf)
+            return pd.DataFrame(np.load(file_name), index=index, columns=columns)
+        elif file_name.endswith('.parquet'):
+            return pd.read_parquet(file_name)
+        elif file_name.endswith('.npy'):
+            return np.load(file_name)
+        else:
+            with open(file_name, 'rb') as pf:
+                return pickle.load(pf)
+
+    def _cache_folder_size(self, folder: str) -> int:
+        return sum(stat(f).st_size for f in glob(path.join(folder, '*')))
+
+    def cache_save(self, name: str, params: dict, result: Any) -> str:
+        """Save a result in the cache.
+
+        If the cache grows larger than `self.cache_max_size` the least
+        recently used entries are removed.
+
+        Args:
+            name (str): Name of the function that produced the result.
+            params (dict): Parameters that were used to produce the result.
+            result (Any): Result to save. If a tuple is given each item is
+                stored in its own file.
+
+        Returns:
+            str: Key of the cache entry.
+        """
+        key = self._cache_key(name, params)
+        entry_folder = path.join(self._cache_folder(), key)
+        if path.exists(entry_folder):
+            shutil.rmtree(entry_folder)
+        makedirs(entry_folder)
+
+        is_tuple = isinstance(result, tuple)
+        items = result if is_tuple else (result,)
+        files = [self._cache_write_item(item, path.join(entry_folder, f'item_{i}')) for i, item in enumerate(items)]
+
+        index = self._cache_index_read()
+        index[key] = {'name': name,
+                      'params': repr(self._cache_hashable(params)),
+                      'files': files,
+                      'tuple': is_tuple,
+                      'size': self._cache_folder_size(entry_folder),
+                      'created': time.time(),
+                      'last_access': time.time()}
+        index = self._cache_evict(index, keep=key)
+        self._cache_index_write(index)
+
+        return key
+
+    def cache_load(self, name: str, params: dict) -> Optional[Any]:
+        """Load a result from the cache.
+
+        Args:
+            name (str): Name of the function that produced the result.
+            params (dict): Parameters that were used to produce the result.
+
+        Returns:
+            Optional[Any]: The cached result, or None if there is no entry for
+                the current dataset state, function and parameters.
+        """
+        key = self._cache_key(name, params)
+        index = self._cache_index_read()
+        if key not in index:
+            return None
+
+        entry_folder = path.join(self._cache_folder(), key)
+        try:
+            items = [self._cache_read_item(path.join(entry_folder, f)) for f in index[key]['files']]
+        except (FileNotFoundError, OSError) as e:
+            self.vp(f'Could not read cache entry {key} for {name}, recalculating. Error: {e}')
+            del index[key]
+            self._cache_index_write(index)
+            return None
+
+        index[key]['last_access'] = time.time()
+        self._cache_index_write(index)
+        self.vp(f'Loaded {name} from cache.')
+
+        return tuple(items) if index[key]['tuple'] else items[0]
+
+    def _cache_evict(self, index: dict, keep: str = None) -> dict:
+        """Remove least recently used entries until the size limit is met.
+
+        Args:
+            index (dict): Cache index.
+            keep (str, optional): Key of an entry that should not be removed.
+                Defaults to None.
+
+        Returns:
+            dict: Updated cache index.
+        """
+        max_size = getattr(self, 'cache_max_size', 10e9)
+        total = sum(v['size'] for v in index.values())
+        for key in sorted(index, key=lambda k: index[k]['last_access']):
+            if total <= max_size:
+                break
+            if key == keep:
+                continue
+            total -= index[key]['size']
+            shutil.rmtree(path.join(self._cache_folder(), key), ignore_errors=True)
+            del index[key]
+
+        return index
+
+    def cache_invalidate(self, name: str = None, params: dict = None) -> int:
+        """Remove entries from the cache.
+
+        Args:
+            name (str, optional): Name of the function for which to remove the
+                cached results. If None, all entries are removed.
+                Defaults to None.
+            params (dict, optional): If given together with "name", only the
+                entry for these parameters and the current dataset state is
+                removed. Defaults to None.
+
+        Returns:
+            int: Number of removed entries.
+        """
+        index = self._cache_index_read()
+        if name != None and params != None:
+            to_remove = [self._cache_key(name, params)]
+        elif name != None:
+            to_remove = [k for k, v in index.items() if v['name'] == name]
+        else:
+            to_remove = list(index.keys())
+
+        n_removed = 0
+        for key in to_remove:
+            if key in index:
+                shutil.rmtree(path.join(self._cache_folder(), key), ignore_errors=True)
+                del index[key]
+                n_removed += 1
+        self._cache_index_write(index)
+
+        return n_removed
+
+    def cache_inspect(self) -> Any:
+        """List the entries in the cache.
+
+        Returns:
+            pd.DataFrame: Dataframe with the function name, parameters, size in
+                bytes, creation and last access time of each entry. Sorted
+                from most to least recently used.
+        """
+        index = self._cache_index_read()
+        df = pd.DataFrame.from_dict(index, orient='index', columns=['name', 'params', 'size', 'created', 'last_access'])
+        df['created'] = pd.to_datetime(df['created'], unit='s')
+        df['last_access'] = pd.to_datetime(df['last_access'], unit='s')
+        return df.sort_values('last_access', ascending=False)
@@ -522,6 +522,7 @@ class DataLoader(DataLoader_base):
         self.x_extent = self.x_max - self.x_min
         self.y_extent = self.y_max - self.y_min 
         self.xy_center = (self.x_max - 0.5*self.x_extent, self.y_max - 0.5*self.y_extent)
+        self.coordinate_transforms.append(('transpose',))
     
     def flip_x(self):
         """Flips the X coordinates around the X center.
@@ -529,6 +530,7 @@ class DataLoader(DataLoader_base):
         This operation does NOT survive reloading the data.
         """
         self.df.x = -(self.df.x - self.xy_center[0]) + self.xy_center[0]
+        self.coordinate_transforms.append(('flip_x', self.xy_center[0]))
     
     def flip_y(self):
         """Flips the Y coordinates around the Y center.
@@ -536,5 +538,6 @@ class DataLoader(DataLoader_base):
         This operation does NOT survive reloading the data.
         """
         self.df.y = -(self.df.y - self.xy_center[1]) + self.xy_center[1]
+        self.coordinate_transforms.append(('flip_y', self.xy_center[1]))
 
 
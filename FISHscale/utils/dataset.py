@@ -20,11 +20,14 @@ from FISHscale.visualization.gene_scatter import GeneScatter, MultiGeneScatter,
 from FISHscale.utils.data_handling import DataLoader, DataLoader_base
 from FISHscale.utils.bonefight import BoneFight, BoneFightMulti
 from FISHscale.utils.regionalization_multi import RegionalizeMulti
+from FISHscale.utils.multi_hex_regionalization import Regionalize3D
 from FISHscale.utils.decomposition import Decomposition
 from FISHscale.spatial.boundaries import Boundaries, Boundaries_Multi
 from FISHscale.spatial.gene_order import Gene_order
 from FISHscale.segmentation.cellpose import Cellpose
 from FISHscale.utils.regionalization_gradient import Regionalization_Gradient, Regionalization_Gradient_Multi
+from FISHscale.utils.cache import Cache
+from FISHscale.utils.spatial_index import SpatialIndexing
 import sys
 from datetime import datetime
 from sklearn.cluster import DBSCAN
@@ -49,7 +52,7 @@ from tqdm import tqdm
 
 class Dataset(Regionalize, Iteration, ManyColors, GeneCorr, GeneScatter, AttributeScatter, SpatialMetrics, DataLoader, Normalization, 
               Density1D, BoneFight, Decomposition, Boundaries, Gene_order, Cellpose, 
-              Regionalization_Gradient):
+              Regionalization_Gradient, Cache, SpatialIndexing):
     """
     Base Class for FISHscale, still under development
 
@@ -73,7 +76,8 @@ class Dataset(Regionalize, Iteration, ManyColors, GeneCorr, GeneScatter, Attribu
         reparse: bool = False,
         color_input: Optional[Union[str, dict]] = None,
         verbose: bool = False,
-        part_of_multidataset: bool = False):
+        part_of_multidataset: bool = False,
+        cache_max_size: float = 10):
         """initiate Dataset
 
         Args:
@@ -131,6 +135,9 @@ class Dataset(Regionalize, Iteration, ManyColors, GeneCorr, GeneScatter, Attribu
             verbose (bool, optional): If True prints additional output.
             part_of_multidataset (bool, optional): True if dataset is part of
                 a multidataset. 
+            cache_max_size (float, optional): Maximum size of the on-disk
+                cache of analysis results in GB. When the cache grows larger,
+                the least recently used results are removed. Defaults to 10.
 
         """
         #Parameters
@@ -145,6 +152,8 @@ class Dataset(Regionalize, Iteration, ManyColors, GeneCorr, GeneScatter, Attribu
         if not isinstance(other_columns, list):
             other_columns = [other_columns]
         self.other_columns = other_columns
+        self.cache_max_size = cache_max_size * 1e9
+        self.coordinate_transforms = []
         
         #Dask
         #if not self.part_of_multidataset:
@@ -212,6 +221,8 @@ class Dataset(Regionalize, Iteration, ManyColors, GeneCorr, GeneScatter, Attribu
         if z_offset != 0:
             self.z_offset += z_offset
             self.df.z += z_offset
+        if x_offset != 0 or y_offset != 0 or z_offset != 0:
+            self.coordinate_transforms.append(('offset', x_offset, y_offset, z_offset))
 
         self.x_extent = self.x_max - self.x_min
         self.y_extent = self.y_max - self.y_min 
@@ -348,7 +359,7 @@ class Dataset(Regionalize, Iteration, ManyColors, GeneCorr, GeneScatter, Attribu
         gene_by_cell_loom(self.dask_attrs[label_column])
 
 class MultiDataset(ManyColors, MultiIteration, MultiGeneScatter, DataLoader_base, Normalization, RegionalizeMulti,
-                   Decomposition, BoneFightMulti, Regionalization_Gradient_Multi, Boundaries_Multi):
+                   Regionalize3D, Decomposition, BoneFightMulti, Regionalization_Gradient_Multi, Boundaries_Multi):
     """Load multiple datasets as Dataset objects.
     """
 
@@ -1,34 +1,224 @@
 from typing import Any
 import numpy as np
-from sklearn.decomposition import PCA, LatentDirichletAllocation
+import scipy.sparse as sp
+from sklearn.decomposition import PCA, IncrementalPCA, LatentDirichletAllocation
+try:
+    from sklearn.decomposition import MiniBatchNMF
+except ImportError as e:
+    print(f'Please update "scikit-learn" to version 1.1 or later for NMF. Error: {e}')
+from FISHscale.utils.aggregate import _to_matrix
 
 class Decomposition:
 
-    def PCA(self, data: Any) -> np.ndarray:
+    def PCA(self, data: Any, n_components: int = None, solver: str = 'auto', chunk_size: int = 50000,
+            random_state: int = 0) -> np.ndarray:
             """Calculate principle components
 
+            With "n_components" only the requested components are calculated,
+            using a randomized SVD. The "incremental" solver fits on chunks
+            of samples, so that large or sparse matrices are never densified
+            at once.
+
             Args:
-                df_hex (pd.DataFrame): Dataframe with samples as rows and 
-                    features as columns. 
+                df_hex (pd.DataFrame): Dataframe with samples as rows and
+                    features as columns. Can also be a numpy array, sparse
+                    matrix or Dataframe with sparse columns.
+                n_components (int, optional): Number of components. If None,
+                    all components are calculated. Defaults to None.
+                solver (str, optional): "full", "randomized", "incremental" or
+                    "auto". "auto" uses "incremental" for sparse data or more
+                    than "chunk_size" samples, "randomized" if fewer than 80%
+                    of the components are requested and "full" otherwise.
+                    Defaults to 'auto'.
+                chunk_size (int, optional): Number of samples per chunk for
+                    the "incremental" solver. Defaults to 50000.
+                random_state (int, optional): Random seed. Defaults to 0.
 
             Returns:
                 [np.array]: Array with principle components as rows.
             """
-            pca = PCA()
-            return pca.fit_transform(data)
-        
-    def LDA(self, data: Any, n_components:int = 64, n_jobs:int = -1) -> np.ndarray:
+            X = _to_matrix(data)
+            max_components = min(X.shape)
+            n_components = max_components if n_components == None else min(n_components, max_components)
+
+            if solver == 'auto':
+                if sp.issparse(X) or X.shape[0] > chunk_size:
+                    solver = 'incremental'
+                elif n_components < 0.8 * max_components:
+                    solver = 'randomized'
+                else:
+                    solver = 'full'
+
+            if solver == 'incremental':
+                return self._PCA_incremental(X, n_components, chunk_size)
+            elif solver in ['full', 'randomized']:
+                if sp.issparse(X):
+                    X = X.toarray()
+                pca = PCA(n_components=n_components, svd_solver=solver, random_state=random_state)
+                return pca.fit_transform(X)
+            else:
+                raise Exception(f'Solver "{solver}" not implemented, choose from "full", "randomized", "incremental" or "auto".')
+
+    def _PCA_incremental(self, X: Any, n_components: int, chunk_size: int = 50000) -> np.ndarray:
+        """Fit and transform PCA on chunks of samples.
+
+        Args:
+            X (Any): Numpy array or sparse matrix with samples as rows.
+            n_components (int): Number of components.
+            chunk_size (int, optional): Number of samples per chunk.
+                Defaults to 50000.
+
+        Returns:
+            np.ndarray: Array with principle components as rows.
+        """
+        #Chunks can not be smaller than the number of components
+        chunk_size = max(chunk_size, n_components)
+        n_chunks = max(1, X.shape[0] // chunk_size)
+        bounds = np.linspace(0, X.shape[0], n_chunks + 1).astype(int)
+        chunks = list(zip(bounds[:-1], bounds[1:]))
+
+        def get_chunk(start, stop):
+            chunk = X[start:stop]
+            return chunk.toarray() if sp.issparse(chunk) else np.asarray(chunk)
+
+        ipca = IncrementalPCA(n_components=n_components)
+        for start, stop in chunks:
+            ipca.partial_fit(get_chunk(start, stop))
+
+        result = np.empty((X.shape[0], n_components))
+        for start, stop in chunks:
+            result[start:stop] = ipca.transform(get_chunk(start, stop))
+        return result
+
+    def LDA(self, data: Any, n_components:int = 64, n_jobs:int = -1, learning_method: str = 'batch',
+            chunk_size: int = 10000, model: Any = None, random_state: int = 0) -> np.ndarray:
         """Calculate Latent Dirichlet Allocation.
 
+        With the "online" learning method the model is updated with mini 
+        batches of "chunk_size" samples, which is faster for large numbers of
+        tiles and does not need the data as dense array. 
+
         Args:
-            df_hex (pd.DataFrame): Dataframe with samples as rows and 
-                features as columns. 
+            df_hex (pd.DataFrame): Dataframe with features as rows and samples
+                as columns. Can also be a numpy array, sparse matrix or 
+                Dataframe with sparse columns. Should contain counts.
             n_components (int, optional): Number of resulting components.
                 Defaults to 64.
             n_jobs (int, optional): Number of jobs. Defaults to -1.
+            learning_method (str, optional): "batch" or "online". 
+                Defaults to 'batch'.
+            chunk_size (int, optional): Number of samples per mini batch for
+                "online". Defaults to 10000.
+            model (LatentDirichletAllocation, optional): Fitted online model 
+                to continue training from, for example the model of a 
+                previous dataset. Implies "online". Defaults to None.
+            random_state (int, optional): Random seed. Defaults to 0.
 
         Returns:
             np.ndarray: Array with components as rows.
         """
-        lda = LatentDirichletAllocation(n_components=n_components, random_state=0, n_jobs=n_jobs)
-        return lda.fit_transform(data.T)
\ No newline at end of file
+        if learning_method == 'batch' and model == None:
+            lda = LatentDirichletAllocation(n_components=n_components, random_state=random_state, n_jobs=n_jobs)
+            return lda.fit_transform(_to_matrix(data).T)
+        elif learning_method not in ['batch', 'online']:
+            raise Exception(f'Learning method "{learning_method}" not implemented, choose from "batch" or "online".')
+        
+        model = self.topic_model_fit(data, method='LDA', n_components=n_components, chunk_size=chunk_size, 
+                                     model=model, random_state=random_state, n_jobs=n_jobs)
+        return self.topic_model_transform(model, data, chunk_size=chunk_size)
+
+    def NMF(self, data: Any, n_components: int = 64, chunk_size: int = 10000, model: Any = None, 
+            random_state: int = 0) -> np.ndarray:
+        """Calculate Non-negative Matrix Factorization with mini batches.
+
+        Args:
+            data (Any): Dataframe with features as rows and samples as 
+                columns. Can also be a numpy array, sparse matrix or 
+                Dataframe with sparse columns. Should be non-negative.
+            n_components (int, optional): Number of resulting components.
+                Defaults to 64.
+            chunk_size (int, optional): Number of samples per mini batch.
+                Defaults to 10000.
+            model (MiniBatchNMF, optional): Fitted model to continue training
+                from. Defaults to None.
+            random_state (int, optional): Random seed. Defaults to 0.
+
+        Returns:
+            np.ndarray: Array with components as rows.
+        """
+        model = self.topic_model_fit(data, method='NMF', n_components=n_components, chunk_size=chunk_size, 
+                                     model=model, random_state=random_state)
+        return self.topic_model_transform(model, data, chunk_size=chunk_size)
+
+    def topic_model_fit(self, data: Any, method: str = 'LDA', n_components: int = 64, chunk_size: int = 10000,
+                        model: Any = None, n_epochs: int = 1, random_state: int = 0, n_jobs: int = -1) -> Any:
+        """Fit an online LDA or mini batch NMF model on one or more datasets.
+
+        The samples are streamed in chunks with `partial_fit()`, dataset by
+        dataset, so that a model can cover all sections of a MultiDataset in
+        one pass without merging the data. Sparse counts are used as they are.
+
+        Args:
+            data (Any): Dataframe, numpy array or sparse matrix with features
+                as rows and samples as columns, or a list of these. All 
+                datasets should have the same features in the same order.
+            method (str, optional): "LDA" for online Latent Dirichlet 
+                Allocation or "NMF" for mini batch Non-negative Matrix 
+                Factorization. Defaults to 'LDA'.
+            n_components (int, optional): Number of components. Ignored when
+                "model" is given. Defaults to 64.
+            chunk_size (int, optional): Number of samples per mini batch. 
+                Defaults to 10000.
+            model (Any, optional): Fitted model to continue training from. If
+                None a new model is made. Defaults to None.
+            n_epochs (int, optional): Number of passes over all data. 
+                Defaults to 1.
+            random_state (int, optional): Random seed. Defaults to 0.
+            n_jobs (int, optional): Number of jobs for LDA. Defaults to -1.
+
+        Returns:
+            Any: Fitted Scikit-learn LatentDirichletAllocation or 
+                MiniBatchNMF model.
+        """
+        data = data if isinstance(data, list) else [data]
+        
+        if model == None:
+            if method.lower() == 'lda':
+                total_samples = sum([d.shape[1] for d in data])
+                model = LatentDirichletAllocation(n_components=n_components, learning_method='online', 
+                                                  batch_size=chunk_size, total_samples=total_samples,
+                                                  random_state=random_state, n_jobs=n_jobs)
+            elif method.lower() == 'nmf':
+                model = MiniBatchNMF(n_components=n_components, batch_size=chunk_size, random_state=random_state)
+            else:
+                raise Exception(f'Method "{method}" not implemented, choose from "LDA" or "NMF".')
+        
+        for epoch in range(n_epochs):
+            for d in data:
+                X = _to_matrix(d).T
+                for start in range(0, X.shape[0], chunk_size):
+                    model.partial_fit(X[start:start + chunk_size])
+        return model
+
+    def topic_model_transform(self, model: Any, data: Any, chunk_size: int = 10000) -> Any:
+        """Get the components of samples from a fitted LDA or NMF model.
+
+        Args:
+            model (Any): Model fitted with `topic_model_fit()`.
+            data (Any): Dataframe, numpy array or sparse matrix with features
+                as rows and samples as columns, or a list of these.
+            chunk_size (int, optional): Number of samples to transform at 
+                once. Defaults to 10000.
+
+        Returns:
+            [np.ndarray, list]: Array with the components of each sample, or
+                a list of arrays if "data" is a list.
+        """
+        if isinstance(data, list):
+            return [self.topic_model_transform(model, d, chunk_size) for d in data]
+        
+        X = _to_matrix(data).T
+        result = np.empty((X.shape[0], model.components_.shape[0]))
+        for start in range(0, X.shape[0], chunk_size):
+            result[start:start + chunk_size] = model.transform(X[start:start + chunk_size])
+        return result
@@ -1,8 +1,13 @@
 import pandas as pd
 import numpy as np
+from os import path
 from typing import Generator, Tuple
 from functools import lru_cache
 from difflib import get_close_matches
+try:
+    import pyarrow.parquet as pq
+except ModuleNotFoundError as e:
+    print(f'Please install "pyarrow" to enable reading genes in batches. Error: {e}')
 
 class Iteration:
 
@@ -85,6 +90,41 @@ class Iteration:
             
         return self.df.get_partition(gene_i).loc[:, columns].sample(frac=frac, random_state=random_state).compute()
     
+    def get_gene_batches(self, gene: str, batch_size: int = 1000000) -> Generator[pd.DataFrame, None, None]:
+        """Iterate over the xy coordinates of a gene in batches.
+
+        The parsed file of the gene is streamed, so that only one batch is
+        loaded in RAM. The temporary coordinate transformations, like offsets
+        and flips, are applied to every batch.
+
+        Args:
+            gene (str): Name of gene.
+            batch_size (int, optional): Maximum number of points in a batch.
+                Defaults to 1000000.
+
+        Yields:
+            pd.DataFrame: Pandas Dataframe with the "x" and "y" coordinates.
+        """
+        if not gene in self.unique_genes:
+            raise Exception(f'Given gene: "{gene}" can not be found in dataset. Did you maybe mean: {get_close_matches(gene, self.unique_genes, cutoff=0.4)}?')
+        
+        file = path.join(self.FISHscale_data_folder, f'{self.dataset_name}_{gene}.parquet')
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=batch_size, columns=['x', 'y']):
+            data = batch.to_pandas()
+            #Replay temporary transformations
+            for t in getattr(self, 'coordinate_transforms', []):
+                if t[0] == 'offset':
+                    data.loc[:, ['x', 'y']] += [t[1], t[2]]
+                elif t[0] == 'transpose':
+                    data = data.rename(columns={'x': 'y', 'y': 'x'})
+                elif t[0] == 'flip_x':
+                    data['x'] = -(data.x - t[1]) + t[1]
+                elif t[0] == 'flip_y':
+                    data['y'] = -(data.y - t[1]) + t[1]
+                else:
+                    raise Exception(f'Unknown coordinate transformation: {t[0]}')
+            yield data.loc[:, ['x', 'y']]
+    
     
     
     
@@ -1,26 +1,25 @@
-from scipy.spatial import KDTree
-from scipy.stats import spearmanr
+from scipy.stats import spearmanr, rankdata
+from scipy.stats import t as t_distribution
 import numpy as np
-from functools import lru_cache
+from tqdm import tqdm
 import pandas as pd
-from typing import Tuple, Any
+from typing import Tuple, Any, Union
 
 class GeneCorr:
 
-    @lru_cache(maxsize=None)
     def make_gene_KDTree(self) -> None:
-        """Make gene coordinate and gene KDTree dictionaries.
+        """Make gene KDTree dictionary.
+
+        The trees are taken from the spatial index of the dataset, see
+        `spatial_index()`, which builds them once and keeps them.
 
         Results stored as:
         "self.gene_KDTree" With a scipy.spatial.KDTree for the point of each
         gene. 
         
         """
-        gene_KDTree = {}
-        for gene in self.unique_genes:
-            gene_KDTree[gene] = KDTree(self.get_gene(gene))
-
-        self.gene_KDTree = gene_KDTree
+        index = self.spatial_index()
+        self.gene_KDTree = {gene: index.tree(gene) for gene in self.unique_genes}
 
     def _CBC(self, geneA: str, geneB: str, radius: float, workers: int=-1) -> Tuple[Any, Any]:
         """Calculate coordinate based colocalization.
@@ -100,7 +99,39 @@ class GeneCorr:
         
         return cor_AB, cor_BA
 
-    def _CBC_matrix(self, radius: float, workers: int=-1) -> Tuple[Any, Any]:
+    def _neighbour_count_matrix(self, radius: Union[float, list], workers: int = -1, 
+                                chunk_size: int = 100000) -> Tuple[Any, np.ndarray]:
+        """Count the molecules of every gene around every molecule.
+
+        Uses the KDTree of all molecules of the spatial index, see
+        `spatial_index()`, that is queried once per molecule, in chunks to
+        limit the memory. For multiple radii, the tree is only queried with 
+        the largest radius, see `SpatialIndex.count_neighbours()`.
+
+        Args:
+            radius (Union[float, list]): Radius within to count neighbouring
+                molecules, or list of radii.
+            workers (int, optional): Number of processes for the scipy KDTree
+                .query_ball_point() function. -1 is all processors. 
+                Defaults to -1.
+            chunk_size (int, optional): Number of molecules to query at once.
+                Defaults to 100000.
+
+        Returns:
+            Tuple[sp.csr_matrix, np.ndarray]: Sparse matrix with shape 
+                (n_molecules, n_genes) with the neighbour counts, including 
+                the molecule itself. Molecules are grouped per gene in the
+                order of self.unique_genes. And an array with the offsets of
+                the molecules of each gene, so that the molecules of gene i
+                are the rows offsets[i] to offsets[i+1]. For a list of radii,
+                the first is a list with a matrix for each radius.
+        """
+        index = self.spatial_index()
+        counts = index.count_neighbours(index.points, radius, workers=workers, chunk_size=chunk_size)
+        
+        return counts, index.offsets
+
+    def _CBC_matrix(self, radius: Union[float, list], workers: int=-1, gene_chunk_size: int = 64) -> Tuple[Any, Any]:
         """Calculate coordinate based colocalization for all genes.
 
         Malkusch, S., Endesfelder, U., Mondry, J. et al. Coordinate-based 
@@ -108,49 +139,95 @@ class GeneCorr:
         data. Histochem Cell Biol 137, 1–10 (2012). 
         https://doi.org/10.1007/s00418-011-0880-5
 
+        The neighbour counts of all genes around all molecules are made in 
+        one pass with `_neighbour_count_matrix()`. The density corrections of
+        `_CBC()` scale the counts by a constant, which does not change the 
+        Spearman correlation, so gene A to gene B is the rank correlation 
+        between column A and column B over the molecules of gene A. These are
+        calculated for all columns at once. Gives the same results as `_CBC()`
+        for every pair.
+
+        Multiple radii are handled with a single neighbour search at the
+        largest radius.
+
         Args:
-            radius (float): Radius within to look for neighbouring spots. The 
-                algorithm counts the number of spots of gene A and gene B 
-                within the radius for all spots of gene A and gene B.
+            radius (Union[float, list]): Radius within to look for neighbouring
+                spots, or list of radii. The algorithm counts the number of 
+                spots of gene A and gene B within the radius for all spots of 
+                gene A and gene B.
             workers (int, optional): Number of processes for the scipy KDTree 
                 .query_ball_point() function. -1 is all processors. 
                 Defaults to -1.
+            gene_chunk_size (int, optional): Number of genes to rank at once,
+                which limits the memory for genes with many molecules. 
+                Defaults to 64.
 
         Returns:
             [Tuple[pd.DataFrame, pd.DataFrame]]: Tuple of two pandas dataframes
             The first contains the spearman r values and the second the p
-            values.
+            values. For a list of radii, the dataframes of all radii are 
+            stacked with a (radius, gene) multi index.
 
         """
-        #Make sure self.gene_KDTree is made.
-        self.make_gene_KDTree()
+        counts, offsets = self._neighbour_count_matrix(radius, workers=workers)
+        if not isinstance(counts, list):
+            return self._CBC_from_counts(counts, offsets, radius, gene_chunk_size)
         
+        results = [self._CBC_from_counts(c, offsets, r, gene_chunk_size) for r, c in zip(radius, counts)]
+        cor = pd.concat([r[0] for r in results], keys=list(radius), names=['radius', 'gene'])
+        p = pd.concat([r[1] for r in results], keys=list(radius), names=['radius', 'gene'])
+        return cor, p
+
+    def _CBC_from_counts(self, counts: Any, offsets: np.ndarray, radius: float, 
+                         gene_chunk_size: int = 64) -> Tuple[Any, Any]:
+        """Coordinate based colocalization from a neighbour count matrix.
+
+        Args:
+            counts (sp.csr_matrix): Neighbour counts made by 
+                `_neighbour_count_matrix()`.
+            offsets (np.ndarray): Offsets of the molecules of each gene.
+            radius (float): Radius of the counts, used for the progress bar.
+            gene_chunk_size (int, optional): Number of genes to rank at once.
+                Defaults to 64.
+
+        Returns:
+            [Tuple[pd.DataFrame, pd.DataFrame]]: Spearman r values and p 
+                values.
+        """
         #make empty matrices to put the r and p values in.
         genes = self.unique_genes
         n_genes = len(genes)
-        cor = pd.DataFrame(np.zeros((n_genes, n_genes)), index = genes, columns = genes)
-        p = pd.DataFrame(np.zeros((n_genes, n_genes)), index = genes, columns = genes)
-
-        combinations = np.array(np.meshgrid(cor.index, cor.index)).T.reshape(-1,2)
-
-        #Iterate through all combinations of genes and fill the r and p matrices
-        for i, (geneA, geneB) in enumerate(combinations):
-            print(f'Radius {radius}: {i}/{combinations.shape[0]}             ', end='\r')
-            #Get the spearman r and p value for gene A versus gene B and gene B versus gene A
-            cor_AB, cor_BA = self._CBC(geneA, geneB, radius, workers=workers)
-            #Place in matrix
-            if geneA == geneB:
-                cor.loc[geneA, geneB] = cor_AB[0]
-                p.loc[geneA, geneB] = cor_AB[1]
-            else:
-                cor.loc[geneA, geneB] = cor_AB[0]
-                cor.loc[geneB, geneA] = cor_BA[0]
-                p.loc[geneA, geneB] = cor_AB[1]
-                p.loc[geneB, geneA] = cor_BA[1]
+        cor = np.full((n_genes, n_genes), np.nan)
+        
+        for a in tqdm(range(n_genes), desc=f'Radius {radius}'):
+            n = offsets[a+1] - offsets[a]
+            if n < 2:
+                continue
+            counts_A = counts[offsets[a]:offsets[a+1]]
+            #Centered ranks of the self counts, with unit length
+            self_rank = rankdata(counts_A[:, a].toarray().ravel())
+            self_rank = self_rank - self_rank.mean()
+            self_rank /= np.linalg.norm(self_rank)
             
+            for start in range(0, n_genes, gene_chunk_size):
+                stop = min(start + gene_chunk_size, n_genes)
+                ranks = rankdata(counts_A[:, start:stop].toarray(), axis=0)
+                ranks -= ranks.mean(axis=0)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    cor[a, start:stop] = (self_rank @ ranks) / np.linalg.norm(ranks, axis=0)
+        
+        #Two sided p values from the t distribution, like scipy.stats.spearmanr()
+        n_points = np.diff(offsets)[:, None].astype(float)
+        cor = np.clip(cor, -1, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = cor * np.sqrt((n_points - 2) / ((1 - cor) * (1 + cor)))
+        p = 2 * t_distribution.sf(np.abs(t), n_points - 2)
+        
+        cor = pd.DataFrame(cor, index=genes, columns=genes)
+        p = pd.DataFrame(p, index=genes, columns=genes)
         return cor, p
 
-    def gene_corr_CBC(self, radius: float, workers: int = -1) -> Tuple[Any, Any]:
+    def gene_corr_CBC(self, radius: Union[float, list], workers: int = -1, cache: bool = True) -> Tuple[Any, Any]:
         """Spatially correlate genes based on Colocalization Based Correlation.
 
         Using:
@@ -166,17 +243,57 @@ class GeneCorr:
         correlation between B and A, it does this process for all points of B.
         Therefore, the correlation is dependent on the direction.
 
+        When a list of radii is given, the neighbours are searched once with
+        the largest radius and the counts for the smaller radii are derived 
+        from the distances.
+
         Args:
-            radius (float): [description]
-            workers (int, optional): [description]. Defaults to -1.
+            radius (Union[float, list]): Radius within to look for neighbouring
+                spots, or list of radii.
+            workers (int, optional): Number of processes for the scipy KDTree 
+                .query_ball_point() function. -1 is all processors. 
+                Defaults to -1.
+            cache (bool, optional): If True, loads the result from the on-disk
+                cache if it has been calculated before with the same radius,
+                and saves new results to the cache. Radii are cached 
+                individually. Defaults to True.
 
         Returns:
-            Tuple[Any, Any]: [description]
+            Tuple[Any, Any]: Pandas dataframes with the Spearman r values and
+                the p values. For a list of radii, the dataframes of all radii
+                are stacked with a (radius, gene) multi index.
         """
-        #Make sure self.gene_KDTree is made.
-        self.make_gene_KDTree()
+        if not isinstance(radius, (list, tuple, np.ndarray)):
+            if cache and hasattr(self, 'cache_load'):
+                cached = self.cache_load('gene_corr_CBC', {'radius': radius})
+                if cached != None:
+                    return cached
+            
+            result = self._CBC_matrix(radius, workers)
+            if cache and hasattr(self, 'cache_save'):
+                self.cache_save('gene_corr_CBC', {'radius': radius}, result)
+            
+            return result
         
-        return self._CBC_matrix(radius, workers)
+        #Collect cached radii and calculate the others in one sweep
+        radius = list(radius)
+        results = {}
+        if cache and hasattr(self, 'cache_load'):
+            for r in radius:
+                cached = self.cache_load('gene_corr_CBC', {'radius': r})
+                if cached != None:
+                    results[r] = cached
+        missing = [r for r in dict.fromkeys(radius) if r not in results]
+        if len(missing) > 0:
+            cor, p = self._CBC_matrix(missing, workers)
+            for r in missing:
+                results[r] = (cor.loc[r].rename_axis(None), p.loc[r].rename_axis(None))
+                if cache and hasattr(self, 'cache_save'):
+                    self.cache_save('gene_corr_CBC', {'radius': r}, results[r])
+        
+        cor = pd.concat([results[r][0] for r in radius], keys=radius, names=['radius', 'gene'])
+        p = pd.concat([results[r][1] for r in radius], keys=radius, names=['radius', 'gene'])
+        return cor, p
 
 
     def gene_corr_hex(self, df_hex: Any=None, method: str='spearman', spacing: float=None, min_count: int=1) -> Any:
@@ -206,7 +323,7 @@ class GeneCorr:
         if type(df_hex) == type(None):
             if spacing == None and min_count == None:
                 raise Exception('If "df_hex" is not defined, both "spacing" and "min_count" need to be defined.')
-            df_hex, hex_coord, hexbin_hexagon_shape = self.make_hexbin(spacing, min_count)
+            df_hex, hex_coord = self.hexbin_make(spacing, min_count)
 
         return df_hex.T.corr(method)    
 
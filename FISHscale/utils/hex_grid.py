@@ -0,0 +1,452 @@
+import math
+import numpy as np
+import scipy.sparse as sp
+from scipy.spatial import KDTree
+from typing import Tuple
+
+
+def hex_grid_make(spacing: float, x_min: float, x_max: float, y_min: float, y_max: float) -> dict:
+    """Define a hexagonal grid with the point up: ⬡ covering an extent.
+
+    The extent is padded to a whole number of tiles. Tiles are ordered row by
+    row from the bottom left, and every even row (0, 2, 4...) is shifted half
+    a spacing to the right.
+
+    Args:
+        spacing (float): Distance between tile centers, in same units as the
+            data.
+        x_min (float): Minimum X of the extent.
+        x_max (float): Maximum X of the extent.
+        y_min (float): Minimum Y of the extent.
+        y_max (float): Maximum Y of the extent.
+
+    Returns:
+        dict: Grid definition with the "spacing", the "y_spacing" between
+            rows, the origin "x0" and "y0" which is the center of the first
+            tile before the row shift, and the number of "n_cols" and "n_rows".
+    """
+    x_extent = x_max - x_min
+    y_extent = y_max - y_min
+
+    #Correct x range to match whole number of tiles
+    n_points_x = math.ceil(x_extent / spacing)
+    difference_x = (n_points_x * spacing) - x_extent
+    x0 = x_min - (0.5 * difference_x)
+    x1 = x_max + (0.5 * difference_x)
+
+    #Correct y range to match whole number of tiles
+    y_spacing = (spacing * np.sqrt(3)) / 2
+    n_points_y = math.ceil(y_extent / y_spacing)
+    difference_y = (n_points_y * y_spacing) - y_extent
+    y0 = y_min - (0.5 * difference_y)
+    y1 = y_max + (0.5 * difference_y)
+
+    #Use the same number of points as np.arange to stay consistent with older results
+    n_cols = np.arange(x0, x1, spacing, dtype=float).shape[0]
+    n_rows = np.arange(y0, y1, y_spacing, dtype=float).shape[0]
+
+    return {'spacing': spacing, 'y_spacing': y_spacing, 'x0': x0, 'y0': y0, 'n_cols': n_cols, 'n_rows': n_rows}
+
+
+def hex_grid_global(spacing: float, x_min: float, x_max: float, y_min: float, y_max: float, 
+                    origin: Tuple[float, float] = None) -> dict:
+    """Define a hexagonal grid that is anchored to a fixed origin.
+
+    Grids with the same origin and spacing line up, independent of the
+    extent they cover. The grid position of the first tile relative to the
+    origin is stored as "row0" and "col0", so that `hex_tile_axial()` gives
+    the same tile ids for the same positions in all these grids.
+
+    Args:
+        spacing (float): Distance between tile centers, in same units as the
+            data.
+        x_min (float): Minimum X of the extent.
+        x_max (float): Maximum X of the extent.
+        y_min (float): Minimum Y of the extent.
+        y_max (float): Maximum Y of the extent.
+        origin (Tuple[float, float], optional): X and Y of the origin of the
+            grid, which is the "x0" and "y0" of the tile with axial id (0, 0)
+            before the row shift. If None, uses the grid of `hex_grid_make()`
+            over the extent. Defaults to None.
+
+    Returns:
+        dict: Grid definition like `hex_grid_make()` with the "row0" and 
+            "col0" of the first tile.
+    """
+    if origin is None:
+        grid = hex_grid_make(spacing, x_min, x_max, y_min, y_max)
+        grid.update({'row0': 0, 'col0': 0})
+        return grid
+
+    y_spacing = (spacing * np.sqrt(3)) / 2
+    #Start at an even row to keep the row shift, pad one column for the shift
+    row0 = 2 * math.floor((y_min - origin[1]) / (2 * y_spacing))
+    col0 = math.floor((x_min - origin[0]) / spacing) - 1
+    n_rows = math.ceil((y_max - origin[1]) / y_spacing) - row0 + 1
+    n_cols = math.ceil((x_max - origin[0]) / spacing) - col0 + 1
+
+    return {'spacing': spacing, 'y_spacing': y_spacing, 'x0': float(origin[0] + col0 * spacing), 
+            'y0': float(origin[1] + row0 * y_spacing), 'n_cols': n_cols, 'n_rows': n_rows, 'row0': row0, 'col0': col0}
+
+
+def hex_grid_coordinates(grid: dict) -> np.ndarray:
+    """Centroid coordinates of all tiles of a hexagonal grid.
+
+    Args:
+        grid (dict): Grid definition made by `hex_grid_make()`.
+
+    Returns:
+        np.ndarray: Array with shape (n_rows * n_cols, 2) with XY coordinates.
+    """
+    x = grid['x0'] + np.arange(grid['n_cols']) * grid['spacing']
+    y = grid['y0'] + np.arange(grid['n_rows']) * grid['y_spacing']
+    xx, yy = np.meshgrid(x, y)
+    #Offset every second row
+    xx[::2, :] += 0.5 * grid['spacing']
+
+    return np.array([xx.ravel(), yy.ravel()]).T
+
+
+def hex_tile_row_col(tile_index: np.ndarray, grid: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """Convert tile indices to row and column indices.
+
+    Args:
+        tile_index (np.ndarray): Array with tile indices.
+        grid (dict): Grid definition made by `hex_grid_make()`.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Row and column indices.
+    """
+    return np.divmod(np.asarray(tile_index), grid['n_cols'])
+
+
+def hex_tile_axial(tile_index: np.ndarray, grid: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """Convert tile indices to integer axial coordinates.
+
+    The axial coordinates (q, r) are relative to the origin of the grid. 
+    Neighbouring tiles differ by (+-1, 0), (0, +-1), (1, -1) or (-1, 1).
+
+    Args:
+        tile_index (np.ndarray): Array with tile indices.
+        grid (dict): Grid definition made by `hex_grid_make()` or 
+            `hex_grid_global()`.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Axial q and r of each tile.
+    """
+    row, col = hex_tile_row_col(tile_index, grid)
+    row = row + grid.get('row0', 0)
+    col = col + grid.get('col0', 0)
+    #Even rows are shifted half a spacing to the right
+    q = col - (row + (row & 1)) // 2
+    return q, row
+
+
+def hex_assign(x: np.ndarray, y: np.ndarray, grid: dict) -> np.ndarray:
+    """Find the nearest tile of a hexagonal grid for each point.
+
+    Calculates the nearest tile directly from the grid definition. For a
+    point between two rows the nearest tile is either in the row below or
+    in the row above, so only two candidates are tested per point. Gives the
+    same result as a nearest neighbour query on the tile centroids, but
+    without building a tree.
+
+    Args:
+        x (np.ndarray): X coordinates of the points.
+        y (np.ndarray): Y coordinates of the points.
+        grid (dict): Grid definition made by `hex_grid_make()`.
+
+    Returns:
+        np.ndarray: Tile index for each point. Points that are further away
+            than the spacing from any tile get -1.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    spacing = grid['spacing']
+    n_rows, n_cols = grid['n_rows'], grid['n_cols']
+
+    row_low = np.floor((y - grid['y0']) / grid['y_spacing']).astype(np.int64)
+    best_dist = np.full(x.shape, np.inf)
+    best_tile = np.full(x.shape, -1, dtype=np.int64)
+    for row in (row_low, row_low + 1):
+        row = np.clip(row, 0, n_rows - 1)
+        #Even rows are shifted half a spacing
+        x_row = x - grid['x0'] - np.where(row % 2 == 0, 0.5 * spacing, 0)
+        col = np.clip(np.rint(x_row / spacing).astype(np.int64), 0, n_cols - 1)
+        dist = (x_row - col * spacing)**2 + (y - grid['y0'] - row * grid['y_spacing'])**2
+        closer = dist < best_dist
+        best_dist[closer] = dist[closer]
+        best_tile[closer] = row[closer] * n_cols + col[closer]
+
+    best_tile[best_dist > spacing**2] = -1
+    return best_tile
+
+
+def hex_doubled_coordinates(hex_coord: np.ndarray, spacing: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Convert tile centroids to integer "doubled" grid coordinates.
+
+    The column is counted in half spacings, so that tiles in the same row
+    differ by 2 and tiles in neighbouring rows differ by 1. Neighbours of a
+    tile are at (+-2, 0) and (+-1, +-1).
+
+    Args:
+        hex_coord (np.ndarray): Array with XY coordinates of tile centroids
+            of a hexagonal grid with the point up: ⬡
+        spacing (float): Distance between tile centers.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Integer column and row of each tile.
+            The lowest row and column are zero.
+    """
+    y_spacing = (spacing * np.sqrt(3)) / 2
+    col = np.rint(2 * (hex_coord[:, 0] - hex_coord[:, 0].min()) / spacing).astype(np.int64)
+    row = np.rint((hex_coord[:, 1] - hex_coord[:, 1].min()) / y_spacing).astype(np.int64)
+    return col, row
+
+
+def hex_grid_from_coordinates(hex_coord: np.ndarray, spacing: float) -> Tuple[dict, np.ndarray]:
+    """Define the hexagonal grid that a set of tiles is part of.
+
+    Args:
+        hex_coord (np.ndarray): Array with XY coordinates of tile centroids
+            of a hexagonal grid with the point up: ⬡
+        spacing (float): Distance between tile centers.
+
+    Returns:
+        Tuple[dict, np.ndarray]: Grid definition like `hex_grid_make()` that
+            covers all tiles, and an array with for every tile of the grid
+            the index of the tile in "hex_coord", or -1 if the grid tile is
+            not in "hex_coord".
+    """
+    col, row = hex_doubled_coordinates(hex_coord, spacing)
+    y_spacing = (spacing * np.sqrt(3)) / 2
+    #Even rows of the grid are shifted half a spacing to the right
+    shifted = (col[0] - row[0]) % 2 == 1
+    x0 = hex_coord[:, 0].min() - (0 if shifted else 0.5 * spacing)
+    #Pad with empty tiles so that points just outside the tiles are not 
+    #assigned to the tiles at the edge. Two rows keep the row shift.
+    grid = {'spacing': spacing, 'y_spacing': y_spacing, 'x0': x0 - spacing, 'y0': hex_coord[:, 1].min() - 2 * y_spacing,
+            'n_cols': int(col.max() // 2) + 4, 'n_rows': int(row.max()) + 5}
+
+    tile_lookup = np.full(grid['n_cols'] * grid['n_rows'], -1, dtype=np.int64)
+    tile_lookup[hex_assign(hex_coord[:, 0], hex_coord[:, 1], grid)] = np.arange(hex_coord.shape[0])
+    return grid, tile_lookup
+
+
+#Neighbour offsets in doubled coordinates, counter clockwise starting east
+_HEX_NEIGHBOUR_OFFSETS = np.array([[2, 0], [1, 1], [-1, 1], [-2, 0], [-1, -1], [1, -1]])
+#Corners of a tile on a lattice of half spacings in X and half hexagon radius
+#in Y, counter clockwise starting at -30 degrees. Edge i lies between corner i
+#and corner i+1 and is shared with neighbour i.
+_HEX_CORNER_OFFSETS = np.array([[1, -1], [1, 1], [0, 2], [-1, 1], [-1, -1], [0, -2]])
+
+
+def _hex_lookup(col: np.ndarray, row: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Find the tiles at given offsets from every tile.
+
+    Args:
+        col (np.ndarray): Doubled column of each tile.
+        row (np.ndarray): Row of each tile.
+        offsets (np.ndarray): Array with shape (n_offsets, 2) with column
+            and row offsets in doubled coordinates.
+
+    Returns:
+        np.ndarray: Array with shape (n_tiles, n_offsets) with the index of
+            the tile at each offset. -1 if there is no tile.
+    """
+    pad = int(np.abs(offsets).max()) + 1
+    width = col.max() + 2 * pad + 1
+    key = (row + pad) * width + (col + pad)
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+
+    offset_key = key[:, None] + (offsets[:, 1] * width + offsets[:, 0])[None, :]
+    pos = np.clip(np.searchsorted(sorted_key, offset_key), 0, len(key) - 1)
+    found = sorted_key[pos] == offset_key
+    return np.where(found, order[pos], -1)
+
+
+def hex_neighbour_index(col: np.ndarray, row: np.ndarray) -> np.ndarray:
+    """Find the 6 neighbours of every tile.
+
+    Args:
+        col (np.ndarray): Doubled column of each tile.
+        row (np.ndarray): Row of each tile.
+
+    Returns:
+        np.ndarray: Array with shape (n_tiles, 6) with the index of the
+            neighbouring tile in counter clockwise order starting east. -1
+            if there is no tile.
+    """
+    return _hex_lookup(col, row, _HEX_NEIGHBOUR_OFFSETS)
+
+
+def hex_ring_offsets(rings: int) -> np.ndarray:
+    """Offsets of all tiles within a number of rings around a tile.
+
+    Args:
+        rings (int): Number of rings. 1 gives the 6 direct neighbours, 2 the
+            first and second ring with 18 tiles, etc.
+
+    Returns:
+        np.ndarray: Array with shape (3 * rings * (rings + 1), 2) with column
+            and row offsets in doubled coordinates, excluding the center.
+    """
+    dc, dr = np.meshgrid(np.arange(-2 * rings, 2 * rings + 1), np.arange(-rings, rings + 1))
+    dc, dr = dc.ravel(), dr.ravel()
+    #Valid tiles have a column with the same parity as the row
+    distance = np.abs(dr) + np.maximum(0, (np.abs(dc) - np.abs(dr)) // 2)
+    filt = ((dc + dr) % 2 == 0) & (distance <= rings) & (distance > 0)
+    return np.column_stack((dc[filt], dr[filt]))
+
+
+def hex_ring_adjacency(col: np.ndarray, row: np.ndarray, rings: int = 1, include_self: bool = False) -> sp.csr_matrix:
+    """Adjacency matrix of all tiles within a number of rings.
+
+    The neighbours follow directly from the grid coordinates, so tiles at
+    the edge of the tissue only get their real neighbours.
+
+    Args:
+        col (np.ndarray): Doubled column of each tile.
+        row (np.ndarray): Row of each tile.
+        rings (int, optional): Number of rings. 1 gives the 6 direct 
+            neighbours, 2 the first and second ring with 18 tiles, etc.
+            Defaults to 1.
+        include_self (bool, optional): If True, tiles are connected to
+            themselves. Defaults to False.
+
+    Returns:
+        sp.csr_matrix: Symmetric connectivity matrix with ones.
+    """
+    n = col.shape[0]
+    if rings > 0:
+        neighbours = _hex_lookup(col, row, hex_ring_offsets(rings))
+        tile, _ = np.nonzero(neighbours >= 0)
+        neighbours = neighbours[neighbours >= 0]
+    else:
+        tile, neighbours = np.array([], dtype=int), np.array([], dtype=int)
+    if include_self:
+        tile = np.concatenate((tile, np.arange(n)))
+        neighbours = np.concatenate((neighbours, np.arange(n)))
+
+    adjacency = sp.csr_matrix((np.ones(tile.shape[0]), (tile, neighbours)), shape=(n, n))
+    adjacency.sort_indices()
+    return adjacency
+
+
+def hex_spacing_infer(hex_coord: np.ndarray, sample: int = 1000) -> float:
+    """Find the spacing of a hexagonal grid from the tile coordinates.
+
+    Args:
+        hex_coord (np.ndarray): Array with XY coordinates of tile centroids.
+        sample (int, optional): Number of tiles to use. Defaults to 1000.
+
+    Returns:
+        float: Smallest distance between tile centers.
+    """
+    step = max(1, hex_coord.shape[0] // sample)
+    dist, _ = KDTree(hex_coord).query(hex_coord[::step], k=2)
+    return dist[:, 1].min()
+
+
+def _cycle_order(nxt: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Order the elements of a permutation by the cycle they belong to.
+
+    Uses pointer jumping, so that the number of array operations grows with
+    the log of the longest cycle.
+
+    Args:
+        nxt (np.ndarray): Permutation array, giving the next element.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Order of the elements so that every
+            cycle is consecutive and in walking order, and the cycle id of
+            each element in that order.
+    """
+    n = nxt.shape[0]
+    #Find the lowest element of each cycle
+    rep = np.arange(n)
+    jump = nxt.copy()
+    n_iter = int(np.ceil(np.log2(max(n, 2)))) + 1
+    for _ in range(n_iter):
+        rep = np.minimum(rep, rep[jump])
+        jump = jump[jump]
+
+    #Cut every cycle before its lowest element and rank by distance to the cut
+    index = np.arange(n)
+    end = nxt == rep
+    jump = np.where(end, index, nxt)
+    dist = (~end).astype(np.int64)
+    for _ in range(n_iter):
+        dist = dist + dist[jump]
+        jump = jump[jump]
+    order = np.lexsort((-dist, rep))
+    return order, rep[order]
+
+
+def hex_boundary_rings(hex_coord: np.ndarray, spacing: float, labels: np.ndarray) -> dict:
+    """Find the boundary rings of labeled regions in a hexagonal grid.
+
+    All tile edges where the label changes, or where there is no neighbour,
+    are found at once. The edges are oriented counter clockwise around their
+    tile, so that at every corner exactly one boundary edge of a label starts
+    and one ends. Following the edges then gives closed rings, which are 
+    counter clockwise for the outside of a region and clockwise for holes.
+
+    Args:
+        hex_coord (np.ndarray): Array with XY coordinates of tile centroids
+            of a hexagonal grid with the point up: ⬡
+        spacing (float): Distance between tile centers.
+        labels (np.ndarray): Array with a label for each tile.
+
+    Returns:
+        dict: Dictionary with for each label a list of closed rings as arrays
+            with XY coordinates. The first and last point of a ring are
+            identical.
+    """
+    labels = np.asarray(labels)
+    unique_labels, label_index = np.unique(labels, return_inverse=True)
+    col, row = hex_doubled_coordinates(hex_coord, spacing)
+
+    #Find edges where the label changes
+    neighbours = hex_neighbour_index(col, row)
+    neighbour_label = np.where(neighbours >= 0, label_index[neighbours], -1)
+    tile, side = np.nonzero(neighbour_label != label_index[:, None])
+
+    #Start and end corners of the edges on the integer corner lattice
+    corner_x = col[tile][:, None] + _HEX_CORNER_OFFSETS[:, 0][None, :]
+    corner_y = 3 * row[tile][:, None] + _HEX_CORNER_OFFSETS[:, 1][None, :]
+    side_end = (side + 1) % 6
+    start_x, start_y = corner_x[np.arange(len(tile)), side], corner_y[np.arange(len(tile)), side]
+    end_x, end_y = corner_x[np.arange(len(tile)), side_end], corner_y[np.arange(len(tile)), side_end]
+    edge_label = label_index[tile]
+
+    #Link each edge to the edge of the same label that starts where it ends
+    width_x = col.max() + 3
+    width_y = 3 * row.max() + 5
+    start_key = (edge_label * width_y + (start_y + 2)) * width_x + (start_x + 1)
+    end_key = (edge_label * width_y + (end_y + 2)) * width_x + (end_x + 1)
+    order = np.argsort(start_key, kind='stable')
+    nxt = order[np.searchsorted(start_key[order], end_key)]
+
+    #Order the edges along the rings
+    edge_order, ring = _cycle_order(nxt)
+    ring_starts = np.flatnonzero(np.r_[True, ring[1:] != ring[:-1]])
+    ring_ends = np.r_[ring_starts[1:], len(ring)]
+
+    #Convert corner lattice to coordinates
+    y_unit = spacing / (2 * np.sqrt(3))
+    x = hex_coord[:, 0].min() + start_x[edge_order] * 0.5 * spacing
+    y = hex_coord[:, 1].min() + start_y[edge_order] * y_unit
+    points = np.column_stack((x, y))
+    ring_label = edge_label[edge_order[ring_starts]]
+
+    #Close the rings by repeating the first point
+    points = np.insert(points, ring_ends, points[ring_starts], axis=0)
+    closed_rings = np.split(points, (ring_ends + np.arange(1, len(ring_ends) + 1))[:-1])
+
+    results = {l: [] for l in unique_labels}
+    for l, r in zip(ring_label, closed_rings):
+        results[unique_labels[l]].append(r)
+
+    return results
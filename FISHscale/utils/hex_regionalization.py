@@ -1,28 +1,45 @@
 import math
-from itertools import  permutations
+import hashlib
 import geopandas as gp
 import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
 import pandas as pd
 from shapely.geometry import  MultiPolygon, Polygon
-from shapely.ops import unary_union
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 from skimage.measure import subdivide_polygon
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.neighbors import kneighbors_graph, radius_neighbors_graph
+from sklearn.cluster import MiniBatchKMeans, ward_tree
+from sklearn.neighbors import kneighbors_graph
 from FISHscale.utils.fast_iteration import Iteration
 from FISHscale.utils.decomposition import Decomposition
-from FISHscale.utils.inside_polygon import inside_multi_polygons
+from FISHscale.utils.inside_polygon import polygon_grid_index, polygon_grid_assign
+from FISHscale.utils.aggregate import label_aggregate, label_indicator
+from FISHscale.utils.hex_grid import (hex_grid_make, hex_grid_coordinates, hex_assign, hex_boundary_rings,
+                                      hex_doubled_coordinates, hex_ring_adjacency, hex_spacing_infer,
+                                      hex_grid_from_coordinates)
 from typing import Tuple, Union, Any, List
 from scipy.spatial import KDTree
 from scipy.cluster.hierarchy import linkage, fcluster, dendrogram
-from collections import Counter
-from matplotlib.patches import Polygon as mpl_polygon
-from matplotlib.collections import PatchCollection
-import copy
-from functools import lru_cache
+from matplotlib.collections import PolyCollection
 import colorsys
 from sklearn.manifold import TSNE, SpectralEmbedding
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+import random
+from itertools import chain
+try:
+    import igraph as ig
+except ModuleNotFoundError as e:
+    print(f'Please install "igraph" to enable Louvain clustering of hexagonal tiles. Error: {e}')
+    ig = None
+try:
+    from annoy import AnnoyIndex
+except ModuleNotFoundError:
+    #Exact nearest neighbours are used instead
+    AnnoyIndex = None
 
 class Regionalize(Iteration, Decomposition):
     """Class for regionalization of multidimensional 2D point data.
@@ -60,19 +77,44 @@ class Regionalize(Iteration, Decomposition):
         return coordinates
             
     def hexbin_make(self, spacing: float, min_count: int, feature_selection: np.ndarray=None,
-                    n_jobs: int=-1) -> Tuple[Any, np.ndarray]:
+                    n_jobs: int=-1, cache: bool=True, batch_size: int=None, 
+                    sparse: bool=False, grid: dict=None) -> Tuple[Any, np.ndarray]:
         """
         Bin 2D point data with hexagonal bins.
         
         Stores the centroids of the exagons under self.hexagon_coordinates,
-        and the hexagon shape under self.hexbin_hexagon_shape.
+        and the hexagon shape under self.hexbin_hexagon_shape. The grid 
+        definition is stored under self.hexbin_grid and the index of the
+        valid tiles in the full grid under self.hexbin_tile_index.
+        
+        For sections that are larger than RAM use "batch_size". The parsed 
+        file of every gene is then streamed once in batches that are binned 
+        one by one. The counts are collected in a sparse matrix so that the 
+        peak memory depends on the batch size and the number of tiles with 
+        molecules, not on the size of the section.
         Args:
             spacing (float): distance between tile centers, in same units as 
                 the data. The function makes hexagons with the point up: ⬡
             min_count (int): Minimal number of molecules in a tile to keep the 
                 tile in the dataset.
-            n_jobs (int, optional): Number of workers. If -1 it takes the max
-                cpu count. Defaults to -1.
+            feature_selection (np.ndarray, optional): Array with genes to bin.
+                If None, all genes are used. Defaults to None.
+            n_jobs (int, optional): Number of genes to read in parallel in 
+                batched mode. If -1 it takes the max cpu count. Defaults to -1.
+            cache (bool, optional): If True, loads the result from the on-disk
+                cache if the dataset has been binned before with the same
+                parameters, and saves new results to the cache. 
+                Defaults to True.
+            batch_size (int, optional): Maximum number of molecules to read
+                at once. If None, the molecules of a gene are read at once.
+                Defaults to None.
+            sparse (bool, optional): If True, returns a sparse Pandas 
+                Dataframe. Defaults to False.
+            grid (dict, optional): Grid definition made by `hex_grid_global()`
+                to bin on, instead of a grid that covers this dataset. Use a
+                grid over the extent of multiple datasets to give the same 
+                tiles the same index in all datasets. The spacing of the grid
+                should match "spacing". Defaults to None.
         Returns:
             Tuple[pd.DataFrame, np.ndarray]: 
             Pandas Dataframe with counts for each valid tile.
@@ -82,114 +124,222 @@ class Regionalize(Iteration, Decomposition):
         #workers
         if n_jobs == -1:
             n_jobs = self.cpu_count
-            
-        #Get canvas size
-        max_x = self.x_max
-        min_x = self.x_min
-        max_y = self.y_max
-        min_y = self.y_min
-        
-        #Find X range 
-        n_points_x = math.ceil((max_x - min_x) / spacing)
-        #Correct x range to match whole number of tiles
-        full_x_extent = n_points_x * spacing
-        difference_x = full_x_extent - self.x_extent
-        min_x = min_x - (0.5 * difference_x)
-        max_x = max_x + (0.5 * difference_x)
-        
-        #Find Y range 
-        y_spacing = (spacing * np.sqrt(3)) / 2
-        n_points_y = math.ceil((max_y - min_y) / y_spacing)
-        #Correct y range to match whole number of tiles
-        full_y_extent = n_points_y * y_spacing
-        difference_y = full_y_extent - self.y_extent
-        min_y = min_y - (0.5 * difference_y)
-        max_y = max_y + (0.5 * difference_y)
-            
-        #make hexagonal grid
-        x = np.arange(min_x, max_x, spacing, dtype=float)
-        y = np.arange(min_y, max_y, y_spacing, dtype=float)
-        xx, yy = np.meshgrid(x, y)
-        #Offset every second row 
-        xx[::2, :] += 0.5*spacing
-        coordinates = np.array([xx.ravel(), yy.ravel()]).T
-        
-        #make KDTree
-        tree = KDTree(coordinates)
         
         #genes
-        if not isinstance(feature_selection, np.ndarray):
-            genes = self.unique_genes
-        elif isinstance(feature_selection, list):
+        if isinstance(feature_selection, list):
             genes = np.array(feature_selection)
+        elif not isinstance(feature_selection, np.ndarray):
+            genes = self.unique_genes
         else:
             genes = feature_selection
-        
-        #Make Results dataframe
         n_genes = len(genes)
+        
+        #make hexagonal grid
+        shared_grid = grid != None
+        if not shared_grid:
+            grid = hex_grid_make(spacing, self.x_min, self.x_max, self.y_min, self.y_max)
+        elif not math.isclose(grid['spacing'], spacing):
+            raise Exception(f'Spacing of the grid ({grid["spacing"]}) does not match "spacing" ({spacing}).')
+        self.hexbin_grid = grid
+        self.hexbin_hexagon_shape = self.hexagon_shape(spacing, closed=True)
+        #Vertices of previous tiles can not be reused
+        self._hexbin_vertices_cache = {}
+        
+        #Check cache
+        cache_params = {'spacing': spacing, 'min_count': min_count, 'genes': genes, 'sparse': sparse}
+        if shared_grid:
+            cache_params['grid'] = grid
+        if cache and hasattr(self, 'cache_load'):
+            cached = self.cache_load('hexbin_make', cache_params)
+            if cached != None:
+                df_hex, coordinates, self.hexbin_tile_index = cached
+                self.hexbin_coordinates = coordinates
+                self._hexbin_params = f'spacing_{spacing}_min_count_{min_count}_ngenes{n_genes}'
+                return df_hex, coordinates
+        
+        coordinates = hex_grid_coordinates(grid)
         n_tiles = coordinates.shape[0]
-        df_hex = pd.DataFrame(data=np.zeros((n_genes, n_tiles)),
-                            index=genes, 
-                            columns=[f'{self.dataset_name}_{j}' for j in range(n_tiles)])
         
         #Hexagonal binning of data
-        for i, g in enumerate(genes):
-            data = self.get_gene(g)
-            #Query nearest neighbour ()
-            dist, idx = tree.query(data, distance_upper_bound=spacing, workers=n_jobs)
-            #Count the number of hits
-            count = np.zeros(n_tiles)
-            counter = Counter(idx)
-            count[list(counter.keys())] = list(counter.values())
-            #Add to dataframe
-            df_hex.loc[g] = count
-        
-        #make hexagon coordinates
-        self.hexbin_hexagon_shape = self.hexagon_shape(spacing, closed=True)
+        if batch_size == None:
+            counts = None if sparse else np.zeros((n_genes, n_tiles))
+            rows, cols, values = [], [], []
+            for i, g in enumerate(genes):
+                data = self.get_gene(g)
+                idx = hex_assign(data.x.to_numpy(), data.y.to_numpy(), grid)
+                gene_counts = np.bincount(idx[idx >= 0], minlength=n_tiles)
+                if sparse:
+                    #Only keep the tiles with molecules
+                    nonzero = np.nonzero(gene_counts)[0]
+                    rows.append(np.full(nonzero.shape[0], i))
+                    cols.append(nonzero)
+                    values.append(gene_counts[nonzero])
+                else:
+                    counts[i] = gene_counts
+            if sparse:
+                counts = sp.coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                       shape=(n_genes, n_tiles)).tocsr()
+        else:
+            counts = self._hexbin_batched(genes, grid, batch_size, n_jobs)
             
         #Filter on number of counts
-        filt = df_hex.sum() >= min_count
-        df_hex = df_hex.loc[:, filt]
+        filt = np.asarray(counts.sum(axis=0)).ravel() >= min_count
+        tile_index = np.nonzero(filt)[0]
+        counts = counts[:, filt]
+        columns = [f'{self.dataset_name}_{j}' for j in tile_index]
+        if sparse:
+            df_hex = pd.DataFrame.sparse.from_spmatrix(sp.csr_matrix(counts, dtype=float), index=genes, columns=columns)
+            df_hex = df_hex.astype(pd.SparseDtype(float, 0))
+        else:
+            counts = counts.toarray() if sp.issparse(counts) else counts
+            df_hex = pd.DataFrame(data=counts.astype(float), index=genes, columns=columns)
         coordinates = coordinates[filt]
         self.hexbin_coordinates = coordinates
+        self.hexbin_tile_index = tile_index
         
         #store settings for plotting
         self._hexbin_params = f'spacing_{spacing}_min_count_{min_count}_ngenes{n_genes}'
+        
+        if cache and hasattr(self, 'cache_save'):
+            self.cache_save('hexbin_make', cache_params, (df_hex, coordinates, tile_index))
 
         return df_hex, coordinates
+    
+    def _hexbin_batched(self, genes: np.ndarray, grid: dict, batch_size: int, n_jobs: int = 1) -> Any:
+        """Bin the data gene by gene, streaming each gene in batches.
+
+        Every parsed file is read once. The counts of a gene are accumulated
+        for the tiles with molecules only.
+
+        Args:
+            genes (np.ndarray): Genes to bin.
+            grid (dict): Grid definition made by `hex_grid_make()`.
+            batch_size (int): Maximum number of molecules to read at once.
+            n_jobs (int, optional): Number of genes to read in parallel. 
+                Defaults to 1.
+
+        Returns:
+            sp.csr_matrix: Sparse matrix with counts, genes in rows and all 
+                tiles of the grid in columns.
+        """
+        n_tiles = grid['n_rows'] * grid['n_cols']
+        
+        def bin_gene(g):
+            tiles, counts = np.empty(0, dtype=np.int64), np.empty(0)
+            for data in self.get_gene_batches(g, batch_size=batch_size):
+                idx = hex_assign(data.x.to_numpy(), data.y.to_numpy(), grid)
+                idx = idx[idx >= 0]
+                #Merge with the counts of the previous batches
+                tiles, inverse = np.unique(np.concatenate([tiles, idx]), return_inverse=True)
+                counts = np.bincount(inverse, weights=np.concatenate([counts, np.ones(idx.shape[0])]), 
+                                     minlength=tiles.shape[0])
+            return tiles, counts
+        
+        with ThreadPoolExecutor(max_workers=max(1, n_jobs)) as executor:
+            results = list(tqdm(executor.map(bin_gene, genes), total=len(genes), desc='Binning genes'))
+        
+        rows = np.repeat(np.arange(len(genes)), [r[0].shape[0] for r in results])
+        cols = np.concatenate([r[0] for r in results])
+        counts = np.concatenate([r[1] for r in results])
+        return sp.coo_matrix((counts, (rows, cols)), shape=(len(genes), n_tiles)).tocsr()
                   
-    @lru_cache(maxsize=5)
-    def _hexbin_PatchCollection_make(self, params: str, filter = None):
-        """Generate hexbin patch collection for plotting
+    def _hexbin_vertices_make(self, params: str, filter: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Generate the vertices of all hexagons for plotting.
+        
+        The vertices are made in one broadcast of the hexagon shape over the
+        tile coordinates, and cached so that they can be reused by every plot.
+        The cache is keyed on the current tile coordinates, so that vertices 
+        are remade when the tiles change.
         Args:
             params (str): The hexbin function saves its parameters under:
-                self._hexbin_params. This is used to check if the patch 
-                collection needs to be recalculated when the hexbin function 
-                has been run with different parameters.
-            filter (str): String representation of a boolean array of ones and
-                zeros. Example '1101' for [True, True, Flase, True].
-                (Needed because lru_cache does not take arrays)
+                self._hexbin_params. This is used to check if the vertices 
+                need to be recalculated when the hexbin function has been run 
+                with different parameters.
+            filter (np.ndarray): Boolean array to filter hexbin coordinates.
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Array with shape 
+                (n_tiles, 7, 2) with the vertices of each hexagon, and the 
+                minimum and maximum coordinates.
+        """
+        if not hasattr(self, '_hexbin_vertices_cache'):
+            self._hexbin_vertices_cache = {}
+        filter_key = None if type(filter) == type(None) else np.packbits(np.asarray(filter, dtype=bool)).tobytes()
+        coordinate_key = hashlib.sha1(np.ascontiguousarray(self.hexbin_coordinates).tobytes()).hexdigest()
+        key = (params, coordinate_key, self.hexbin_coordinates.shape, filter_key)
+        
+        if key not in self._hexbin_vertices_cache:
+            coordinates = self.hexbin_coordinates
+            if type(filter) != type(None):
+                coordinates = coordinates[np.asarray(filter, dtype=bool)]
+            vertices = coordinates[:, None, :] + self.hexbin_hexagon_shape[None, :, :]
+            #Keep the last few grids
+            if len(self._hexbin_vertices_cache) >= 5:
+                del self._hexbin_vertices_cache[next(iter(self._hexbin_vertices_cache))]
+            self._hexbin_vertices_cache[key] = (vertices, coordinates.min(axis=0), coordinates.max(axis=0))
+            
+        return self._hexbin_vertices_cache[key]
+    
+    def _hexbin_raster_make(self, c: Union[np.ndarray, list], filter: np.ndarray = None, 
+                            resolution: int = 4) -> Tuple[np.ndarray, np.ndarray, list]:
+        """Paint the hexagonal tiles in an image array.
+        
+        Every pixel gets the value of the tile that its center falls in, 
+        using the grid definition of the last `hexbin_make()` call. 
+        Args:
+            c (np.ndarray, list): Eiter an Array with color values, or a list 
+                of RGB color values.
+            filter (np.ndarray): Boolean array to filter hexbin coordinates.
+            resolution (int, optional): Number of pixels per tile spacing.
+                Defaults to 4.
         Returns:
-            Matplotlib patch collection
+            Tuple[np.ndarray, np.ndarray, list]: Image, with NaN or transparent
+                pixels where there are no tiles. The minimum and maximum
+                coordinates, and the extent for plt.imshow().
         """
-        if type(filter) == type(None):
-            filter = np.ones(self.hexbin_coordinates.shape[0]).astype('bool')
+        if not hasattr(self, 'hexbin_grid') or not hasattr(self, 'hexbin_tile_index'):
+            raise Exception('Raster plotting needs the grid of the hexbin. Please make using: self.hexbin_make()')
+        grid = self.hexbin_grid
+        tile_index = self.hexbin_tile_index
+        coordinates = self.hexbin_coordinates
+        if type(filter) != type(None):
+            filter = np.asarray(filter, dtype=bool)
+            tile_index = tile_index[filter]
+            coordinates = coordinates[filter]
+        plot_min, plot_max = coordinates.min(axis=0), coordinates.max(axis=0)
+        
+        #Lookup from grid tile to plotted tile
+        lookup = np.full(grid['n_rows'] * grid['n_cols'], -1)
+        lookup[tile_index] = np.arange(tile_index.shape[0])
+        
+        #Pixel centers
+        pixel_size = grid['spacing'] / resolution
+        d = 0.5 * grid['spacing']
+        x = np.arange(plot_min[0] - d, plot_max[0] + d, pixel_size) + 0.5 * pixel_size
+        y = np.arange(plot_min[1] - d, plot_max[1] + d, pixel_size) + 0.5 * pixel_size
+        xx, yy = np.meshgrid(x, y)
+        tile = hex_assign(xx.ravel(), yy.ravel(), grid)
+        pixel_tile = np.where(tile >= 0, lookup[np.maximum(tile, 0)], -1)
+        valid = pixel_tile >= 0
+        
+        if type(c) == list or (isinstance(c, np.ndarray) and c.ndim == 2):
+            c = np.asarray(c, dtype=float)
+            image = np.zeros((pixel_tile.shape[0], 4))
+            image[valid, :c.shape[1]] = c[pixel_tile[valid]]
+            image[valid, 3] = 1 if c.shape[1] == 3 else image[valid, 3]
+            image = image.reshape(y.shape[0], x.shape[0], 4)
         else:
-            filter = np.array([int(i) for i in filter]).astype('bool')
-        
-        patches = []
-        coordinates = self.hexbin_coordinates[filter]
-        for i in coordinates:
-            pol = mpl_polygon(self.hexbin_hexagon_shape + i, closed=True)
-            patches.append(pol)
-        self._hexbin_PatchCollection = PatchCollection(patches)
-        return PatchCollection(patches), coordinates.min(axis=0), coordinates.max(axis=0)
+            image = np.full(pixel_tile.shape[0], np.nan)
+            image[valid] = np.asarray(c)[pixel_tile[valid]]
+            image = image.reshape(y.shape[0], x.shape[0])
+        
+        extent = [x[0] - 0.5 * pixel_size, x[-1] + 0.5 * pixel_size, y[0] - 0.5 * pixel_size, y[-1] + 0.5 * pixel_size]
+        return image, (plot_min, plot_max), extent
                 
     def hexbin_plot(self, c: Union[np.ndarray, list], cm:Any=None, 
                     filter: np.ndarray = None, ax:Any=None, 
                     figsize=None, save:bool=False, savename:str='',
                     vmin:float=None, vmax:float=None, linewidth:float=0.1,
-                    colorbar=False):
+                    colorbar=False, raster: bool=False, raster_resolution: int=4):
         """Plot hexbin results. 
         Args:
             c (np.ndarray, list): Eiter an Array with color values as a float
@@ -208,6 +358,11 @@ class Regionalize(Iteration, Decomposition):
                 Defaults to None.
             linewidth (float, optional): When saving you might see gaps between
                 the hexagons. Increase the linewidth to hide them
+            raster (bool, optional): If True, paints the tiles in an image 
+                instead of drawing a polygon for each tile. Much faster for
+                large grids. Defaults to False.
+            raster_resolution (int, optional): Number of pixels per tile 
+                spacing in raster mode. Defaults to 4.
         """
         #Input handling
         if ax == None: 
@@ -216,51 +371,47 @@ class Regionalize(Iteration, Decomposition):
             fig, ax = plt.subplots(figsize=figsize)
         if cm == None:
             cm = plt.cm.viridis
-
-        #Get PatchCollection, patchCollection can only be added once to a figue so make a deep copy.
         if not hasattr(self, '_hexbin_params'):
             raise Exception('Hexbin has not been calculated yet. Please make using: self.hexbin_make()')
-        #Format filter to be hasable for lru_cache
-        if type(filter) != type(None):
-            filter = ''.join(map(str, filter.astype('int')))
-        p, plot_min, plot_max = copy.deepcopy(self._hexbin_PatchCollection_make(self._hexbin_params, filter=filter))
-        ax.add_collection(p)
-        #Set colors from an RGB list
-        if type(c) == list:
-            p.set_color(c)
-            p.set_linewidth(linewidth) #To hide small white lines between the polygons
-            p.set_edgecolor(c)
-            if colorbar:
-                print('Colorbar not possible to add when giving a list of RGB colors')
-                colorbar=False
+        if vmin != None or vmax != None:
+            if vmin == None:
+                raise Exception('If "vmax" is set, also "vmin" needs to be specified.')
+            if vmax == None:
+                raise Exception('If "vmin" is set, also "vmax" needs to be specified.')
+        if type(c) == list and colorbar:
+            print('Colorbar not possible to add when giving a list of RGB colors')
+            colorbar=False
+
+        if raster:
+            image, (plot_min, plot_max), extent = self._hexbin_raster_make(c, filter=filter, resolution=raster_resolution)
+            p = ax.imshow(image, cmap=cm, vmin=vmin, vmax=vmax, extent=extent, origin='lower', interpolation='nearest')
             
-        #Set colors from an array of values
         else:
-            #c = c / c.max()
-            p.set_array(c)
-            p.set_cmap(cm)
+            #A new collection is made from the cached vertices, because a collection can only be added once to a figure
+            vertices, plot_min, plot_max = self._hexbin_vertices_make(self._hexbin_params, filter=filter)
+            p = PolyCollection(vertices, closed=True)
+            ax.add_collection(p)
             p.set_linewidth(linewidth) #To hide small white lines between the polygons
-            if vmin!= None or vmax!=None:
-                if vmin == None:
-                    raise Exception('If "vmax" is set, also "vmin" needs to be specified.')
-                if vmax == None:
-                    raise Exception('If "vmin" is set, also "vmax" needs to be specified.')
-                p.set_clim(vmin=vmin, vmax=vmax)
-                c_scaled = c - vmin
-                c_scaled[c_scaled < 0] = 0
-                c_scaled = c_scaled / (vmax - vmin)
-                p.set_edgecolor(cm(c_scaled))
+            #Set colors from an RGB list
+            if type(c) == list:
+                p.set_facecolor(c)
+                p.set_edgecolor(c)
+                
+            #Set colors from an array of values
             else:
-                c_scaled = c - c.min()
-                c_scaled = c_scaled / c_scaled.max()
-                p.set_edgecolor(cm(c_scaled))
+                p.set_array(c)
+                p.set_cmap(cm)
+                if vmin!= None:
+                    p.set_clim(vmin=vmin, vmax=vmax)
+                #Edges get the same color as the faces
+                p.set_edgecolor('face')
 
         #Colorbar
         if colorbar:
-            fig.colorbar(p, ax=ax)
+            ax.figure.colorbar(p, ax=ax)
             
         #Scale
-        d = 0.5 * int(self._hexbin_params.split('_')[1])
+        d = 0.5 * float(self._hexbin_params.split('_')[1])
         ax.set_xlim(plot_min[0] - d, plot_max[0] + d)
         ax.set_ylim(plot_min[1] - d, plot_max[1] + d)
         ax.set_aspect('equal')
@@ -269,8 +420,6 @@ class Regionalize(Iteration, Decomposition):
         if save:
             plt.savefig(f'{savename}_hexbin.pdf')
             
-        del p, plot_min, plot_max
-            
     def hexbin_tsne_plot(self, data = None, tsne:np.ndarray = None, components: int = 2, save:bool=False, savename:str=''):
         """Calculate tSNE on hexbin and plot spatial identities.
         
@@ -423,9 +572,49 @@ class Regionalize(Iteration, Decomposition):
         if save:
             plt.savefig(f'{savename}_hexbin_decomposition_[{components[0]}, {components[1]}].png', dpi=200)
 
+    def hex_adjacency(self, hex_coord: np.ndarray, spacing: float = None, neighbor_rings: int = 1, 
+                      include_self: bool = False) -> Any:
+        """Get the connectivity matrix of tiles within a number of rings.
+        
+        The neighbours are found from the grid position of the tiles, so that
+        every tile gets exactly its neighbours on the hexagonal grid. Results 
+        are cached, keyed on the coordinates and settings, so that 
+        clustering, smoothing and boundary detection on the same tiles share
+        one matrix.
+        Args:
+            hex_coord (np.ndarray): Numpy Array with XY coordinates of the
+                centroids of the hexagonal tiles.
+            spacing (float, optional): Distance between hexagon tile centers.
+                If None, it is derived from the coordinates. Defaults to None.
+            neighbor_rings (int, optional): Number of rings around a central 
+                tile. 1 means the 6 imediate neighbors. 2 means the first and 
+                second ring, making 18 neigbors, etc. Defaults to 1.
+            include_self (bool, optional): If True, tiles are connected to
+                themselves. Defaults to False.
+        Returns:
+            sp.csr_matrix: Sparse connectivity matrix.
+        """
+        if spacing == None:
+            spacing = hex_spacing_infer(hex_coord)
+        if not hasattr(self, '_hex_adjacency_cache'):
+            self._hex_adjacency_cache = {}
+        key = (hashlib.sha1(np.ascontiguousarray(hex_coord).tobytes()).hexdigest(), hex_coord.shape, 
+               spacing, neighbor_rings, include_self)
+        
+        if key not in self._hex_adjacency_cache:
+            col, row = hex_doubled_coordinates(hex_coord, spacing)
+            #Keep the last few matrices
+            if len(self._hex_adjacency_cache) >= 5:
+                del self._hex_adjacency_cache[next(iter(self._hex_adjacency_cache))]
+            self._hex_adjacency_cache[key] = hex_ring_adjacency(col, row, neighbor_rings, include_self=include_self)
+        
+        return self._hex_adjacency_cache[key]
+
     def clust_hex_connected(self, df_hex, hex_coord: np.ndarray, spacing: float,
                             distance_threshold: float = None, n_clusters:int = None, 
-                            neighbor_rings:int = 1, n_jobs:int=-1) -> np.ndarray:
+                            neighbor_rings:int = 1, n_jobs:int=-1, method: str = 'ward',
+                            resolution: float = 1.0, n_neighbors: int = 15, 
+                            n_precluster: int = None, random_state: int = 0) -> np.ndarray:
         """Cluster hex-bin data, with a neighborhood embedding.
         Clusters with AggolmerativeClustering that uses a distance matrix 
         made from the tiles and their neighbours within the neighbour_radius.
@@ -434,6 +623,16 @@ class Regionalize(Iteration, Decomposition):
         "distance_threshold" that determines the cutoff. When passing
         multiple datasets that require a different number of clusters the
         "distance_threshold" will be more suitable.
+
+        Ward clustering with connectivity scales poorly with the number of 
+        tiles. For large datasets two other methods are available:
+        - "louvain": Louvain community detection on a graph of the spatial
+            neighbours and the expression nearest neighbours of the tiles.
+            The number of clusters is set by the "resolution", 
+            "n_clusters" can not be used. Requires "igraph".
+        - "kmeans_ward": Mini batch KMeans pre-clustering into spatially 
+            connected fragments, followed by Ward clustering of the fragment
+            centroids with connectivity.
         Args:
             df_hex (pd.Dataframe): Pandas Dataframe with molecule counts for
                 each hexagonal tile
@@ -449,36 +648,303 @@ class Regionalize(Iteration, Decomposition):
                 Clustering with connectivity. 1 means connections with the 6 
                 imediate neighbors. 2 means the first and second ring, making 
                 18 neigbors, etc.. Defaults to 1.
+            n_jobs (int, optional): Number of jobs. Defaults to -1.
+            method (str, optional): Clustering method, choose from "ward", 
+                "louvain" or "kmeans_ward". Defaults to 'ward'.
+            resolution (float, optional): Resolution for "louvain". Higher 
+                values give more clusters. Defaults to 1.0.
+            n_neighbors (int, optional): Number of expression nearest 
+                neighbours that are added to the graph for "louvain". If 0
+                only the spatial neighbours are used. Defaults to 15.
+            n_precluster (int, optional): Approximate number of KMeans 
+                clusters for "kmeans_ward". If None, uses one per 100 tiles,
+                with a minimum of 100. Defaults to None.
+            random_state (int, optional): Random seed for "louvain" and 
+                "kmeans_ward". Defaults to 0.
         Raises:
             Exception: If "distance_threshold" and "n_clusters" are not 
-                properly defined
+                properly defined, or if "n_clusters" is given for "louvain".
         Returns:
             [np.array]: Numpy array with cluster labels.
         """
         #Input check
-        if distance_threshold!=None and n_clusters!=None:
-            raise Exception('One of "distance_threshold" or "n_clusters" should be defined, not both.')
-        if distance_threshold==None and n_clusters==None:
-            raise Exception('One of "distance_threshold" or "n_clusters" should be defined.')
+        if method not in ['ward', 'louvain', 'kmeans_ward']:
+            raise Exception(f'Method "{method}" not implemented, choose from "ward", "louvain" or "kmeans_ward".')
+        if method == 'louvain' and n_clusters != None:
+            raise Exception('"n_clusters" can not be used with "louvain", set the number of clusters with "resolution".')
+        if method != 'louvain':
+            if distance_threshold!=None and n_clusters!=None:
+                raise Exception('One of "distance_threshold" or "n_clusters" should be defined, not both.')
+            if distance_threshold==None and n_clusters==None:
+                raise Exception('One of "distance_threshold" or "n_clusters" should be defined.')
 
         #Make graph to connect neighbours 
         if neighbor_rings > 0:
-            r_neighbors = neighbor_rings * spacing + (0.1 * spacing) #Some extra to be sure there are no rounding errors.
-            Kgraph = radius_neighbors_graph(hex_coord, r_neighbors, include_self=False, n_jobs=n_jobs)
+            Kgraph = self.hex_adjacency(hex_coord, spacing, neighbor_rings)
         else:
             Kgraph = None
 
+        X = np.asarray(df_hex)
+        if method == 'louvain':
+            return self._clust_louvain(X, Kgraph, resolution=resolution, n_neighbors=n_neighbors, 
+                                       random_state=random_state, n_jobs=n_jobs)
+
         #Cluster
-        clust_result = AgglomerativeClustering(n_clusters=n_clusters,
-                                               distance_threshold=distance_threshold, 
-                                               compute_full_tree=True, 
-                                               connectivity=Kgraph,
-                                               linkage='ward').fit(df_hex)
+        tree = self._clust_tree_fit(X, hex_coord, Kgraph, method=method, n_precluster=n_precluster,
+                                    random_state=random_state)
         #Return labels
-        return clust_result.labels_
+        return self.clust_tree_cut(tree, distance_threshold=distance_threshold, n_clusters=n_clusters)
+
+    def clust_hex_tree(self, df_hex, hex_coord: np.ndarray, spacing: float, neighbor_rings: int = 1, 
+                       method: str = 'ward', n_precluster: int = None, random_state: int = 0) -> dict:
+        """Fit the connected Ward merge tree of hex-bin data once.
+
+        The tree can be cut at many distance thresholds or numbers of clusters
+        with `clust_tree_cut()`, without clustering again. Cutting gives the
+        same result as `clust_hex_connected()` with the same settings.
+        Args:
+            df_hex (pd.Dataframe): Pandas Dataframe or array with features for
+                each hexagonal tile.
+            hex_coord (np.array): Numpy Array with XY coordinates of the
+                centroids of the hexagonal tiles. 
+            spacing (float): distance between hexagon tile centers.
+            neighbor_rings (int, optional): Number of rings around a central 
+                tile to make connections between tiles. Defaults to 1.
+            method (str, optional): "ward" or "kmeans_ward". See 
+                `clust_hex_connected()`. Defaults to 'ward'.
+            n_precluster (int, optional): Approximate number of KMeans 
+                clusters for "kmeans_ward". Defaults to None.
+            random_state (int, optional): Random seed for "kmeans_ward". 
+                Defaults to 0.
+        Returns:
+            dict: Dictionary with the "children" and merge "distances" of 
+                the tree, the number of leaves "n_leaves" and the 
+                "leaf_index" with the leaf of every tile.
+        """
+        if method not in ['ward', 'kmeans_ward']:
+            raise Exception(f'Method "{method}" does not make a merge tree, choose from "ward" or "kmeans_ward".')
+        Kgraph = self.hex_adjacency(hex_coord, spacing, neighbor_rings) if neighbor_rings > 0 else None
+        return self._clust_tree_fit(np.asarray(df_hex), hex_coord, Kgraph, method=method, 
+                                    n_precluster=n_precluster, random_state=random_state)
+
+    def _clust_tree_fit(self, X: np.ndarray, hex_coord: np.ndarray, Kgraph: Any, method: str = 'ward', 
+                        n_precluster: int = None, random_state: int = 0) -> dict:
+        """Fit a Ward merge tree with connectivity.
+        Args:
+            X (np.ndarray): Array with features of the tiles.
+            hex_coord (np.ndarray): Array with XY coordinates of the tiles.
+            Kgraph (sp.csr_matrix): Spatial connectivity matrix or None.
+            method (str, optional): "ward" or "kmeans_ward". 
+                Defaults to 'ward'.
+            n_precluster (int, optional): Approximate number of KMeans 
+                clusters for "kmeans_ward". Defaults to None.
+            random_state (int, optional): Random seed. Defaults to 0.
+        Returns:
+            dict: Tree, see `clust_hex_tree()`.
+        """
+        if method == 'kmeans_ward':
+            leaf_index, X, Kgraph = self._kmeans_fragments(X, hex_coord, Kgraph, n_precluster=n_precluster,
+                                                           random_state=random_state)
+        else:
+            leaf_index = np.arange(X.shape[0])
+        
+        if X.shape[0] > 1:
+            children, _, n_leaves, _, distances = ward_tree(X, connectivity=Kgraph, return_distance=True)
+        else:
+            children, n_leaves, distances = np.zeros((0, 2), dtype=int), X.shape[0], np.zeros(0)
+        
+        return {'children': children, 'distances': distances, 'n_leaves': n_leaves, 'leaf_index': leaf_index}
+
+    def clust_tree_cut(self, tree: dict, distance_threshold: float = None, n_clusters: int = None) -> np.ndarray:
+        """Cut a merge tree into clusters.
+        Args:
+            tree (dict): Tree made by `clust_hex_tree()`.
+            distance_threshold (float, optional): Merge distance above which
+                clusters are not merged. Defaults to None.
+            n_clusters (int, optional): Number of desired clusters. 
+                Defaults to None.
+        Raises:
+            Exception: If "distance_threshold" and "n_clusters" are not 
+                properly defined
+        Returns:
+            np.ndarray: Numpy array with cluster labels for each tile.
+        """
+        if distance_threshold!=None and n_clusters!=None:
+            raise Exception('One of "distance_threshold" or "n_clusters" should be defined, not both.')
+        if distance_threshold==None and n_clusters==None:
+            raise Exception('One of "distance_threshold" or "n_clusters" should be defined.')
+
+        n_leaves = tree['n_leaves']
+        if distance_threshold != None:
+            n_clusters = int(np.count_nonzero(tree['distances'] >= distance_threshold)) + 1
+        n_clusters = min(max(n_clusters, 1), n_leaves)
+        
+        #Perform the first merges, merge i makes node n_leaves + i
+        n_merges = n_leaves - n_clusters
+        children = tree['children'][:n_merges]
+        parents = np.repeat(np.arange(n_leaves, n_leaves + n_merges), 2)
+        n_nodes = n_leaves + n_merges
+        graph = sp.csr_matrix((np.ones(2 * n_merges), (parents, children.ravel())), shape=(n_nodes, n_nodes))
+        _, node_labels = connected_components(graph, directed=False)
+        
+        labels = np.unique(node_labels[:n_leaves], return_inverse=True)[1].ravel()
+        return labels[tree['leaf_index']]
+
+    def _knn_graph(self, X: np.ndarray, n_neighbors: int, random_state: int = 0, n_jobs: int = -1) -> Any:
+        """Nearest neighbour connectivity graph in expression space.
+
+        Uses approximate nearest neighbours from Annoy, because exact search
+        scales with the square of the number of tiles. If Annoy is not 
+        installed, falls back to exact search with scikit-learn.
+        Args:
+            X (np.ndarray): Array with features of the tiles.
+            n_neighbors (int): Number of neighbours, excluding the tile itself.
+            random_state (int, optional): Random seed. Defaults to 0.
+            n_jobs (int, optional): Number of jobs. Defaults to -1.
+        Returns:
+            sp.csr_matrix: Connectivity matrix.
+        """
+        if AnnoyIndex == None:
+            return kneighbors_graph(X, n_neighbors, mode='connectivity', n_jobs=n_jobs)
+        
+        n = X.shape[0]
+        index = AnnoyIndex(X.shape[1], 'euclidean')
+        for i, x in enumerate(X):
+            index.add_item(i, x)
+        index.set_seed(random_state)
+        index.build(10, n_jobs=n_jobs)
+        
+        #The tile itself is normally the first hit
+        neighbours = [[j for j in index.get_nns_by_item(i, n_neighbors + 1) if j != i][:n_neighbors] for i in range(n)]
+        lengths = np.fromiter(map(len, neighbours), dtype=np.int64, count=n)
+        cols = np.fromiter(chain.from_iterable(neighbours), dtype=np.int64, count=lengths.sum())
+        rows = np.repeat(np.arange(n), lengths)
+        return sp.csr_matrix((np.ones(rows.shape[0]), (rows, cols)), shape=(n, n))
+
+    def _clust_louvain(self, X: np.ndarray, Kgraph: Any, resolution: float = 1.0, n_neighbors: int = 15, 
+                       random_state: int = 0, n_jobs: int = -1) -> np.ndarray:
+        """Louvain community detection on a spatial and expression graph.
+
+        Tiles are connected to their spatial neighbours and to their nearest
+        neighbours in expression space. Edges are weighted with a Gaussian 
+        kernel of the expression distance, so that spatial neighbours with a
+        different expression are only weakly connected. Uses the compiled
+        multilevel algorithm of igraph.
+        Args:
+            X (np.ndarray): Array with features of the tiles.
+            Kgraph (sp.csr_matrix): Spatial connectivity matrix or None.
+            resolution (float, optional): Louvain resolution. Defaults to 1.0.
+            n_neighbors (int, optional): Number of expression nearest 
+                neighbours. Defaults to 15.
+            random_state (int, optional): Random seed. Defaults to 0.
+            n_jobs (int, optional): Number of jobs. Defaults to -1.
+        Returns:
+            np.ndarray: Array with cluster labels.
+        """
+        if ig == None:
+            raise Exception('Louvain clustering requires "igraph", please install it with: pip install python-igraph')
+        n = X.shape[0]
+        graph = sp.csr_matrix((n, n))
+        if Kgraph is not None:
+            graph = graph + Kgraph
+        if n_neighbors > 0:
+            graph = graph + self._knn_graph(X, min(n_neighbors, n - 1), random_state=random_state, n_jobs=n_jobs)
+        if graph.nnz == 0:
+            raise Exception('No edges to cluster on, provide "neighbor_rings" or "n_neighbors" larger than 0.')
+        
+        #Weigh edges by the expression distance, only keep one direction
+        graph = sp.triu(graph + graph.T, k=1).tocoo()
+        dist = np.linalg.norm(X[graph.row] - X[graph.col], axis=1)
+        sigma = np.median(dist)
+        sigma = sigma if sigma > 0 else 1
+        weight = np.exp(-(dist ** 2) / (2 * sigma ** 2))
+        
+        G = ig.Graph(n=n, edges=list(zip(graph.row.tolist(), graph.col.tolist())), edge_attrs={'weight': weight})
+        #igraph draws from the random module, seed it without changing the global state
+        ig.set_random_number_generator(random.Random(random_state))
+        try:
+            membership = np.asarray(G.community_multilevel(weights='weight', resolution=resolution).membership)
+        finally:
+            ig.set_random_number_generator(random)
+        
+        #Largest community gets label 0
+        sizes = np.bincount(membership)
+        order = np.empty(sizes.shape[0], dtype=int)
+        order[np.argsort(-sizes, kind='stable')] = np.arange(sizes.shape[0])
+        return order[membership]
+
+    def _kmeans_fragments(self, X: np.ndarray, hex_coord: np.ndarray, Kgraph: Any, n_precluster: int = None, 
+                          random_state: int = 0) -> Tuple[np.ndarray, np.ndarray, Any]:
+        """KMeans pre-clustering into spatially connected fragments.
+
+        The tiles are first clustered with mini batch KMeans on the features
+        and the scaled coordinates, with centers seeded on a coarse hexagonal
+        grid like SLIC superpixels. KMeans clusters are then split into 
+        spatially connected fragments. The centroids of these fragments are
+        clustered with Ward linkage for "kmeans_ward". Ward is applied to the
+        centroids without weighing them by the number of tiles, so distance
+        thresholds are not identical to plain "ward".
+        Args:
+            X (np.ndarray): Array with features of the tiles.
+            hex_coord (np.ndarray): Array with XY coordinates of the tiles.
+            Kgraph (sp.csr_matrix): Spatial connectivity matrix or None.
+            n_precluster (int, optional): Approximate number of KMeans
+                clusters. If None, uses one per 100 tiles, with a minimum of
+                100. Defaults to None.
+            random_state (int, optional): Random seed. Defaults to 0.
+        Returns:
+            Tuple[np.ndarray, np.ndarray, sp.csr_matrix]: Fragment index of 
+                every tile, fragment centroids and the connectivity matrix
+                between fragments.
+        """
+        n = X.shape[0]
+        if n_precluster == None:
+            n_precluster = max(100, n // 100)
+        n_precluster = min(n_precluster, n)
+        
+        #Seed the KMeans centers on a coarse hexagonal grid over the tiles
+        area = np.ptp(hex_coord[:,0]) * np.ptp(hex_coord[:,1])
+        seed_spacing = max(np.sqrt(area / n_precluster), 1e-12)
+        seed_grid = hex_grid_make(seed_spacing, hex_coord[:,0].min(), hex_coord[:,0].max(), 
+                                  hex_coord[:,1].min(), hex_coord[:,1].max())
+        dist, seed_index = KDTree(hex_coord).query(hex_grid_coordinates(seed_grid), 
+                                                    distance_upper_bound=seed_spacing / 2)
+        seed_index = np.unique(seed_index[np.isfinite(dist)])
+        if seed_index.shape[0] < 2:
+            seed_index = np.random.default_rng(random_state).choice(n, n_precluster, replace=False)
+        
+        #Scale coordinates so that the seed spacing weighs as much as the 
+        #expression variation, which makes compact fragments
+        coord = (hex_coord - hex_coord.mean(axis=0)) * (np.sqrt(X.var(axis=0).sum()) / seed_spacing)
+        Xc = np.hstack([X, coord])
+        pre_labels = MiniBatchKMeans(n_clusters=seed_index.shape[0], init=Xc[seed_index], n_init=1,
+                                     random_state=random_state).fit_predict(Xc)
+        
+        #Split KMeans clusters into spatially connected fragments
+        if Kgraph is not None:
+            A = Kgraph.tocoo()
+            same = pre_labels[A.row] == pre_labels[A.col]
+            A_same = sp.csr_matrix((np.ones(same.sum()), (A.row[same], A.col[same])), shape=(n, n))
+            _, fragments = connected_components(A_same, directed=False)
+        else:
+            fragments = pre_labels
+        
+        fragments = np.unique(fragments, return_inverse=True)[1].ravel()
+        I, _ = label_indicator(fragments)
+        centroids = label_aggregate(X.T, fragments, func='mean').to_numpy().T
+        
+        #Fragments are connected if any of their tiles are
+        if Kgraph is not None:
+            connectivity = (I.T @ Kgraph @ I).tocsr()
+            connectivity.setdiag(0)
+            connectivity.eliminate_zeros()
+        else:
+            connectivity = None
+        
+        return fragments, centroids, connectivity
 
     def smooth_hex_labels(self, hex_coord: np.ndarray, labels: np.ndarray, neighbor_rings: int = 1, cycles: int = 1,
-                        return_all: bool = False, n_jobs: int = -1) -> Union[np.ndarray, list]:
+                        return_all: bool = False, n_jobs: int = -1, spacing: float = None) -> Union[np.ndarray, list]:
         """Smooth labels of a hexagonal tile matrix by neighbour majority vote.
         For each tile, the identity is set to the most predominant label in 
         its local environment, set by the neighbour radius.
@@ -498,37 +964,41 @@ class Regionalize(Iteration, Decomposition):
                 smoothing round as a list of arrays, including the original 
                 labels. If False, it just returns the last round. 
                 Defaults to False.
-            n_jobs (int, optional): Number of jobs to use for generating the 
-                neighbourhood graph. -1 means as many jobs as CPUs.
+            n_jobs (int, optional): Not used anymore, because the 
+                neighbourhood graph is derived from the grid. 
                 Defaults to -1.
+            spacing (float, optional): Distance between hexagon tile centers.
+                If None, it is derived from the coordinates. Defaults to None.
         Returns:
             [np.ndarray]: Numpy Array with the smoothed cluster labels. 
         """
-        def smooth(Kgraph, label):
-            """Smooth labels with neigbouring labels"""
-            new_label = []
-            for i, l in enumerate(label):
-                #Get labels of neigbours and select most predominant label(s).
-                neighbour_labels = label[Kgraph[i].indices]
-                values, counts = np.unique(neighbour_labels, return_counts=True)
-                predominant_label = values[counts == counts.max()]
-                #Check if there is a tie between neighbouring labels
-                if predominant_label.shape[0] > 1:
-                    #There is a tie, set to original label
-                    new_label.append(l)
-                else:
-                    #Set to new label
-                    new_label.append(predominant_label[0])        
-            return np.array(new_label)
+        def smooth(Kgraph, label_index, n_labels):
+            """Smooth labels with neigbouring labels.
+            
+            Counts the labels of the neighbours of all tiles at once by 
+            multiplying the neighbour graph with a one-hot encoding of the 
+            labels.
+            """
+            n = label_index.shape[0]
+            onehot = sp.csr_matrix((np.ones(n), (np.arange(n), label_index)), shape=(n, n_labels))
+            counts = (Kgraph @ onehot).tocsr()
+            #Select most predominant label(s)
+            row_max = counts.max(axis=1).toarray().ravel()
+            counts = counts.tocoo()
+            is_max = counts.data == row_max[counts.row]
+            n_max = np.bincount(counts.row[is_max], minlength=n)
+            predominant_label = np.zeros(n, dtype=label_index.dtype)
+            predominant_label[counts.row[is_max]] = counts.col[is_max]
+            #If there is a tie between neighbouring labels, set to original label
+            return np.where(n_max > 1, label_index, predominant_label)
         
-        #This should be radius_neighbours_graph because otherwise edge cases have weird neighbours
-
-        n_neighbors = 1 + (neighbor_rings * 6)
-        Kgraph = kneighbors_graph(hex_coord, n_neighbors, include_self=True, n_jobs=n_jobs)
+        Kgraph = self.hex_adjacency(hex_coord, spacing, neighbor_rings, include_self=True)
 
+        unique_labels, label_index = np.unique(labels, return_inverse=True)
         results = [labels]
         for iteration in range(cycles):
-            results.append(smooth(Kgraph, results[-1]))
+            label_index = smooth(Kgraph, label_index, unique_labels.shape[0])
+            results.append(unique_labels[label_index])
         
         if return_all:
             return results
@@ -541,21 +1011,12 @@ class Regionalize(Iteration, Decomposition):
             values for each unique label in labels.
         Args:
             df_hex (pd.DataFrame): Pandas DataFrame with samples in columns.
+                Can be dense or sparse.
             labels (np.ndarray): Numpy array with cluster labels
         Returns:
             [pd.DataFrame]: Pandas Dataframe with mean values for each label.
         """
-        unique_labels = np.unique(labels)
-        cluster_mean = pd.DataFrame(data=np.zeros((df_hex.shape[0], len(unique_labels))), index = df_hex.index,
-                                    columns=unique_labels)
-
-        #Loop over clusters
-        for l in unique_labels:
-            filt = labels == l
-            #Get mean expression of cluster
-            cluster_mean.loc[df_hex.index, l] = df_hex.loc[df_hex.index, filt].mean(axis=1)
-
-        return cluster_mean
+        return label_aggregate(df_hex, labels, func='mean')
 
     def cluster_sum_make(self, df_hex, labels: np.ndarray) -> Any: 
         """Calculate cluster sum.
@@ -563,21 +1024,12 @@ class Regionalize(Iteration, Decomposition):
         counts for each unique label in labels.
         Args:
             df_hex (pd.DataFrame): Pandas DataFrame with samples in columns.
+                Can be dense or sparse.
             labels (np.ndarray): Numpy array with cluster labels
         Returns:
             [pd.DataFrame]: Pandas Dataframe with sum values for each label.
         """
-        unique_labels = np.unique(labels)
-        cluster_sum = pd.DataFrame(data=np.zeros((df_hex.shape[0], len(unique_labels))), index = df_hex.index,
-                                    columns=unique_labels)
-
-        #Loop over clusters
-        for l in unique_labels:
-            filt = labels == l
-            #Get mean expression of cluster
-            cluster_sum.loc[:, l] = df_hex.loc[:, filt].sum(axis=1)
-
-        return cluster_sum
+        return label_aggregate(df_hex, labels, func='sum')
 
     def hex_neighbour_coord(self, x:float, y:float, s:float) -> np.ndarray:
         """Calculate cartesian coordinates of neighbour centroids.
@@ -686,8 +1138,7 @@ class Regionalize(Iteration, Decomposition):
             corner[angle] = c
 
         #Find neighbours
-        neighbour_radius = hexbin_spacing + (0.1 * hexbin_spacing)
-        Kgraph = radius_neighbors_graph(hex_coord, neighbour_radius, include_self=False)
+        Kgraph = self.hex_adjacency(hex_coord, hexbin_spacing, 1)
         
         #Iterate over all tiles
         for i, l in enumerate(labels):
@@ -729,6 +1180,32 @@ class Regionalize(Iteration, Decomposition):
 
         return boundary_points
 
+    def hex_region_rings(self, hex_coord: np.ndarray, hexbin_spacing: float, labels: np.ndarray, 
+                         decimals: int = 7) -> dict:
+        """Find ordered border coordinates of regions in a hexagonal grid.
+        
+        Vectorized replacement of `hex_region_boundaries()` followed by
+        `polygon_order_points()`. Works on the integer grid coordinates of the
+        tiles, so that all edges between tiles of different labels are found 
+        at once and chained into closed rings without a loop over the tiles.
+        Outer rings are counter clockwise and holes are clockwise. Assumes 
+        hexagonal grid with point up: ⬡
+        Args:
+            hex_coord (np.ndarray): Numpy Array with centroid coordinates as XY
+                columns for all tiles in a hexagonal grid. 
+            hexbin_spacing (float): Centroid spacing used to make the hexbin
+                plot.
+            labels (np.ndarray): Array with cluster labels for each tile
+            decimals (int): Number of decimals to round the points to.
+                Default suggestion: 7
+        Returns:
+            dict: Dictionary with for each label a list of closed polygons, 
+                meaning that the first and last point are identical. In the 
+                same format as the output of `polygon_order_points()`.
+        """
+        rings = hex_boundary_rings(hex_coord, hexbin_spacing, labels)
+        return {l: [r.round(decimals=decimals) for r in rings[l]] for l in rings}
+
     def polygon_order_points(self, boundary_points: dict) -> dict:
         """Order set of point for making polygons.
         This function makes a network out of a set of points, and uses this to 
@@ -797,6 +1274,60 @@ class Regionalize(Iteration, Decomposition):
     
         return results
         
+    def polygon_nesting(self, polygons: List[Any]) -> List[Any]:
+        """Resolve which polygons lie inside which and cut holes.
+        
+        The polygons are sorted by area, and each polygon is only tested 
+        against larger polygons whose bounding box contains its bounding box,
+        found with a spatial index. The smallest polygon that contains a 
+        polygon is its parent. Polygons at an even nesting depth are shells, 
+        polygons at an odd depth are holes in their parent. Islands inside
+        holes become new shells.
+        Args:
+            polygons (List[Any]): List of Shapely Polygons without holes.
+        Returns:
+            List[Any]: List of Shapely Polygons with holes.
+        """
+        n = len(polygons)
+        if n == 1:
+            return polygons
+        
+        areas = np.array([p.area for p in polygons])
+        bounds = np.array([p.bounds for p in polygons])
+        tree = STRtree(polygons)
+        geom_index = {id(p): i for i, p in enumerate(polygons)}
+        prepared = {}
+        
+        parent = np.full(n, -1)
+        depth = np.zeros(n, dtype=int)
+        #Largest first, so that the parents are resolved before their children
+        for i in np.argsort(-areas, kind='stable'):
+            candidates = tree.query(polygons[i])
+            #Shapely < 2.0 returns geometries instead of indices
+            if len(candidates) > 0 and not isinstance(candidates[0], (int, np.integer)):
+                candidates = [geom_index[id(c)] for c in candidates]
+            candidates = np.asarray(candidates, dtype=int)
+            #Keep larger polygons whose bounding box contains the polygon
+            b = bounds[i]
+            filt = ((areas[candidates] > areas[i]) & (bounds[candidates, 0] <= b[0]) & (bounds[candidates, 1] <= b[1]) & 
+                    (bounds[candidates, 2] >= b[2]) & (bounds[candidates, 3] >= b[3]))
+            candidates = candidates[filt]
+            #Test smallest candidate first
+            for j in candidates[np.argsort(areas[candidates], kind='stable')]:
+                if j not in prepared:
+                    prepared[j] = prep(polygons[j])
+                if prepared[j].contains(polygons[i]):
+                    parent[i] = j
+                    depth[i] = depth[j] + 1
+                    break
+        
+        #Make polygons with holes
+        holes = {i: [] for i in range(n)}
+        for i in np.nonzero(depth % 2 == 1)[0]:
+            holes[parent[i]].append(polygons[i].exterior.coords)
+        
+        return [Polygon(polygons[i].exterior.coords, holes[i]) for i in range(n) if depth[i] % 2 == 0]
+    
     def to_Shapely_polygons(self, ordered_points: dict) -> dict:
         """Make Shapely polygons out of a set of ordered points.
         Converts orderd points to polygons, and makes complex polygons 
@@ -809,41 +1340,16 @@ class Regionalize(Iteration, Decomposition):
             dict: Dictionary with for every label a Shapely Polygon, or a 
                 MultiPolygon if the region consists of multiple polygons.
         """
-        #datasets = list(ordered_points.keys())
         results = {}
 
         #Loop over labels
         for l in ordered_points.keys():
-            polygons = []
-            clean_polygons = []
             #Loop over point sets and make polygons
-            for circle in ordered_points[l]:
-                polygons.append(Polygon(circle))         
+            polygons = [Polygon(circle) for circle in ordered_points[l]]
             
             #Check if a polygon contains another polygon
             if len(polygons) > 1:
-            
-                r_polygons = range(len(polygons))    
-                intersections = {i:[] for i in r_polygons}
-                interior = []
-                for i,j in permutations(r_polygons, 2):
-                    if polygons[i].contains(polygons[j]):
-                        intersections[i].append(j)
-                        interior.append(j)
-
-                #Clean the polygons by making holes for the interior polygons
-                for i in r_polygons:
-                    inside = intersections[i]
-                    if inside != []:
-                        for j in inside:
-                            intersect = unary_union(polygons[i].intersection(polygons[j]))
-                            polygons[i] = unary_union(polygons[i].difference(intersect))
-                        clean_polygons.append(polygons[i])
-                    elif i not in interior:
-                        clean_polygons.append(polygons[i])
-                    else:
-                        pass
-                    
+                clean_polygons = self.polygon_nesting(polygons)
                 if len(clean_polygons) > 1:
                     clean_polygons = MultiPolygon(clean_polygons)
                 else:
@@ -929,13 +1435,44 @@ class Regionalize(Iteration, Decomposition):
         filt_y = np.logical_and(points[:,1]>=bbox[0][1], points[:,1]<=bbox[1][1])
         return np.logical_and(filt_x, filt_y)
 
-    def point_in_region(self, polygon_points: dict, normalize: bool = True, normalize_unit: str = 'millimeter') -> Any:
+    def _hex_tile_lookup(self, hex_coord: np.ndarray, spacing: float) -> Tuple[dict, np.ndarray]:
+        """Get the hexagonal grid of tiles and the position of each grid tile.
+
+        If the tiles were made by the last `hexbin_make()` call, its grid is
+        used so that points are assigned exactly as during binning. 
+        Otherwise the grid is derived from the tile coordinates.
+        Args:
+            hex_coord (np.ndarray): XY coordinates of the hexagonal tiles.
+            spacing (float): Spacing of the hexagonal tiles.
+        Returns:
+            Tuple[dict, np.ndarray]: Grid definition and array with for every
+                tile of the grid the index in "hex_coord", or -1.
+        """
+        grid = getattr(self, 'hexbin_grid', None)
+        tile_index = getattr(self, 'hexbin_tile_index', None)
+        if grid is not None and tile_index is not None and grid['spacing'] == spacing \
+           and tile_index.shape[0] == hex_coord.shape[0] \
+           and np.allclose(hex_grid_coordinates(grid)[tile_index], hex_coord):
+            tile_lookup = np.full(grid['n_cols'] * grid['n_rows'], -1, dtype=np.int64)
+            tile_lookup[tile_index] = np.arange(tile_index.shape[0])
+            return grid, tile_lookup
+        return hex_grid_from_coordinates(hex_coord, spacing)
+
+    def point_in_region(self, polygon_points: dict, normalize: bool = True, normalize_unit: str = 'millimeter',
+                        hex_coord: np.ndarray = None, spacing: float = None, labels: np.ndarray = None, 
+                        cell_size: float = None) -> Any:
         """Make GeoPandas Dataframe of region and count points inside.
         Takes a dictionary of (Multi-)polygons and converts these to Shapely
         (Mulit-)Polygons. Then it takes the point data and counts the points
         that fall inside each region. The results are stored as GeoPandas 
         geoDataFrame, that contains the counts for all genes in each region.
         Optionally normalizes for area. 
+
+        If the regions are made of hexagonal tiles, give the "hex_coord" and
+        "labels" of the tiles. Each point is then assigned to its tile 
+        directly, and gets the label of that tile. Otherwise, points are
+        assigned using a grid index of the polygons, so that only points near
+        polygon edges need a point in polygon test.
         Args:
             polygon_points (dict): Dictionary with keys for each label and a 
                 list of orderd points for each polygon.
@@ -944,6 +1481,15 @@ class Regionalize(Iteration, Decomposition):
             normalize_unit (str, optional): Unit of the normalization. Defaluts
                 to "milimeter", which means that data will be normalized by 
                 square milimeter. 
+            hex_coord (np.ndarray, optional): XY coordinates of the hexagonal
+                tiles that make up the regions. Defaults to None.
+            spacing (float, optional): Spacing of the hexagonal tiles. If None
+                it is derived from "hex_coord". Defaults to None.
+            labels (np.ndarray, optional): Region label of each tile.
+                Defaults to None.
+            cell_size (float, optional): Cell size of the grid index for
+                polygons. If None, the larger side of the extent is divided
+                in 500 cells. Defaults to None.
         Returns:
             [gp.GeoDataFrame]: geoDataFrame with (normalized) counts for each
             gene in each region. Every region has a Shapely (Multi-)Polygon in
@@ -952,17 +1498,31 @@ class Regionalize(Iteration, Decomposition):
         #Make base geopandas dataframe
         polygons = self.to_Shapely_polygons(polygon_points)
         gs = self.geoSeries_make(polygons)
-        labels = list(polygon_points.keys())
-        gdf = self.geoDataFrame_make(data=np.zeros((len(labels), len(self.unique_genes)), dtype='int64'), index=labels, 
-                                            columns=self.unique_genes,  geometry=gs)
+        region_labels = list(polygon_points.keys())
 
-        #Recount which points fall in which (multi-)polygon
-        df = pd.DataFrame(data = self.df.g, columns = ['gene'])
-        points = self.df.loc[:, ['x', 'y']].compute().to_numpy() #Loading all points in RAM
-        for l, filt in inside_multi_polygons(polygon_points, points): 
-            #get the sum of every gene and asign to gene count for that area. 
-            gdf.loc[l, self.unique_genes] = df[filt].groupby('gene').size() 
-        del points
+        #Function to find the region of points
+        if hex_coord is not None and labels is not None:
+            if spacing == None:
+                spacing = hex_spacing_infer(hex_coord)
+            grid, tile_lookup = self._hex_tile_lookup(hex_coord, spacing)
+            tile_region = pd.Index(region_labels).get_indexer(np.asarray(labels))
+            grid_region = np.where(tile_lookup >= 0, tile_region[tile_lookup], -1)
+            
+            def assign(points):
+                tile = hex_assign(points[:,0], points[:,1], grid)
+                return np.where(tile >= 0, grid_region[tile], -1)
+        else:
+            index = polygon_grid_index(polygon_points, cell_size)
+            
+            def assign(points):
+                return polygon_grid_assign(polygon_points, points, index)
+
+        #Count the points of each gene in every region
+        counts = np.zeros((len(region_labels), len(self.unique_genes)), dtype='int64')
+        for i, g in enumerate(self.unique_genes):
+            region = assign(self.get_gene(g).to_numpy())
+            counts[:, i] = np.bincount(region[region >= 0], minlength=len(region_labels))
+        gdf = self.geoDataFrame_make(data=counts, index=region_labels, columns=self.unique_genes, geometry=gs)
 
         #Normalize data    
         if normalize:
@@ -988,6 +1548,8 @@ class Regionalize(Iteration, Decomposition):
                         smooth_cycles: int = 1,
                         post_merge: bool = False,
                         post_merge_t: float = 0.05,
+                        clust_method: str = 'ward',
+                        clust_resolution: float = 1.0,
                         order_labels: bool = True,
                         n_jobs=-1) -> Union[Any, np.ndarray, np.ndarray, Any]:
         """Regionalize dataset.
@@ -1014,7 +1576,8 @@ class Regionalize(Iteration, Decomposition):
                 respectively. Also possible to not normalize, in which case the
                 input should be None. Usefull for LDA. Defaults to 'APR'.
             dimensionality_reduction (str, optional): Method for dimentionality
-                reduction. Implmented PCA, LDA. Defaults to 'PCA'.
+                reduction. Implmented PCA, LDA, NMF. LDA and NMF need
+                non-negative data. Defaults to 'PCA'.
             n_components (list, optional): Components to use for clustering.
                 In some cases the PCA component 0 signifies to total expression
                 which should be excluded for clustering. Defaults to [0, 100].
@@ -1035,10 +1598,16 @@ class Regionalize(Iteration, Decomposition):
                 18 neigbors, etc. Defaults to 1.
             smooth_cycles (int, optional): Number of smoothing cycles.
                 Defaults to 1.
-                
-                
-                
-                
+            post_merge (bool, optional): If True merges clusters with a
+                correlation distance below "post_merge_t". Defaults to False.
+            post_merge_t (float, optional): Correlation distance threshold 
+                for post merging. Defaults to 0.05.
+            clust_method (str, optional): Clustering method, choose from 
+                "ward", "louvain" or "kmeans_ward". "louvain" and 
+                "kmeans_ward" scale to large numbers of tiles. See 
+                `clust_hex_connected()`. Defaults to 'ward'.
+            clust_resolution (float, optional): Resolution for "louvain"
+                clustering. Higher values give more clusters. Defaults to 1.0.
             order_labels (bool, optional): If True orders the cluster labels
                 based on similarity. Defaults to True.
             n_jobs (int, optional): Number op processes. If -1 uses the max 
@@ -1052,6 +1621,109 @@ class Regionalize(Iteration, Decomposition):
                 - df_mean: Dataframe with mean count per region.
                 - df_norm: Dataframe with mean normalized count per region.
         """
+        #Bin, normalize and reduce dimensions
+        df_hex, hex_coord, df_hex_norm, dr = self._regionalize_pre(spacing, min_count, feature_selection, 
+                                                                   normalization_mode, dimensionality_reduction,
+                                                                   n_components, n_jobs)
+            
+        #Cluster dataset
+        labels = self.clust_hex_connected(dr[:, n_components[0] : n_components[1]], hex_coord, 
+                                          spacing = spacing,
+                                          distance_threshold=clust_dist_threshold,
+                                          n_clusters = n_clusters,
+                                          neighbor_rings=clust_neighbor_rings, n_jobs=n_jobs,
+                                          method=clust_method, resolution=clust_resolution)
+        
+        #Smooth, merge and order labels
+        labels, df_mean, df_norm = self._regionalize_post(df_hex, df_hex_norm, hex_coord, labels, spacing, smooth, 
+                                                          smooth_neighbor_rings, smooth_cycles, post_merge, 
+                                                          post_merge_t, order_labels, n_jobs)
+        
+        return df_hex, labels, hex_coord, df_mean, df_norm
+
+    def regionalize_sweep(self, spacing: float, 
+                              min_count: int,
+                              clust_dist_thresholds: list = None,
+                              n_clusters: list = None,
+                              feature_selection: np.ndarray = None,
+                              normalization_mode: str = 'APR',
+                              dimensionality_reduction: str = 'PCA', 
+                              n_components: list = [0,100],
+                              clust_neighbor_rings: int = 1,
+                              clust_method: str = 'ward',
+                              smooth: bool = False,
+                              smooth_neighbor_rings: int = 1, 
+                              smooth_cycles: int = 1,
+                              post_merge: bool = False,
+                              post_merge_t: float = 0.05,
+                              order_labels: bool = True,
+                              n_jobs=-1) -> dict:
+        """Regionalize dataset for multiple clustering thresholds.
+
+        Binning, normalization, dimensionality reduction and fitting the Ward
+        merge tree are done once. The tree is then cut for each distance
+        threshold or number of clusters, and smoothing, post merging and 
+        ordering are applied to each cut. Every cut gives the same result as
+        `regionalize()` with that threshold.
+        Args:
+            spacing (float): distance between tile centers, in same units as 
+                the data. The function makes hexagons with the point up: ⬡
+            min_count (int):  Minimal number of molecules in a tile to keep the 
+                tile in the dataset.
+            clust_dist_thresholds (list, optional): List of distance 
+                thresholds. Defaults to None.
+            n_clusters (list, optional): List of numbers of clusters. Either 
+                this or clust_dist_thresholds should be provided. 
+                Defaults to None.
+            Other arguments: See `regionalize()`. Only "ward" and 
+                "kmeans_ward" are possible for "clust_method".
+        Returns:
+            dict: Dictionary containing:
+                - df_hex: Dataframe with counts for each hexagonal tile.
+                - hex_coord: XY coordinates for each hexagonal tile.
+                - tree: Merge tree that can be cut with `clust_tree_cut()`.
+                - cuts: Dictionary with the threshold or number of clusters
+                    as keys and a dictionary with the "labels", "df_mean" and
+                    "df_norm" for that cut as values.
+        """
+        #Input check
+        if (clust_dist_thresholds is None) == (n_clusters is None):
+            raise Exception('One of "clust_dist_thresholds" or "n_clusters" should be defined.')
+        
+        #Bin, normalize and reduce dimensions
+        df_hex, hex_coord, df_hex_norm, dr = self._regionalize_pre(spacing, min_count, feature_selection, 
+                                                                   normalization_mode, dimensionality_reduction,
+                                                                   n_components, n_jobs)
+        
+        #Fit merge tree once
+        tree = self.clust_hex_tree(dr[:, n_components[0] : n_components[1]], hex_coord, spacing, 
+                                   neighbor_rings=clust_neighbor_rings, method=clust_method)
+        
+        #Cut tree
+        cuts = {}
+        for value in (clust_dist_thresholds if clust_dist_thresholds is not None else n_clusters):
+            if clust_dist_thresholds is not None:
+                labels = self.clust_tree_cut(tree, distance_threshold=value)
+            else:
+                labels = self.clust_tree_cut(tree, n_clusters=value)
+            labels, df_mean, df_norm = self._regionalize_post(df_hex, df_hex_norm, hex_coord, labels, spacing, smooth, 
+                                                              smooth_neighbor_rings, smooth_cycles, post_merge, 
+                                                              post_merge_t, order_labels, n_jobs)
+            cuts[value] = {'labels': labels, 'df_mean': df_mean, 'df_norm': df_norm}
+        
+        return {'df_hex': df_hex, 'hex_coord': hex_coord, 'tree': tree, 'cuts': cuts}
+
+    def _regionalize_pre(self, spacing: float, min_count: int, feature_selection: np.ndarray = None, 
+                         normalization_mode: str = 'APR', dimensionality_reduction: str = 'PCA', 
+                         n_components: list = [0,100], n_jobs: int = -1) -> Tuple[Any, np.ndarray, Any, np.ndarray]:
+        """Binning, normalization and dimensionality reduction for regionalization.
+        Args:
+            See `regionalize()`.
+        Returns:
+            Tuple[pd.DataFrame, np.ndarray, pd.DataFrame, np.ndarray]: 
+                Dataframe with counts per tile, tile coordinates, normalized
+                counts and the dimensionality reduction.
+        """
         #Bin the data with a hexagonal grid
         df_hex, hex_coord = self.hexbin_make(spacing, min_count, feature_selection=feature_selection, n_jobs=n_jobs)
         
@@ -1061,21 +1733,36 @@ class Regionalize(Iteration, Decomposition):
         #Dimensionality reduction
         if dimensionality_reduction.lower() == 'pca':
             #Calculate PCA
-            dr = self.PCA(df_hex_norm.T)
+            dr = self.PCA(df_hex_norm.T, n_components=n_components[1])
         elif dimensionality_reduction.lower() == 'lda':
             #Calculate Latent Dirichlet Allocation
-            dr = self.LDA(df_hex_norm.T, n_components=n_components, n_jobs=n_jobs)
-            
-        #Cluster dataset
-        labels = self.clust_hex_connected(dr[:, n_components[0] : n_components[1]], hex_coord, 
-                                          spacing = spacing,
-                                          distance_threshold=clust_dist_threshold,
-                                          n_clusters = n_clusters,
-                                          neighbor_rings=clust_neighbor_rings, n_jobs=n_jobs)
+            dr = self.LDA(df_hex_norm, n_components=n_components[1], n_jobs=n_jobs, learning_method='online')
+        elif dimensionality_reduction.lower() == 'nmf':
+            #Calculate Non-negative Matrix Factorization
+            dr = self.NMF(df_hex_norm, n_components=n_components[1])
+        else:
+            raise Exception(f'Dimensionality reduction "{dimensionality_reduction}" not implemented, choose from "PCA", "LDA" or "NMF".')
         
+        return df_hex, hex_coord, df_hex_norm, dr
+
+    def _regionalize_post(self, df_hex: Any, df_hex_norm: Any, hex_coord: np.ndarray, labels: np.ndarray, 
+                          spacing: float, smooth: bool = False, smooth_neighbor_rings: int = 1, 
+                          smooth_cycles: int = 1, post_merge: bool = False, post_merge_t: float = 0.05, 
+                          order_labels: bool = True, n_jobs: int = -1) -> Tuple[np.ndarray, Any, Any]:
+        """Smoothing, post merging and ordering of cluster labels.
+        Args:
+            df_hex (pd.DataFrame): Dataframe with counts for each tile.
+            df_hex_norm (pd.DataFrame): Dataframe with normalized counts.
+            hex_coord (np.ndarray): XY coordinates for each tile.
+            labels (np.ndarray): Cluster labels for each tile.
+            Other arguments: See `regionalize()`.
+        Returns:
+            Tuple[np.ndarray, pd.DataFrame, pd.DataFrame]: Labels, mean count
+                per region and mean normalized count per region.
+        """
         #Spatially smooth cluster labels
         if smooth:
-            labels = self.smooth_hex_labels(hex_coord, labels, smooth_neighbor_rings, smooth_cycles, n_jobs=n_jobs)
+            labels = self.smooth_hex_labels(hex_coord, labels, smooth_neighbor_rings, smooth_cycles, spacing=spacing)
         
         #make mean expression
         df_mean = self.cluster_mean_make(df_hex, labels)
@@ -1085,25 +1772,25 @@ class Regionalize(Iteration, Decomposition):
         if post_merge:
             Z = linkage(df_mean.T, metric='correlation')
             labels_post_merge = fcluster(Z, post_merge_t, criterion='distance')
-            label_conversion = dict(zip(df_mean.columns, labels_post_merge))
-            labels = np.array([label_conversion[i] for i in labels])
+            labels = labels_post_merge[np.searchsorted(df_mean.columns.to_numpy(), labels)]
             #Remake mean expression dataframe
             df_mean = self.cluster_mean_make(df_hex, labels)
             df_norm = self.cluster_mean_make(df_hex_norm, labels)
         
         #Order cluster labels
         if order_labels:
-            manifold = SpectralEmbedding(n_components=1, n_jobs=n_jobs).fit_transform(df_mean.T)
+            #Fixed seed so that the same regions always get the same labels
+            manifold = SpectralEmbedding(n_components=1, n_jobs=n_jobs, random_state=0).fit_transform(df_mean.T)
             even_spaced = np.arange(manifold.shape[0])
             even_spaced_dict = dict(zip(np.sort(manifold.ravel()), even_spaced))
             manifold_even = np.array([even_spaced_dict[i] for i in manifold.ravel()])
             manifold_even_dict = dict(zip(df_mean.columns, manifold_even))
-            labels = np.array([manifold_even_dict[i] for i in labels])
+            labels = manifold_even[np.searchsorted(df_mean.columns.to_numpy(), labels)]
             #labels = (labels * manifold.shape[0]).astype('int')
             df_mean.rename(columns=manifold_even_dict, inplace=True)
             df_norm.rename(columns=manifold_even_dict, inplace=True)
         
-        return df_hex, labels, hex_coord, df_mean, df_norm
+        return labels, df_mean, df_norm
 
     def geopandas_make(self, spacing: float, 
                             df_hex: Any,
@@ -1126,11 +1813,10 @@ class Regionalize(Iteration, Decomposition):
             labels: (np.ndarray): Cluster labels matching the number of tiles.
             hex_coord (np.ndarray): Array with XY coordinates of the hexagonal
                 tiles.
-            boundary_decimals (int, optional): Due to inaccuracies in the 
-                original hexagon tile  generation and rounding errors, the 
-                points need to be rounded to return all unique points. If you 
-                experience errors with the  generation of polygons downstream, 
-                lower the number of decimals. Defaults to 7.
+            boundary_decimals (int, optional): Number of decimals to round 
+                the polygon points to. If you experience errors with the 
+                generation of polygons downstream, lower the number of 
+                decimals. Defaults to 7.
             smooth_polygon (bool, optional): Whether or not smooting of the 
                 polygons is performed. Advised not to smooth, because smoothing
                 has little effect and can cause holes inbetween polygons where
@@ -1149,11 +1835,8 @@ class Regionalize(Iteration, Decomposition):
         Retruns:
             [None]: Data saved as self.regions. 
         """
-        #Get boundary points of regions
-        boundary_points = self.hex_region_boundaries(hex_coord, self.hexbin_hexagon_shape, spacing, labels, decimals = boundary_decimals)
-        
-        #Order boundary point for making polygons
-        ordered_points = self.polygon_order_points(boundary_points)
+        #Get ordered boundary points of regions
+        ordered_points = self.hex_region_rings(hex_coord, spacing, labels, decimals = boundary_decimals)
         
         #Smooth boundary points
         if smooth_polygon == True:
@@ -1164,7 +1847,11 @@ class Regionalize(Iteration, Decomposition):
         
         #Recount points in polygons and make geoDataFrame
         if recount == True:
-            gdf = self.point_in_region(ordered_points, normalize=area_normalize, normalize_unit=area_normalize_unit)
+            if smooth_polygon:
+                gdf = self.point_in_region(ordered_points, normalize=area_normalize, normalize_unit=area_normalize_unit)
+            else:
+                gdf = self.point_in_region(ordered_points, normalize=area_normalize, normalize_unit=area_normalize_unit,
+                                           hex_coord=hex_coord, spacing=spacing, labels=labels)
             return gdf
         
         #make geoDataFrame with region data
@@ -246,4 +246,105 @@ def inside_multi_polygons(polygon_points: dict, points: np.ndarray) -> Generator
             #which has a 3rd polygon inside, that contains the point.
             point_inside[filt] = np.logical_xor(point_inside[filt], is_inside)
 
-        yield l, point_inside
\ No newline at end of file
+        yield l, point_inside
+
+def polygon_grid_index(polygon_points: dict, cell_size: float = None) -> dict:
+    """Make a square grid index of multi-polygons for fast point assignment.
+
+    Cells that are crossed by a polygon edge are marked as boundary cells.
+    All other cells lie completely inside one region or outside all regions,
+    so points in these cells get the region of the cell center. Only points
+    in boundary cells need an exact point in polygon test.
+
+    Args:
+        polygon_points (dict): Dictionary with labels of each (multi-) 
+            polygon and a list of (sub-)polygon(s) as numpy arrays. Polygon 
+            needs to be closed, meaning that the first and last point are 
+            identical.
+        cell_size (float, optional): Width of the grid cells. If None, the 
+            larger side of the extent is divided in 500 cells. 
+            Defaults to None.
+
+    Returns:
+        dict: Grid index with the origin "x0" and "y0", the "cell_size", the
+            number of cells "n_x" and "n_y", the "labels" of the regions and
+            "cell_region" with for every cell the index of the region in 
+            "labels", -1 outside all regions or -2 for boundary cells.
+    """
+    labels = list(polygon_points.keys())
+    all_points = np.vstack([p for l in labels for p in polygon_points[l]])
+    x0, y0 = all_points.min(axis=0)
+    x1, y1 = all_points.max(axis=0)
+    if cell_size == None:
+        cell_size = max(x1 - x0, y1 - y0) / 500
+    n_x = int((x1 - x0) // cell_size) + 1
+    n_y = int((y1 - y0) // cell_size) + 1
+
+    #Classify cell centers
+    cx, cy = np.meshgrid(x0 + (np.arange(n_x) + 0.5) * cell_size, y0 + (np.arange(n_y) + 0.5) * cell_size)
+    centers = np.column_stack([cx.ravel(), cy.ravel()])
+    cell_region = np.full(n_x * n_y, -1, dtype=np.int64)
+    for i, (l, filt) in enumerate(inside_multi_polygons(polygon_points, centers)):
+        cell_region[filt] = i
+
+    #Mark cells crossed by edges. Edges are sampled at half a cell size, so a
+    #sample lies in, or next to, every cell that the edge crosses.
+    boundary = np.zeros((n_y, n_x), dtype=bool)
+    for l in labels:
+        for p in polygon_points[l]:
+            start, stop = p[:-1], p[1:]
+            n_samples = np.ceil(np.linalg.norm(stop - start, axis=1) / (0.5 * cell_size)).astype(np.int64) + 2
+            edge = np.repeat(np.arange(start.shape[0]), n_samples)
+            #Position of each sample along its edge, from 0 to 1
+            first = np.repeat(np.cumsum(n_samples) - n_samples, n_samples)
+            t = (np.arange(edge.shape[0]) - first) / (n_samples[edge] - 1)
+            samples = start[edge] + (stop[edge] - start[edge]) * t[:, None]
+            ix = np.clip(((samples[:, 0] - x0) // cell_size).astype(np.int64), 0, n_x - 1)
+            iy = np.clip(((samples[:, 1] - y0) // cell_size).astype(np.int64), 0, n_y - 1)
+            boundary[iy, ix] = True
+    #Include the neighbours of marked cells
+    dilated = boundary.copy()
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            dilated[max(dy, 0):n_y + min(dy, 0), max(dx, 0):n_x + min(dx, 0)] |= \
+                boundary[max(-dy, 0):n_y + min(-dy, 0), max(-dx, 0):n_x + min(-dx, 0)]
+    cell_region[dilated.ravel()] = -2
+
+    return {'x0': x0, 'y0': y0, 'cell_size': cell_size, 'n_x': n_x, 'n_y': n_y, 'labels': labels,
+            'cell_region': cell_region}
+
+def polygon_grid_assign(polygon_points: dict, points: np.ndarray, index: dict = None) -> np.ndarray:
+    """Find the region of each point using a grid index.
+
+    Args:
+        polygon_points (dict): Dictionary with labels of each (multi-) 
+            polygon and a list of (sub-)polygon(s) as numpy arrays. Polygon 
+            needs to be closed, meaning that the first and last point are 
+            identical.
+        points (np.ndarray): Array with X and Y coordinates of the points
+                as columns
+        index (dict, optional): Grid index made by `polygon_grid_index()`.
+            If None, it is made with the default cell size. Defaults to None.
+
+    Returns:
+        np.ndarray: Index of the region in `index['labels']` for each point,
+            or -1 if the point is outside all regions.
+    """
+    if index == None:
+        index = polygon_grid_index(polygon_points)
+    cell_size = index['cell_size']
+    ix = np.floor((points[:, 0] - index['x0']) / cell_size).astype(np.int64)
+    iy = np.floor((points[:, 1] - index['y0']) / cell_size).astype(np.int64)
+    in_grid = (ix >= 0) & (ix < index['n_x']) & (iy >= 0) & (iy < index['n_y'])
+
+    region = np.full(points.shape[0], -1, dtype=np.int64)
+    region[in_grid] = index['cell_region'][iy[in_grid] * index['n_x'] + ix[in_grid]]
+
+    #Exact test for points in boundary cells
+    boundary = np.where(region == -2)[0]
+    region[boundary] = -1
+    if boundary.shape[0] > 0:
+        for i, (l, filt) in enumerate(inside_multi_polygons(polygon_points, points[boundary])):
+            region[boundary[filt]] = i
+
+    return region
@@ -1,674 +1,200 @@
-import gc
-import glob
-import math
-from itertools import combinations, permutations
-from multiprocessing import cpu_count
-import geopandas as gp
-import matplotlib.pyplot as plt
-import networkx as nx
 import numpy as np
-import pandas as pd
-import psutil
-from joblib import Parallel, delayed
-from matplotlib.pyplot import axes, hexbin, xcorr
-from shapely.geometry import MultiLineString, MultiPolygon, Polygon
-from shapely.ops import unary_union
-from skimage.measure import subdivide_polygon
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.neighbors import kneighbors_graph, radius_neighbors_graph
-from numba import jit, njit
-import numba
-from pint import UnitRegistry
-#Mypy types
-
-class 3D_regionalize:
-
-    def merge_norm(hex_bin, normalizer=None):
-        """
-        Merge multiple datasets and optonally normalize the data.
-        Input:
-        `hex_bin`(dict): Dictonray with hex bin results for every dataset.
-            Output form the hex_bin.make_hexbin() function.
-        `normalizer`(func): Function that can normalize the data.
-            For example: "lambda x: np.log(x + 1)" for log normalization.
-            Carfull, this normalizaiton will be applied on each dataset
-            individually first, and then merged in one large dataset. 
-        Returns:
-        `df`(pd.Dataframe): Dataframe with all tiles in one table. Optionally
-            with normalization applied
-        `samples`(np.array): Array with original dataset names.
-        
-        """
-        nrows = math.ceil(len(hex_bin.keys())/2)
-        fig, axes = plt.subplots(ncols=2, nrows=nrows, figsize=(10,1.5*nrows), sharey=True, sharex=True)
-        
-        norm = normalizer != None
-        
-        for i, d in enumerate(list(hex_bin.keys())):
-            print(f'Merging datasets. Processing sample: {i}                    ', end='\r')
-            if i == 0:
-                df_next = hex_bin[d]['df']
-                df_all = df_next
-                samples = [d for i in df_all.columns]
-                if norm:
-                    df_next_norm = normalizer(df_next)
-                    df_norm = df_next_norm
-                
-            else:
-                df_next = hex_bin[d]['df']
-                df_all = pd.concat([df_all, df_next], axis=1, sort=False)
-                for j in df_next.columns:
-                    samples.append(d)
-                if norm:
-                    df_next_norm = normalizer(df_next)
-                    df_norm = pd.concat([df_norm, df_next_norm], axis=1, sort=False)
-                
-            
-            ax = axes[int(i/2), i%2]
-            if norm:
-                ax.hist(df_next_norm.sum(), bins=100)
-                ax.set_title(f'{d} normalized')
-            else:
-                ax.hist(df_next.sum(), bins=100)
-                ax.set_title(d)
-            ax.set_ylabel('Frequency')
-            ax.set_xlabel('Sum molecule count')
-        plt.tight_layout()
-        
-        if norm:
-            return df_norm, np.array(samples)
-        else:
-            return df_all, np.array(samples)
-
-    def make_hexbin_serial(spacing, spots, min_count):
-        """
-        Serial wrapper around make_hexbin()
-        
-        Use when running out of memory with the parallel function.
-        
-        Input:
-        `spacing`(int): distance between tile centers, in same units as the data. 
-            The actual spacing will have a verry small deviation (tipically lower 
-            than 2e-9%) in the y axis, due to the matplotlib hexbin function.
-            The function makes hexagons with the point up: ⬡
-        `spots`(dictionary): Dictionary with for each dataset aDataFrame with 
-            columns ['x', 'y', 'gene'] for the x and y coordinates and the gene 
-            labels respectively.
-        `min_count`(int): Minimal number of molecules in a tile to keep the tile in 
-            the dataset. The algorithm will generate a lot of empty 
-            tiles, which are later discarded using the min_count threshold.
-            Suggested to be at least 1.
-        
-        Output:
-        Dictionary with the following items:
-        `gene` --> Dictionary with tile counts for each gene.
-        `hexbin` --> matplotlib PolyCollection for hex bins.
-        `coordinates` --> XY coordinates for all tiles.
-        `coordinates_filt` --> XY coordinates for all tiles that have
-            enough counts according to "min_count"
-        `df` --> Pandas dataframe with counts for all genes in all 
-            valid tiles.
-        `spacing` --> Chosen spacing. Keep in mind that the distance between tile
-            centers in different rows might deviate slightly. 
-        
-        """
-        dataset_keys = list(spots.keys())
-        results={}    
-        
-        
-        spacing_list = [spacing for i in dataset_keys]
-        datasets = [spots[k] for k in dataset_keys]
-        min_count_list = [min_count for i in dataset_keys]
-        
-        for d in dataset_keys:
-            results[d] = make_hexbin(spacing, spots[d], min_count)
-
-        return results
-
-
-    def make_hexbin_parallel(spacing, spots, min_count, n_jobs=None):
-        """
-        Parallel wrapper around make_hexbin()
-        
-        Can consume 
-        
-        Input:
-        `spacing`(int): distance between tile centers, in same units as the data. 
-            The actual spacing will have a verry small deviation (tipically lower 
-            than 2e-9%) in the y axis, due to the matplotlib hexbin function.
-            The function makes hexagons with the point up: ⬡
-        `spots`(dictionary): Dictionary with for each dataset aDataFrame with 
-            columns ['x', 'y', 'gene'] for the x and y coordinates and the gene 
-            labels respectively.
-        `min_count`(int): Minimal number of molecules in a tile to keep the tile in 
-            the dataset. The algorithm will generate a lot of empty 
-            tiles, which are later discarded using the min_count threshold.
-            Suggested to be at least 1.
-        
-        Output:
-        Dictionary with the following items:
-        `gene` --> Dictionary with tile counts for each gene.
-        `hexbin` --> matplotlib PolyCollection for hex bins.
-        `coordinates` --> XY coordinates for all tiles.
-        `coordinates_filt` --> XY coordinates for all tiles that have
-            enough counts according to "min_count"
-        `df` --> Pandas dataframe with counts for all genes in all 
-            valid tiles.
-        `spacing` --> Chosen spacing. Keep in mind that the distance between tile
-            centers in different rows might deviate slightly. 
-        
-        """
-        dataset_keys = list(spots.keys())
-        spacing_list = [spacing for i in dataset_keys]
-        datasets = [spots[k] for k in dataset_keys]
-        min_count_list = [min_count for i in dataset_keys]
-
-        #Paralel execution for all datasets
-        with Pool(processes=n_jobs) as pool:
-            result = pool.starmap(make_hexbin, zip(spacing_list, datasets, min_count_list), 1)
-            
-        pooled_results = {k:v for k,v in zip(dataset_keys, result)}
-
-        return pooled_results
-
-    def make_hexbin_joblib(spacing, spots, min_count, unique_genes, n_jobs=None):
-        """
-        Parallel wrapper around make_hexbin()
-        
-        Can consume quite some memory. If this is a problem use the serial 
-        function.
-        
-        Input:
-        `spacing`(int): distance between tile centers, in same units as the data. 
-            The actual spacing will have a verry small deviation (tipically lower 
-            than 2e-9%) in the y axis, due to the matplotlib hexbin function.
-            The function makes hexagons with the point up: ⬡
-        `spots`(dictionary): Dictionary with for each dataset aDataFrame with 
-            columns ['x', 'y', 'gene'] for the x and y coordinates and the gene 
-            labels respectively.
-        `min_count`(int): Minimal number of molecules in a tile to keep the tile in 
-            the dataset. The algorithm will generate a lot of empty 
-            tiles, which are later discarded using the min_count threshold.
-            Suggested to be at least 1.
-        `n_jobs`(int): Number of jobs to use. If set to None, will use the number 
-            of CPUs given by multiprocessing.cpu_count()
-        
-        Output:
-        Dictionary with the following items:
-        `gene` --> Dictionary with tile counts for each gene.
-        `hexbin` --> matplotlib PolyCollection for hex bins.
-        `coordinates` --> XY coordinates for all tiles.
-        `coordinates_filt` --> XY coordinates for all tiles that have
-            enough counts according to "min_count"
-        `df` --> Pandas dataframe with counts for all genes in all 
-            valid tiles.
-        `spacing` --> Chosen spacing. Keep in mind that the distance between tile
-            centers in different rows might deviate slightly. 
-        
-        """
-        dataset_keys = list(spots.keys())
-        
-        if n_jobs == None:
-            n_jobs = cpu_count()
-        with Parallel(n_jobs=n_cores, backend='loky') as parallel:
-            result = parallel(delayed(make_hexbin)(spacing, spots[k], min_count, unique_genes) for k in dataset_keys)
-            
-        pooled_results = {k:v for k,v in zip(dataset_keys, result)}
-        del result
-        gc.collect()
-
-        return pooled_results
-
-    #Just copied here as backup. This could be paralelized. 
-    def clust_hex_connected(hex_bin, data, samples, distance_threshold=None, 
-                        n_clusters=None, neighbor_rings=1, x_lim=None, 
-                        y_lim=None, save=False, save_name=''):
-        """
-        Cluster hex-bin data, with a neighborhood embedding.
-        
-        Clusters with AggolmerativeClustering that uses a distance matrix 
-        made from the tiles and their neighbours within the neighbour_radius.
-        Can either cluster with a pre-defined number of resulting clusters
-        by passing a number to "n_clusters", or clusters with a 
-        "distance_threshold" that determines the cutoff. When passing
-        multiple datasets that require a different number of clusters the
-        "distance_threshold" will be more suitable.
-        Input:
-        `hex_bin`(dict): Dictonray with hex bin results for every dataset.
-            Output form the hex_bin.make_hexbin() function.
-        `data`(pd.DataFrame): Dataframe with data to cluster.
-        `distance_threshold`(float): Distance threshold for Agglomerative
-            Clustering.
-        `n_clusters`(int): Number of desired resulting clusters.
-        `neighbor_rings`(int): Number of rings around a central tile to make
-            connections between tiles for AgglomerativeClustering with connectivity.
-            1 means connections with the 6 imediate neighbors. 2 means the first and
-            second ring, making 18 neigbors, etc.
-        `x_lim`(tuple): Tuple with (x_min, x_max)
-        `y_lim`(tuple): Tuple with (y_min, y_max)
-
-        """
-        n_rows = math.ceil(len(hex_bin.keys())/3)
-        fig = plt.figure(constrained_layout=True, figsize=(20, n_rows*10))
-        gs = fig.add_gridspec(n_rows, 6)
-        
-        labels_all = []
-        datasets = list(hex_bin.keys())
-        for i, d in enumerate(datasets):
-            print(f'Connected clustering. Processing sample: {i}                    ', end='\r')
-            ax = fig.add_subplot(gs[int(i/3), (i%3)*2:((i%3)*2)+2])
-            
-            n_neighbors = (neighbor_rings * 6)
-            Kgraph = kneighbors_graph(hex_bin[d]['coordinates_filt'], n_neighbors, include_self=False)
-            
-            if distance_threshold!=None and n_clusters!=None:
-                raise Exception('One of "distance_threshold" or "n_clusters" should be defined, not both.')
-            elif distance_threshold != None:
-                clust_result = AgglomerativeClustering(n_clusters=None, distance_threshold=distance_threshold, 
-                                                    compute_full_tree=True, connectivity=Kgraph).fit(data[samples == d])
-            elif n_clusters != None:
-                clust_result = AgglomerativeClustering(n_clusters=n_clusters, 
-                                                    connectivity=Kgraph).fit(data[samples == d])
-            else:
-                raise Exception('One of "distance_threshold" or "n_clusters" should be defined.')
-
-            labels = clust_result.labels_
-            n_clust = len(np.unique(labels))
-            labels_all.append(labels)
-            
-            colors = np.multiply(plt.cm.gist_ncar(labels/max(labels)), [0.9, 0.9, 0.9, 1])
-            
-            xdata = hex_bin[d]['coordinates_filt'][:,0]
-            ydata = hex_bin[d]['coordinates_filt'][:,1]
-            ax.scatter(xdata, ydata, s=4, marker=(6, 0, 0), c=colors)
-            ax.set_aspect('equal')
-
-            #set canvas size, assumes that the first section is the largest if not given.
-            if x_lim == None or y_lim == None:
-                if i == 0:
-                    ylim = ax.get_ylim()
-                    xlim = ax.get_xlim()
-            else:
-                ax.set_ylim(ylim)
-                ax.set_xlim(xlim)
-
-            #ax.invert_yaxis()
-            ax.axis('off')
-            ax.set_title(f'{d} {n_clust} clusters')
-        plt.suptitle(f'Clustering with neighbour connectivity')
-        
-        if save == True:
-            plt.savefig(f'{save_name}_clustering_connectivity_radius{neighbour_radius}.png', dpi=300)
-        
-        return labels_all
-
-     def make_cluster_mean(hex_bin_signal, samples, labels, names):
-        """
-
-        THIS IS THE ORIGINAL FUNCTION RE-IMPLEMENTED ABOVE. MAKE A NEW IMPLEMENTATION THAT WORKS 
-
-        Calculate mean for every cluster.
-        
-        Input:
-        `hex_bin_signal`(np.array): Array with signal for every hexagonal tile.
-            Tiles as columns and genes as rows. Data can be raw counts or 
-            normalized counts.
-        `samples`(np.array): Array with original dataset names to identify
-            from with dataset the tiles are comming.
-        `labels`(np.array): Array with the clustering labels for each dataset 
-            as subarray. Example: "np.array([[1,1,2] [1,2,2]])" For 2 datasets 
-            with each 3 samples.
-        `names`(list): Names of the individual samples in the hex_bin dataset.
-        
-        Returns
-        Dataframe with cluster names and mean.
-        
-        
-        """
-        cluster_names = []
-        for d, label in zip(names, labels):
-            for l in np.unique(label):
-                cluster_names.append(f'{d}_{l}')
-        
-        n_index = hex_bin_signal.shape[1]
-        cluster_mean = pd.DataFrame(data=np.zeros((n_index, len(cluster_names))), index=np.arange(0,n_index,1), columns=cluster_names)
-
-        for d, label in zip(names, labels):
-            for l in np.unique(label):
-                name = f'{d}_{l}'
-                filt1 = samples == d
-                data = hex_bin_signal[filt1,:]  
-                filt2 = label == l
-                data_mean = np.mean(data[filt2,:], axis=0)
-                cluster_mean.loc[:,name] = data_mean
-                
-        return cluster_mean
-
-    
-    def make_cluster_correlation(cluster_mean, method='pearson'):
-        """
-        Return a correlation matrix between cluster_mean expression.
-        This is basically a wrapper for the Pandas .corr() function.
-        Input:
-        `cluster_mean`(pd.Dataframe): Dataframe with clusters as columns, and mean
-            expression for each gene as rows. 
-        `method`(str): Method for correlation: "pearson", "kendall", "spearman"
-        Returns
-        Pandas dataframe with correlation matrix.
-        
-        """
-        return cluster_mean.corr(method=method)
+import scipy.sparse as sp
+import dask
+from dask.diagnostics import ProgressBar
+from sklearn.cluster import ward_tree
+from sklearn.manifold import SpectralEmbedding
+from FISHscale.utils.hex_regionalization import Regionalize
+from FISHscale.utils.hex_grid import hex_tile_row_col, hex_ring_adjacency
+from FISHscale.utils.aggregate import label_aggregate
+from typing import Any
+
+
+class Regionalize3D:
+    """Regionalization of z-stacked sections as one volume.
+
+    All sections are binned on one hexagonal grid, so that a tile has the
+    same index in every section. Tiles are connected to their neighbours
+    within the section and to the tile at the same position in the adjacent
+    sections. The joint volume is then clustered once with connectivity,
+    which replaces regionalization of every section followed by merging of
+    the labels.
+
+    The datasets should be ordered along Z, see `order_datasets()`.
+    """
 
-    def make_similarity_network(correlation_matrix=None, cutoff=None, links=None):
-        """
-        Make links between correlating clusters and return a network.
-        
-        Makes links of the highest correlating clusters above the cutoff.
-        
-        Input:
-        'correlation_matrix'(pd.Dataframe): Dataframe with a correlation
-            matrix. Can be the result of the "make_cluster_mean()"
-            function after calling .corr().
-        `cutoff`(float): Cutoff correlation below which relations are 
-            ignored.
-        `links`(pd.Dataframe): Dataframe with edges between nodes. Contains at least
-            two columns with "source" and "target" listing the IDs of the nodes to
-            be connected. See networkx.from_pandas_edgelist() documentation for more
-            details.
-        Returns:
-        Network with edges between nodes that are correlated with each other above
-        the cutoff.
-        
-        """
-        print(type(correlation_matrix))
-        print(type(links))
-        if type(correlation_matrix) == pd.core.frame.DataFrame and type(links) != pd.core.frame.DataFrame:
-            links = correlation_matrix.stack().reset_index()
-            links.columns = ['Var1', 'Var2', 'value']
+    #Tree cutting and graph clustering do not depend on the dimensionality
+    clust_tree_cut = Regionalize.clust_tree_cut
+    _clust_louvain = Regionalize._clust_louvain
 
-            #Filter the links 
-                #Filter on correlation value
-            links = links.loc[(links['value']>cutoff) & (links['value']<1)]
-                #filter on within sample correlation
-            filt = [False if i[:8] == j[:8] else True for i,j in zip(links['Var1'], links['Var2'])]
-            links = links.loc[filt]
-            
-        elif type(correlation_matrix) != pd.core.frame.DataFrame and type(links) == pd.core.frame.DataFrame:
-            pass
-        
-        else:
-            raise Exception('Input is not correct, specify correlation_matrix or links but not both or none, and they should be pandas dataframes')
+    def hex_adjacency_3D(self, tile_index: list, grid: dict, neighbor_rings: int = 1, z_neighbors: int = 1) -> Any:
+        """Connectivity matrix of tiles of multiple sections on one grid.
 
-        G = nx.from_pandas_edgelist(links, source='Var1', target='Var2', edge_attr='value')
+        Tiles are connected to the tiles within "neighbor_rings" in the same
+        section, and to the tile with the same index in the next
+        "z_neighbors" sections.
 
-        fig = plt.figure(figsize=(10,10))
-        nx.draw(G, with_labels=True, node_color='orange', node_size=20, edge_color='gray', 
-                linewidths=1, font_size=6,ax=plt.gca())
-        
-        return G
+        Args:
+            tile_index (list): List with for each section an array with the
+                sorted index of the tiles in the grid.
+            grid (dict): Grid definition made by `hex_grid_global()`.
+            neighbor_rings (int, optional): Number of rings around a tile
+                within the section. Defaults to 1.
+            z_neighbors (int, optional): Number of sections above and below to
+                connect to. Defaults to 1.
 
-    def merge_labels(G, labels, names):
-        """
-        Merge labels based on a network that links labels toghether.
-        
-        Input:
-        `G`(nx.network): Network with edges between cluster labels that need to be 
-            merged.
-        `labels`(np.array): Array with the clustering labels for each dataset 
-            as subarray. Example: "np.array([[1,1,2] [1,2,2]])" For 2 datasets 
-            with each 3 samples.
-        `names`(list): Names of the individual samples in the hex_bin dataset.
         Returns:
-        Array in the same shape as "labels" with the new merged labels.
-        
-        """
-        merge_dict = {}
-        for i, group in enumerate(nx.connected_components(G)):
-            for g in group:
-                merge_dict[g] = f'merge_{i}'
-
-        str_labels = []
-        for d, label in zip(names, labels):
-            for l in label:
-                str_labels.append(f'{d}_{l}')
-
-        str_labels_merged = []
-        for i in str_labels:
-            if i in merge_dict.keys():
-                i = merge_dict[i]
-            str_labels_merged.append(i)
+            sp.csr_matrix: Symmetric connectivity matrix with the tiles of
+                all sections in order.
+        """
+        offsets = np.concatenate([[0], np.cumsum([t.shape[0] for t in tile_index])])
+        n = offsets[-1]
+
+        #In section, stack the sections with empty rows in between
+        rows, cols = [], []
+        row_stride = grid['n_rows'] + 2 * neighbor_rings + 1
+        for i, t in enumerate(tile_index):
+            row, col = hex_tile_row_col(t, grid)
+            #Doubled column, even rows are shifted half a spacing
+            cols.append(2 * col + (row % 2 == 0))
+            rows.append(row + i * row_stride)
+        adjacency = hex_ring_adjacency(np.concatenate(cols), np.concatenate(rows), neighbor_rings)
+
+        #Between sections, tiles with the same index
+        z_row, z_col = [], []
+        for i in range(len(tile_index)):
+            for j in range(i + 1, min(i + 1 + z_neighbors, len(tile_index))):
+                _, index_i, index_j = np.intersect1d(tile_index[i], tile_index[j], assume_unique=True,
+                                                     return_indices=True)
+                z_row.append(offsets[i] + index_i)
+                z_col.append(offsets[j] + index_j)
+        if len(z_row) > 0:
+            z_row, z_col = np.concatenate(z_row), np.concatenate(z_col)
+            z_links = sp.csr_matrix((np.ones(z_row.shape[0]), (z_row, z_col)), shape=(n, n))
+            adjacency = adjacency + z_links + z_links.T
+
+        return adjacency.tocsr()
+
+    def regionalize_3D(self,
+                       spacing: float,
+                       min_count: int,
+                       feature_selection: np.ndarray = None,
+                       normalization_mode: str = 'APR',
+                       n_components: list = [0,100],
+                       clust_dist_threshold: float = 70,
+                       n_clusters: int = None,
+                       clust_neighbor_rings: int = 1,
+                       z_neighbors: int = 1,
+                       clust_method: str = 'ward',
+                       clust_resolution: float = 1.0,
+                       order_labels: bool = True,
+                       origin: tuple = None,
+                       n_jobs: int = -1) -> dict:
+        """Regionalize all datasets as one volume.
+
+        Performs the following steps:
+        - Hexagonal binning of all datasets on one grid
+        - Normalization of each dataset
+        - PCA of all tiles together
+        - Clustering with connectivity within and between sections
+        - Calculating mean region expression matrix for each dataset
+
+        Because all tiles are clustered together, the labels are the same
+        for all datasets and do not need to be merged.
+
+        Args:
+            spacing (float): distance between tile centers, in same units as
+                the data. The function makes hexagons with the point up: ⬡
+            min_count (int):  Minimal number of molecules in a tile to keep the
+                tile in the dataset.
+            feature_selection (np.ndarray, optional): Array of genes to use.
+                If none is provided will run on all genes. Defaults to None.
+            normalization_mode (str, optional):Normalization method. Choose
+                from: "log", "sqrt",  "z", "APR" or None. Datasets are
+                normalized individually. Defaults to 'APR'.
+            n_components (list, optional): PCA components to use for
+                clustering. Defaults to [0, 100].
+            clust_dist_threshold (float, optional): Distance threshold for
+                Ward clustering. Defaults to 70.
+            n_clusters (int, optional): Number of desired clusters. Either this
+                or clust_dist_threshold should be provided. Defaults to None.
+            clust_neighbor_rings (int, optional): Number of rings around a
+                central tile to connect to within the section. Defaults to 1.
+            z_neighbors (int, optional): Number of sections above and below
+                a tile to connect to. Defaults to 1.
+            clust_method (str, optional): "ward" for Ward clustering with
+                connectivity, or "louvain" for Louvain community detection on
+                the connectivity graph weighted by expression distance.
+                Defaults to 'ward'.
+            clust_resolution (float, optional): Resolution for "louvain",
+                which does not take "n_clusters". Defaults to 1.0.
+            order_labels (bool, optional): Order the labels so that similar
+                regions have similar labels. Defaults to True.
+            origin (tuple, optional): X and Y of the origin of the grid, see
+                `hexbin_grid_global()`. Defaults to None.
+            n_jobs (int, optional): Number of jobs. Defaults to -1.
 
-        merge_label_dict = {v: i for i, v in enumerate(np.unique(str_labels_merged))}
-        int_labels_merged = np.array([merge_label_dict[i] for i in str_labels_merged])
-        
-        return np.array(int_labels_merged)
-    
-    def hex_region_boundaries_paralel(hex_bin, labels, decimals=7, n_jobs=None):
-        """
-        Paralel wrapper around hex_region_boundaries
-        
-        Input:
-        `hex_bin`(dict): Dictonray with hex bin results for every dataset.
-            Output form the hex_bin.make_hexbin() function.
-        `labels`(np.array): Array of arrays with labels for each dataset in hex_bin. 
-        `decimal`(int): Due to inaccuracies in the original hexagon tile generation 
-            and rounding errors, the points need to be rounded to return all unique 
-            points. If you experience errors with the generation of polygons 
-            downstream, lower the number of decimals.
-        `n_jobs`(int): Number of processes for multiprocessing.pool.
-            If None it will use the max number of CPU cores.
-        
-        """
-        dataset_keys = list(hex_bin.keys())
-        #datasets = [hex_bin[k] for k in dataset_keys]
-        #decimals_list = [decimals for i in dataset_keys]
-
-        #Paralel execution for all datasets
-        #with Pool(processes=n_jobs) as pool:
-        #    result = pool.starmap(hex_region_boundaries, zip(datasets, labels, decimals_list), 1)
-            
-        n_cores = cpu_count()
-        with Parallel(n_jobs=n_cores, backend='loky') as parallel:
-            result = parallel(delayed(hex_region_boundaries)(hex_bin[k], l, decimals) for k,l in zip(dataset_keys, labels))
-
-        pooled_results = {k:v for k,v in zip(dataset_keys, result)}
-
-        return pooled_results
-
-
-
-    def order_points_parallel(boundary_points, n_jobs=None):
-        """
-        Parallel wrapper around order_points()
-        
-        Input:
-        `boundary_points`(dict): Dictionary with keys for each dataset with the 
-            lables for each region as keys and a numpy array with xy coordinates
-            for all boundary points.
-        `n_jobs`(int): Number of processes for multiprocessing.pool.
-            If None it will use the max number of CPU cores.
         Returns:
-        Dictionary with for every dataset (same keys as "boundary_points" input) a 
-        dictionary with for every label, a list of arrays with the border points of
-        every seppearate sub-region in the correct order to make a polygon.   
-        Will close the polygon, meaning that the first and last point are idential.
-        
-        
-        """
-        dataset_keys = list(boundary_points.keys())
-        #datasets = [boundary_points[k] for k in dataset_keys]
-
-        #Paralel execution for all datasets
-        #with Pool(processes=n_jobs) as pool:
-        #    result = pool.map(order_points, datasets, 1)
-            
-        n_cores = cpu_count()
-        with Parallel(n_jobs=n_cores, backend='loky') as parallel:
-            result = parallel(delayed(order_points)(boundary_points[k]) for k in dataset_keys)
-
-        pooled_results = {k:v for k,v in zip(dataset_keys, result)}
-
-        return pooled_results
-
-
-#############################################################################
-#############################################################################
-#############################################################################
-
-
-
-#############################################################################
-#############################################################################
-#############################################################################
-
-def read_spot_data(base_folder, full_name=True, rename_columns = {'r_px_microscope_stitched': 'y', 
-                                                                  'c_px_microscope_stitched': 'x',
-                                                                  'below3Hdistance_genes': 'gene'}):
-    """
-    Read .parquet data and put dataframes in dictionary.
-    
-    Has the option to rename the columns with a dictionary.
-    
-    Input:
-    `base_folder`(str): Path to folder with datasets. Will process all 
-        ".parquet" files.
-    `full_name`(bool): If True uses the full file name. Else it will take the 
-        last part after a lower dash "_"
-    `rename_columns`(dict): Dictionary with old and new column names. Default:
-        {'r_px_microscope_stitched': 'y', 
-        'c_px_microscope_stitched': 'x',
-        'below3Hdistance_genes': 'gene'}
-        Set to None if you want the default column names
-    Output:
-    Dictionary with file names as keys, with a pandas dataframe with the spot
-    localizaion data.
-    
-    """
-    data = {}
-    for f in sorted(glob.glob(base_folder + '*.parquet')):
-        if full_name:
-            name = f.split('/')[-1]
+            dict: Dictionary with dataset names as keys. Each holds a
+            dictionary with the "df_hex", "labels", "coordinates", "df_mean"
+            and "df_norm" like `regionalize()`. The labels are also stored
+            under "labels_merged".
+        """
+        if clust_method not in ['ward', 'louvain']:
+            raise Exception(f'Method "{clust_method}" not implemented, choose from "ward" or "louvain".')
+        if clust_method == 'louvain' and n_clusters != None:
+            raise Exception('"n_clusters" can not be used with "louvain", set the number of clusters with "clust_resolution".')
+        grid = self.hexbin_grid_global(spacing, origin=origin)
+        self.hexbin_grid = grid
+
+        #Bin all datasets on the same grid
+        results = {}
+        for d in self.datasets:
+            r = dask.delayed(d.hexbin_make)(spacing, min_count, feature_selection=feature_selection, n_jobs=1,
+                                            grid=grid)
+            results[d.dataset_name] = r
+        with ProgressBar():
+            results = dask.compute(results)[0]
+        df_hex = [results[d.dataset_name][0] for d in self.datasets]
+        coordinates = [results[d.dataset_name][1] for d in self.datasets]
+        tile_index = [d.hexbin_tile_index for d in self.datasets]
+        widths = np.array([df.shape[1] for df in df_hex])
+        bounds = np.concatenate([[0], np.cumsum(widths)])
+
+        #Normalize each dataset and reduce all tiles together
+        merged, _ = self.merge_norm(df_hex, mode=normalization_mode, out='array')
+        dr = self.PCA(merged.T, n_components=n_components[1])[:, n_components[0]:]
+
+        #Cluster the volume
+        Kgraph = self.hex_adjacency_3D(tile_index, grid, neighbor_rings=clust_neighbor_rings,
+                                       z_neighbors=z_neighbors)
+        if clust_method == 'ward':
+            children, _, n_leaves, _, distances = ward_tree(dr, connectivity=Kgraph, return_distance=True)
+            tree = {'children': children, 'distances': distances, 'n_leaves': n_leaves,
+                    'leaf_index': np.arange(dr.shape[0])}
+            labels = self.clust_tree_cut(tree, distance_threshold=clust_dist_threshold, n_clusters=n_clusters)
         else:
-            name = f.split('_')[-1]
-        name = name.split('.')[0]
-        df = pd.read_parquet(f)
-        if isinstance(rename_columns, dict):
-            df = df.rename(columns=rename_columns)
-        data[name] = df
-    
-    return data
-
-def convert_spot_numpy(spots, x_label='r_px_microscope_stitched', y_label='c_px_microscope_stitched', gene_label='below3Hdistance_genes'):
-    """
-    Convert spot localization data in a pandas dataframe to a standard file.
-    
-    Converts to a dictionary that for every dataset contains: 
-    "xy": A (n, 2) numpy array with x y coordinates.
-    "gene": A numpy array with the original gene names for every spot.
-    Input:
-    spots(dict): Dictionary with for every key a pandas dataframe with x and y 
-        coordinates and a gene name column.
-    x_label(str): Name of the column containing the x coordinates.
-    y_label(str): Name of the column containing the y coordinates.
-    gene_label(str): Name of the column containint the gene labels.
-    Output:
-    Dictionary in with the same keys as the input. Containing the xy 
-    coordinates and the gene labels.  
-    
-    """
-    datasets = list(spots.keys())
-    converted = {d:{} for d in datasets}
-    for d in datasets:
-        converted[d]['xy'] = np.array(spots[d].loc[:, [x_label, y_label]])
-        converted[d]['gene'] = spots[d].loc[:, gene_label].to_numpy()
-    return converted
-
-
-
-
-
-
-
-    
-def clust_hex(hex_bin, manifold, n_clusters=None, data=None, clustering=None, 
-              labels_input=None, x_lim=None, y_lim=None):
-    """
-    Cluster hex-bin data. There are multiple options for clustering.
-    Either give as input:
-    "n_clusters" and "data", to perform KMeans clustering.
-    "clustering", for custom clustering.
-    "labels_input", if you just want to plot results of existing
-        clustering results.    
-    Input:
-    `hex_bin`(dict): Dictonray with hex bin results for every dataset.
-        Output form the make_hexbin() function.
-    `manifold`(pd.DataFrame): Dataframe with the manifold embedding
-        Like UMAP or tSNE. Should have "c1" and "c2" as index.
-    `n_clusters`(int): Number of clusters.
-    `data`(pd.DataFrame): Dataframe with data to cluster.
-    `clustering`(clustering object): Scikit learn clustering object. 
-        Like: "AgglomerativeClustering(n_clusters=40).fit(pca)"
-    `labels_input`(array, list): Cluster labels if dataset has been
-        clusterd before.
-    `x_lim`(tuple): Tuple with (x_min, x_max)
-    `y_lim`(tuple): Tuple with (y_min, y_max)
-
-    """
-    if clustering == None and not isinstance(labels_input, (np.ndarray, list)):
-        clust_result = KMeans(n_clusters=n_clusters).fit(data)
-        labels = clust_result.labels_
-    elif clustering != None and not isinstance(labels_input, (np.ndarray, list)):
-        clust_result = clustering
-        labels = clust_result.labels_
-    elif clustering == None and isinstance(labels_input, (np.ndarray, list)):
-        labels = labels_input
-    
-    n_rows = math.ceil(len(hex_bin.keys())/2)
-    fig = plt.figure(constrained_layout=True, figsize=(10, n_rows*3))
-    gs = fig.add_gridspec(n_rows, 4)
-
-    datasets = list(hex_bin.keys())
-    for i, d in enumerate(datasets):
-        print(f'Clustering. Processing sample: {i}                    ', end='\r')
-        ax = fig.add_subplot(gs[int(i/2), (i%2)*2:((i%2)*2)+2])
-
-        ydata = hex_bin[d]['coordinates_filt'][:,0]
-        xdata = hex_bin[d]['coordinates_filt'][:,1]
-
-        labels_plot = labels[samples == d]
-        
-        colors = np.multiply(plt.cm.gist_ncar(labels_plot/max(labels_plot)), [0.9, 0.9, 0.9, 1])
-
-        ax.scatter(xdata, ydata, s=0.1, marker=(6, 0, 30), c=colors)
-        ax.set_aspect('equal')
-
-        #set canvas size, assumes that the first section is the largest if not given.
-        if x_lim == None or y_lim == None:
-            if i == 0:
-                ylim = ax.get_ylim()
-                xlim = ax.get_xlim()
-                print(xlim)
-        else:
-            ax.set_ylim(ylim)
-            ax.set_xlim(xlim)
-
-
-        ax.invert_yaxis()
-        ax.axis('off')
-        ax.set_title(d)
-    plt.suptitle(f'Clustering')
-
-    ax = fig.add_subplot(gs[-1, 2])
-    colors_manifold =  np.multiply(plt.cm.gist_ncar(labels/max(labels)), [0.9, 0.9, 0.9, 1])
-    ax.scatter(manifold.loc['c1', :], manifold.loc['c2', :], s=0.5, c=colors_manifold)
-    ax.set_aspect('equal')
-    ax.set_axis_off()
-
-    ax = fig.add_subplot(gs[-1, 3])
-    unique = np.unique(labels, return_counts=True)
-    colors_unique = np.multiply(plt.cm.gist_ncar(unique[0]/max(unique[0])), [0.9, 0.9, 0.9, 1])
-    ax.pie(unique[1], colors=colors_unique)
-    
-    return labels
-
-#TODO: make paralel, make plotting a seperate function
\ No newline at end of file
+            labels = self._clust_louvain(dr, Kgraph, resolution=clust_resolution, n_neighbors=0)
+
+        #Order cluster labels on the mean normalized expression
+        if order_labels:
+            cluster_mean = label_aggregate(merged, labels, func='mean')
+            manifold = SpectralEmbedding(n_components=1, n_jobs=n_jobs).fit_transform(cluster_mean.T)
+            order = np.empty(cluster_mean.shape[1], dtype=int)
+            order[cluster_mean.columns.to_numpy()[np.argsort(manifold.ravel(), kind='stable')]] = np.arange(order.shape[0])
+            labels = order[labels]
+
+        #Results per dataset
+        collection = {}
+        for i, d in enumerate(self.datasets):
+            l = labels[bounds[i]:bounds[i+1]]
+            df_norm = label_aggregate(merged[:, bounds[i]:bounds[i+1]], l, func='mean')
+            df_norm.index = df_hex[i].index
+            collection[d.dataset_name] = {'df_hex': df_hex[i],
+                                          'labels': l,
+                                          'coordinates': coordinates[i],
+                                          'df_mean': label_aggregate(df_hex[i], l, func='mean'),
+                                          'df_norm': df_norm,
+                                          'labels_merged': l}
+
+        return collection
@@ -1,6 +1,8 @@
 import numpy as np
 from typing import Any
 import pandas as pd
+import scipy.sparse as sp
+from FISHscale.utils.aggregate import _to_matrix
 
 
 class Normalization:
@@ -58,19 +60,34 @@ class Normalization:
             c[~np.isfinite(c)] = 0  # -inf inf NaN
         return c
     
-    def APR(self, df, clip = None):
+    def APR(self, df, clip = None, chunk_size: int = None, dtype: Any = None, out: np.ndarray = None):
         """Analytic Pearson residuals. 
         
         Calculate bionimial deviance statistics. 
         
         Based on: https://doi.org/10.1101/2020.12.01.405886
 
+        The gene and sample totals are calculated first, after which the 
+        residuals are calculated for blocks of "chunk_size" samples. The 
+        expected counts are only made for one block at a time, so that the 
+        peak memory is the output plus a few blocks. With "out" the result is
+        written into a preallocated array, like a block of a larger matrix or
+        a memory mapped array.
+
         Args:
             df ([pd.DataFrame, np.ndarray]): Pandas dataframe or numpy array 
-                with features as rows and samples as columns.
+                with features as rows and samples as columns. Can also be a
+                scipy sparse matrix or a Dataframe with sparse columns.
             clip ([float, bool], optional): If True, data will be clipped to 
                 +/- sqrt(n samples). If a number is given the data will be 
                 clipped to +/- the value.
+            chunk_size (int, optional): Number of samples per block. If None, 
+                all samples are processed at once. Defaults to None.
+            dtype (Any, optional): Data type of the result, like np.float32 
+                to halve the memory. If None uses the type of "out", or 
+                float64. Defaults to None.
+            out (np.ndarray, optional): Array with the same shape as "df" to 
+                write the result in. Defaults to None.
                 
         Returns:
             [pd.DataFrame, np.ndarray]: Pandas dataframe or array with results.
@@ -81,28 +98,20 @@ class Normalization:
             pandas = True
             index = df.index
             columns = df.columns
-            df = df.to_numpy()
-                    
-        totals = df.sum(axis=0)
-        gene_totals = df.sum(axis=1)
-        overall_total = df.sum()
+        X = _to_matrix(df)
         
-        expected = totals[:, None] @ self.div0(gene_totals[None, :], overall_total)
-        expected = expected.T
-        result = self.div0((df - expected), np.sqrt(expected + np.power(expected, 2) / 100))
+        #Totals in double precision
+        totals = np.asarray(X.sum(axis=0), dtype=np.float64).ravel()
+        gene_totals = np.asarray(X.sum(axis=1), dtype=np.float64).ravel()
+        gene_fraction = self.div0(gene_totals, totals.sum())
         
-        if pandas:
-            result = pd.DataFrame(data=result, index=index, columns=columns)
+        out = _APR_residuals(X, gene_fraction, totals, clip=clip, chunk_size=chunk_size, dtype=dtype, out=out)
         
-        if clip == True:
-            cap = np.sqrt(result.shape[1])
-            result = result.clip(lower=-cap, upper=cap)
-            
-        elif isinstance(clip, (int, float)):
-            result = result.clip(lower=-clip, upper=clip)
+        if pandas:
+            out = pd.DataFrame(data=out, index=index, columns=columns, copy=False)
         
-        return result
-    
+        return out
+
     def normalize(self, data: Any, mode:str = 'log', **kwargs) -> Any:
         """Simple data normalization.
 
@@ -113,7 +122,9 @@ class Normalization:
                 "sqrt",  "z", "APR" or None. for log +1 transform, square root 
                 transform, z scores or Analytic Pearson residuals respectively.
                 When the mode is None, no normalization will be performed and
-                the input is the output. Defaults to 'log'.
+                the input is the output. Can also be a fitted Normalizer, see
+                `normalizer_make()`, to normalize with its statistics. 
+                Defaults to 'log'.
                 
         Kwargs:
             Will be passed to the APR() normalization function.
@@ -125,7 +136,11 @@ class Normalization:
             [np.ndarray, pd.Dataframe]: Normalzed data.
         """
 
-        if mode == 'log':
+        if isinstance(mode, Normalizer):
+            result = mode.transform(data, **kwargs)
+        elif mode == None:
+            result = data
+        elif mode == 'log':
             result = self.log_norm(data)
         elif mode == 'sqrt':
             result = self.sqrt_norm(data)
@@ -133,10 +148,281 @@ class Normalization:
             result = self.z_norm(data)
         elif mode.lower() == 'apr':
             result = self.APR(data, **kwargs)
-        elif mode == None:
-            result = data
         else:
             raise Exception(f'Invalid "mode": {mode}')
 
         return result
-    
\ No newline at end of file
+
+    def normalizer_make(self, mode: str = 'APR', data: list = None) -> 'Normalizer':
+        """Make a normalizer that can be fitted on multiple datasets.
+
+        Args:
+            mode (str, optional): Normalization method. Choose from: "log",
+                "sqrt", "z" or "APR". Defaults to 'APR'.
+            data (list, optional): List of datasets with features in rows and
+                samples in columns, to fit the normalizer on one by one with 
+                `partial_fit()`. If None, the normalizer is not fitted.
+                Defaults to None.
+
+        Raises:
+            Exception: If mode is not properly defined
+
+        Returns:
+            Normalizer: Normalizer with `fit()`, `partial_fit()` and 
+                `transform()`.
+        """
+        normalizers = {'log': LogNormalizer, 'sqrt': SqrtNormalizer, 'z': ZNormalizer, 'apr': APRNormalizer}
+        if mode.lower() not in normalizers:
+            raise Exception(f'Invalid "mode": {mode}')
+        normalizer = normalizers[mode.lower()]()
+        
+        if data != None:
+            for d in data:
+                normalizer.partial_fit(d)
+        return normalizer
+    
+
+
+def _APR_residuals(X: Any, gene_fraction: np.ndarray, totals: np.ndarray, clip: Any = None, chunk_size: int = None,
+                   dtype: Any = None, out: np.ndarray = None) -> np.ndarray:
+    """Analytic Pearson residuals from precomputed totals, block by block.
+
+    Args:
+        X (Any): Numpy array or sparse matrix with features as rows and 
+            samples as columns.
+        gene_fraction (np.ndarray): Fraction of the total count of each 
+            feature.
+        totals (np.ndarray): Total count of each sample.
+        clip ([float, bool], optional): See `Normalization.APR()`.
+        chunk_size (int, optional): Number of samples per block. If None, all
+            samples are processed at once. Defaults to None.
+        dtype (Any, optional): Data type of the result. Defaults to None.
+        out (np.ndarray, optional): Array to write the result in. 
+            Defaults to None.
+
+    Returns:
+        np.ndarray: Array with residuals.
+    """
+    if sp.issparse(X):
+        X = X.tocsc()
+    n_samples = X.shape[1]
+    
+    if out is None:
+        out = np.empty(X.shape, dtype=np.float64 if dtype == None else dtype)
+    elif out.shape != X.shape:
+        raise Exception(f'Shape of "out" {out.shape} does not match the shape of the data {X.shape}.')
+    dtype = out.dtype
+    
+    if clip == True:
+        cap = np.sqrt(n_samples)
+    elif isinstance(clip, (int, float)) and clip is not False:
+        cap = clip
+    else:
+        cap = None
+    
+    chunk_size = n_samples if chunk_size == None else max(1, chunk_size)
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
+        block = X[:, start:stop]
+        result = out[:, start:stop]
+        result[:] = block.toarray() if sp.issparse(block) else block
+        
+        #(X - mu) / sqrt(mu + mu^2 / 100)
+        expected = np.multiply.outer(gene_fraction, totals[start:stop]).astype(dtype, copy=False)
+        result -= expected
+        expected *= 1 + expected / 100
+        np.sqrt(expected, out=expected)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(result, expected, out=result)
+        result[~np.isfinite(result)] = 0
+        
+        if cap != None:
+            np.clip(result, -cap, cap, out=result)
+    
+    return out
+
+
+class Normalizer:
+    """Normalization with statistics that are fitted once.
+
+    The statistics are accumulated with `partial_fit()` over any number of
+    datasets, for example streamed sections, and can then be applied to 
+    each dataset with `transform()`, without concatenating the data. 
+    `transform()` does not change the normalizer, so datasets can be 
+    transformed in parallel threads.
+
+    Data has features in rows and samples in columns, like 
+    `Normalization.normalize()`.
+    """
+
+    def __init__(self):
+        self.features = None
+        self.n_samples = 0
+
+    def fit(self, data: Any) -> 'Normalizer':
+        """Fit the statistics on data.
+
+        Args:
+            data (Any): Pandas DataFrame, numpy array or sparse matrix.
+
+        Returns:
+            Normalizer: The fitted normalizer.
+        """
+        self.__init__()
+        return self.partial_fit(data)
+
+    def partial_fit(self, data: Any) -> 'Normalizer':
+        """Add data to the statistics.
+
+        Args:
+            data (Any): Pandas DataFrame, numpy array or sparse matrix. For 
+                DataFrames the features are aligned on the index of the first
+                fitted DataFrame.
+
+        Returns:
+            Normalizer: The updated normalizer.
+        """
+        X = self._align(data)
+        self._update(X)
+        self.n_samples += X.shape[1]
+        return self
+
+    def transform(self, data: Any, **kwargs) -> Any:
+        """Normalize data with the fitted statistics.
+
+        Args:
+            data (Any): Pandas DataFrame, numpy array or sparse matrix.
+
+        Kwargs:
+            Passed to the normalization, see the subclasses.
+
+        Returns:
+            [pd.DataFrame, np.ndarray]: Pandas dataframe or array with results.
+        """
+        X = self._align(data)
+        result = self._transform(X, **kwargs)
+        if isinstance(data, pd.DataFrame):
+            result = pd.DataFrame(data=result, index=self.features, columns=data.columns, copy=False)
+        return result
+
+    def fit_transform(self, data: Any, **kwargs) -> Any:
+        """Fit on data and normalize it.
+
+        Args:
+            data (Any): Pandas DataFrame, numpy array or sparse matrix.
+
+        Returns:
+            [pd.DataFrame, np.ndarray]: Pandas dataframe or array with results.
+        """
+        return self.fit(data).transform(data, **kwargs)
+
+    def _align(self, data: Any) -> Any:
+        """Get the values of the data with the features in fitted order.
+
+        Args:
+            data (Any): Pandas DataFrame, numpy array or sparse matrix.
+
+        Returns:
+            [np.ndarray, sp.csr_matrix]: Numpy array or sparse matrix.
+        """
+        if isinstance(data, pd.DataFrame):
+            if self.features is None:
+                self.features = data.index
+            elif not data.index.equals(self.features):
+                data = data.reindex(self.features, fill_value=0)
+        return _to_matrix(data)
+
+    def _update(self, X: Any) -> None:
+        pass
+
+    def _transform(self, X: Any, **kwargs) -> np.ndarray:
+        raise Exception(f'{type(self).__name__} does not implement transform.')
+
+
+class LogNormalizer(Normalizer):
+    """Log normalization, log(X + 1). Has no statistics."""
+
+    def _transform(self, X: Any, **kwargs) -> np.ndarray:
+        return np.log(_dense(X) + 1)
+
+
+class SqrtNormalizer(Normalizer):
+    """Square root normalization, sqrt(X). Has no statistics."""
+
+    def _transform(self, X: Any, **kwargs) -> np.ndarray:
+        return np.sqrt(_dense(X))
+
+
+class ZNormalizer(Normalizer):
+    """Z scores with the mean and standard deviation of all fitted samples.
+
+    Means and variances of the features are combined over batches with the
+    parallel algorithm of Chan et al., so that the result matches the z 
+    scores of the concatenated data.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.mean = None
+        self.m2 = None
+
+    def _update(self, X: Any) -> None:
+        n = X.shape[1]
+        if n == 0:
+            return
+        mean = np.asarray(X.mean(axis=1), dtype=np.float64).ravel()
+        if sp.issparse(X):
+            m2 = np.asarray(X.multiply(X).sum(axis=1), dtype=np.float64).ravel() - n * mean**2
+        else:
+            m2 = ((np.asarray(X, dtype=np.float64) - mean[:, None])**2).sum(axis=1)
+        
+        if self.mean is None:
+            self.mean, self.m2 = mean, m2
+        else:
+            n_total = self.n_samples + n
+            delta = mean - self.mean
+            self.mean = self.mean + delta * (n / n_total)
+            self.m2 = self.m2 + m2 + delta**2 * (self.n_samples * n / n_total)
+
+    @property
+    def std(self) -> np.ndarray:
+        """Sample standard deviation of the features."""
+        return np.sqrt(self.m2 / max(self.n_samples - 1, 1))
+
+    def _transform(self, X: Any, **kwargs) -> np.ndarray:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = (_dense(X) - self.mean[:, None]) / self.std[:, None]
+        result[~np.isfinite(result)] = 0
+        return result
+
+
+class APRNormalizer(Normalizer):
+    """Analytic Pearson residuals with the gene totals of all fitted samples.
+
+    The expected count of a gene in a sample is the total count of the 
+    sample times the fraction of the gene in all fitted data.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.gene_totals = None
+
+    def _update(self, X: Any) -> None:
+        gene_totals = np.asarray(X.sum(axis=1), dtype=np.float64).ravel()
+        self.gene_totals = gene_totals if self.gene_totals is None else self.gene_totals + gene_totals
+
+    @property
+    def gene_fraction(self) -> np.ndarray:
+        """Fraction of the total count of each gene."""
+        total = self.gene_totals.sum()
+        return self.gene_totals / total if total > 0 else np.zeros_like(self.gene_totals)
+
+    def _transform(self, X: Any, clip: Any = None, chunk_size: int = None, dtype: Any = None, 
+                   out: np.ndarray = None) -> np.ndarray:
+        totals = np.asarray(X.sum(axis=0), dtype=np.float64).ravel()
+        return _APR_residuals(X, self.gene_fraction, totals, clip=clip, chunk_size=chunk_size, dtype=dtype, out=out)
+
+
+def _dense(X: Any) -> np.ndarray:
+    """Dense float array of a numpy array or sparse matrix."""
+    return X.toarray() if sp.issparse(X) else np.asarray(X, dtype=np.float64)
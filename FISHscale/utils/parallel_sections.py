@@ -0,0 +1,116 @@
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, List
+
+
+class SectionHandle:
+    """Picklable reference to a Dataset.
+
+    A Dataset holds Dask dataframes and other objects that can not be sent
+    to another process. The handle only stores what is needed to reopen the
+    parsed data of the section in a worker process, together with the
+    temporary coordinate transformations, like offsets and flips, that are
+    replayed after reopening.
+    """
+
+    def __init__(self, dataset: Any):
+        """Make handle of a Dataset.
+
+        Args:
+            dataset (Dataset): FISHscale Dataset that has been parsed.
+        """
+        self.filename = dataset.filename
+        self.dataset_name = dataset.dataset_name
+        self.unique_genes = np.asarray(dataset.unique_genes)
+        self.z = dataset.z
+        self.pixel_size = f'{dataset.pixel_size.magnitude} micrometer'
+        self.color_dict = getattr(dataset, 'color_dict', None)
+        self.cache_max_size = dataset.cache_max_size / 1e9
+        self.coordinate_transforms = list(dataset.coordinate_transforms)
+
+    def open(self) -> Any:
+        """Reopen the Dataset.
+
+        Returns:
+            Dataset: Dataset with the same coordinates as the original.
+        """
+        #Imported here to prevent a circular import
+        from FISHscale.utils.dataset import Dataset
+
+        d = Dataset(self.filename, unique_genes=self.unique_genes, z=self.z, pixel_size=self.pixel_size,
+                    color_input=self.color_dict, part_of_multidataset=True, cache_max_size=self.cache_max_size)
+
+        #Replay temporary transformations
+        for t in self.coordinate_transforms:
+            if t[0] == 'offset':
+                d.offset_data_temp(*t[1:])
+            elif t[0] == 'transpose':
+                d.transpose()
+            elif t[0] == 'flip_x':
+                d.flip_x()
+            elif t[0] == 'flip_y':
+                d.flip_y()
+            else:
+                raise Exception(f'Unknown coordinate transformation: {t[0]}')
+        return d
+
+
+def _hexbin_worker(handle: SectionHandle, kwargs: dict) -> str:
+    """Hexagonal binning of one section in a worker process.
+
+    The result is written to the on-disk cache of the section.
+
+    Args:
+        handle (SectionHandle): Handle of the section.
+        kwargs (dict): Keyword arguments for `hexbin_make()`.
+
+    Returns:
+        str: Name of the section.
+    """
+    d = handle.open()
+    d.hexbin_make(cache=True, **kwargs)
+    return handle.dataset_name
+
+
+def _regionalize_worker(handle: SectionHandle, kwargs: dict) -> str:
+    """Regionalization of one section in a worker process.
+
+    The result is written to the on-disk cache of the section under the
+    name "regionalize", with the keyword arguments as parameters.
+
+    Args:
+        handle (SectionHandle): Handle of the section.
+        kwargs (dict): Keyword arguments for `regionalize()`.
+
+    Returns:
+        str: Name of the section.
+    """
+    d = handle.open()
+    result = d.regionalize(**kwargs)
+    d.cache_save('regionalize', kwargs, result)
+    return handle.dataset_name
+
+
+def run_sections(worker: Callable, datasets: List[Any], kwargs: dict, n_jobs: int = -1) -> List[str]:
+    """Run a worker function for each section in a process pool.
+
+    Uses the "spawn" start method so that workers do not inherit the
+    threads of Dask or Numba from the parent.
+
+    Args:
+        worker (Callable): Module level worker function that takes a
+            SectionHandle and a dictionary with keyword arguments.
+        datasets (List[Dataset]): List of Datasets.
+        kwargs (dict): Keyword arguments for the worker.
+        n_jobs (int, optional): Number of processes. If -1 uses the number of
+            CPUs. Defaults to -1.
+
+    Returns:
+        List[str]: Names of the finished sections.
+    """
+    n_jobs = multiprocessing.cpu_count() if n_jobs == -1 else n_jobs
+    handles = [SectionHandle(d) for d in datasets]
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(handles)), mp_context=ctx) as executor:
+        return list(executor.map(worker, handles, [kwargs] * len(handles)))
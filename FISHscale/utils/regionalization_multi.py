@@ -1,7 +1,13 @@
 from numpy.linalg.linalg import norm
 from FISHscale.utils.decomposition import Decomposition
 from FISHscale.utils.density_1D import Density1D
+from FISHscale.utils.aggregate import label_aggregate, _to_matrix
+from FISHscale.utils.hex_grid import hex_grid_global, hex_tile_axial
+from FISHscale.utils.normalization import APRNormalizer
+from FISHscale.utils.parallel_sections import run_sections, _hexbin_worker, _regionalize_worker
 import gc
+import multiprocessing
+from os import path
 import glob
 import math
 from itertools import combinations, permutations
@@ -10,6 +16,7 @@ import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from joblib import Parallel, delayed
 from matplotlib.pyplot import axes, hexbin, xcorr
 from shapely.geometry import MultiLineString, MultiPolygon, Polygon
@@ -21,9 +28,14 @@ from numba import jit, njit
 import numba
 from pint import UnitRegistry
 from tqdm import tqdm
-from typing import Any
+from typing import Any, Tuple
+from concurrent.futures import ThreadPoolExecutor
 import copy
 from sklearn.manifold import TSNE, SpectralEmbedding
+from sklearn.decomposition import IncrementalPCA
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse.csgraph import connected_components
+from scipy.stats import rankdata, kendalltau
 import dask
 import colorsys
 from dask.diagnostics import ProgressBar
@@ -33,32 +45,95 @@ from collections import Counter
 class RegionalizeMulti(Decomposition):
     
     #### HEXAGONAL BINNING ####    
-    def hexbin_multi(self, spacing: float, min_count: int) -> dict:
+    def hexbin_grid_global(self, spacing: float, origin: tuple = None) -> dict:
+        """Hexagonal grid that covers the union extent of all datasets.
+
+        Args:
+            spacing (float): Center to center spacing between hexagons.
+            origin (tuple, optional): X and Y of the origin of the grid. Grids
+                with the same origin line up with each other. If None, the 
+                grid is fitted to the union extent. Defaults to None.
+
+        Returns:
+            dict: Grid definition like `hex_grid_global()`.
+        """
+        x_min = min([d.x_min for d in self.datasets])
+        x_max = max([d.x_max for d in self.datasets])
+        y_min = min([d.y_min for d in self.datasets])
+        y_max = max([d.y_max for d in self.datasets])
+        return hex_grid_global(spacing, x_min, x_max, y_min, y_max, origin=origin)
+
+    def hexbin_multi(self, spacing: float, min_count: int, parallel: str = 'threads', n_jobs: int = -1,
+                     global_grid: bool = False, origin: tuple = None, feature_selection: np.ndarray = None) -> dict:
         """Make hexagonal bining of all datasets
 
+        With "global_grid" all datasets are binned on one grid, so that tiles
+        at the same position have the same index in all datasets. Datasets
+        can then be compared or stacked by joining on the "tile_index" or the
+        integer "axial" coordinates, for example with `np.intersect1d()`.
+
         Args:
             spacing (float): Center to center spacing between hexagons
             min_count (int): Minimum count to keep tile i nthe dataset.
+            parallel (str, optional): "threads" to bin the datasets with Dask
+                threads, or "processes" to bin the datasets in a process pool.
+                With processes each worker reopens its dataset and writes the
+                result to the on-disk cache of that dataset, from which it is
+                then loaded. Defaults to 'threads'.
+            n_jobs (int, optional): Number of processes when "parallel" is 
+                "processes". If -1 uses the number of CPUs. Defaults to -1.
+            global_grid (bool, optional): If True, bins all datasets on one
+                grid over the union extent. The grid is stored under
+                self.hexbin_grid. Defaults to False.
+            origin (tuple, optional): X and Y of the origin of the global 
+                grid, see `hexbin_grid_global()`. Implies "global_grid".
+                Defaults to None.
+            feature_selection (np.ndarray, optional): Array with genes to 
+                bin. If None, all genes are used. Defaults to None.
 
         Returns:
-            dict: Dictionary with dataset names as keys 
+            dict: Dictionary with dataset names as keys. With "global_grid"
+                each dataset also has the "tile_index" in the global grid and
+                the "axial" q and r coordinates of the tiles as integer array
+                with shape (n_tiles, 2).
         """
         results = {}
-         
-        for d in self.datasets:
-            r = dask.delayed(d.hexbin_make)(spacing, min_count, n_jobs=1)
-            results[d.dataset_name] = {'df_hex': r[0],
-                                       'coordinates': r[1]}
+        kwargs = {'n_jobs': 1, 'feature_selection': feature_selection}
+        if global_grid or origin != None:
+            self.hexbin_grid = self.hexbin_grid_global(spacing, origin=origin)
+            kwargs['grid'] = self.hexbin_grid
+        
+        if parallel == 'processes':
+            run_sections(_hexbin_worker, self.datasets, {'spacing': spacing, 'min_count': min_count, **kwargs}, 
+                         n_jobs=n_jobs)
+            #Load results from cache
+            for d in self.datasets:
+                r = d.hexbin_make(spacing, min_count, **kwargs)
+                results[d.dataset_name] = {'df_hex': r[0],
+                                           'coordinates': r[1]}
+        elif parallel == 'threads':
+            for d in self.datasets:
+                r = dask.delayed(d.hexbin_make)(spacing, min_count, **kwargs)
+                results[d.dataset_name] = {'df_hex': r[0],
+                                           'coordinates': r[1]}
+            
+            with ProgressBar():
+                results = dask.compute(results)[0] #Threads, use parallel='processes' to bin in separate processes
+        else:
+            raise Exception(f'Parallel mode "{parallel}" not implemented, choose from "threads" or "processes".')
         
-        with ProgressBar():
-            results = dask.compute(results) #It is not paralel because d can not be pickled, but there is still some speed up
+        if 'grid' in kwargs:
+            for d in self.datasets:
+                results[d.dataset_name]['tile_index'] = d.hexbin_tile_index
+                results[d.dataset_name]['axial'] = np.column_stack(hex_tile_axial(d.hexbin_tile_index, self.hexbin_grid))
         
-        return results[0]
+        return results
     
     #### PLOTTING ####        
     def hexbin_plot(self, c:list, cm=None, gridspec=None, figsize=None, 
                     show_sample_title:bool = True, vmin:float = None,
-                     vmax:float = None, save:bool=False, savename:str=''):
+                     vmax:float = None, save:bool=False, savename:str='',
+                     raster: bool = False, raster_resolution: int = 4):
         """Plot spatial multidataset hexbin results
 
         Args:
@@ -81,6 +156,11 @@ class RegionalizeMulti(Decomposition):
                 Defaults to True.
             save (bool, optional): Save the plot as .pdf. Defaults to False.
             savename (str, optional): Name of the plot. Defaults to ''.
+            raster (bool, optional): If True, paints the tiles in an image 
+                instead of drawing a polygon for each tile. Much faster for
+                many datasets or large grids. Defaults to False.
+            raster_resolution (int, optional): Number of pixels per tile 
+                spacing in raster mode. Defaults to 4.
         """
         #calculate grid
         n_datasets = len(c)
@@ -100,7 +180,7 @@ class RegionalizeMulti(Decomposition):
         #plot data
         for d, col, ((i,j), ax) in zip(self.datasets, c, np.ndenumerate(axes)):
             ax = axes[i,j]
-            d.hexbin_plot(c = col, cm=cm, ax=ax, vmin=vmin, vmax=vmax)
+            d.hexbin_plot(c = col, cm=cm, ax=ax, vmin=vmin, vmax=vmax, raster=raster, raster_resolution=raster_resolution)
             if show_sample_title:
                 ax.set_title(d.dataset_name, fontsize=6)
             ax.set_aspect('equal')
@@ -257,9 +337,14 @@ class RegionalizeMulti(Decomposition):
             c.append(results[k][item])
         return c
             
-    def merge_norm(self, data:list, mode:str=None, plot:bool = False, **kwargs):
+    def merge_norm(self, data:list, mode:str=None, plot:bool = False, out: str = 'dataframe', 
+                   memmap_file: str = None, return_section_id: bool = False, dtype: Any = 'float64', 
+                   fit_global: bool = False, **kwargs):
         """Merge multiple datasets and optionaly normalize before merging.
 
+        The shape of the merged matrix is calculated first, and each dataset
+        is normalized straight into its block of one preallocated array.
+
         Args:
             data (list): List of pandas dataframes in the same order as 
                 self.datasets_names. 
@@ -267,58 +352,118 @@ class RegionalizeMulti(Decomposition):
                 "sqrt",  "z", "APR" or None. for log +1 transform, square root 
                 transform, z scores or Analytic Pearson residuals respectively.
                 When the mode is None, no normalization will be performed and
-                the input is the output. Defaults to None.
+                the input is the output. Can also be a fitted Normalizer, see
+                `normalizer_make()`. Defaults to None.
             plot (bool, optional): Plot a histogram of the data. Usefull to
                 evaluate normalization performace. Defaults to False.
+            out (str, optional): Type of the merged data. "dataframe" for a
+                Pandas Dataframe, "array" for a numpy array, "memmap" for a 
+                numpy array that is memory mapped to "memmap_file" or 
+                "sparse" for a scipy sparse CSC matrix. Defaults to 
+                'dataframe'.
+            memmap_file (str, optional): File for the "memmap" output. If None
+                the file is made in the FISHscale data folder of the 
+                MultiDataset. Defaults to None.
+            return_section_id (bool, optional): If True, returns an integer
+                section id for each column and an array with the dataset 
+                names of the ids, instead of the dataset name for each column.
+                Defaults to False.
+            dtype (Any, optional): Data type of the merged array. Use 
+                'float32' to halve the memory. Defaults to 'float64'.
+            fit_global (bool, optional): If True, the statistics of the 
+                normalization, like the gene totals for "APR" or the means 
+                and variances for "z", are fitted on all datasets together, 
+                one dataset at a time, instead of on each dataset 
+                individually. Defaults to False.
 
         Kwargs:
-            Will be passed to the APR() normalization function.
+            Will be passed to the APR() normalization function. Use 
+            "chunk_size" to normalize the datasets in blocks of tiles.
         
         Returns:
             Tuple with:
-            [pd.DataFrame]: Merged dataframe.
+            [pd.DataFrame]: Merged dataframe, or array, memmap or sparse 
+                matrix depending on "out".
             [np.ndarray]: Array with sample labels to match columns in the
                 merged dataframe with the original dataset name. 
+            Or if "return_section_id" is True:
+            [pd.DataFrame]: Merged data.
+            [np.ndarray]: Integer array with the section id of each column.
+            [np.ndarray]: Array with the dataset name of each section id.
         """
         nrows = math.ceil(len(data)/2)
         norm = mode != None
         if plot:
             fig, axes = plt.subplots(ncols=2, nrows=nrows, figsize=(10,1.5*nrows), sharey=True, sharex=True)
         
-        for i, (df_next, name) in tqdm(enumerate(zip(data, self.datasets_names))):
-            if i == 0:
-                df_all = df_next
-                samples = [name for j in df_all.columns]
-                if norm:
-                    df_next_norm = self.normalize(df_next, mode=mode, **kwargs)
-                    df_norm = df_next_norm
-                
+        #Final shape
+        index = data[0].index
+        for df_next in data[1:]:
+            if not df_next.index.equals(index):
+                index = index.union(df_next.index, sort=False)
+        widths = np.array([df_next.shape[1] for df_next in data])
+        bounds = np.concatenate([[0], np.cumsum(widths)])
+        names = np.array(self.datasets_names[:len(data)])
+        section_id = np.repeat(np.arange(len(data)), widths)
+        
+        #Fit normalization statistics on all datasets
+        if norm and fit_global and isinstance(mode, str):
+            mode = self.normalizer_make(mode, (df_next if df_next.index.equals(index) else 
+                                               df_next.reindex(index, fill_value=0) for df_next in data))
+        apr = isinstance(mode, APRNormalizer) or (isinstance(mode, str) and mode.lower() == 'apr')
+        
+        #Preallocate, column major so that the block of each dataset is contiguous
+        if out in ['dataframe', 'array']:
+            merged = np.empty((index.shape[0], bounds[-1]), dtype=dtype, order='F')
+        elif out == 'memmap':
+            if memmap_file == None:
+                memmap_file = path.join(self.FISHscale_data_folder, f'{self.dataset_name}_merge_norm.dat')
+            merged = np.memmap(memmap_file, dtype=dtype, mode='w+', shape=(index.shape[0], bounds[-1]), order='F')
+        elif out == 'sparse':
+            merged = []
+        else:
+            raise Exception(f'Output "{out}" not implemented, choose from "dataframe", "array", "memmap" or "sparse".')
+        
+        for i, (df_next, name) in tqdm(enumerate(zip(data, names))):
+            if not df_next.index.equals(index):
+                df_next = df_next.reindex(index, fill_value=0)
+            if norm and apr and out != 'sparse':
+                #Normalize straight into the block of this dataset
+                apr_function = mode.transform if isinstance(mode, APRNormalizer) else self.APR
+                block = apr_function(_to_matrix(df_next), out=merged[:, bounds[i]:bounds[i+1]], **kwargs)
             else:
-                df_all = pd.concat([df_all, df_next], axis=1, sort=False)
-                for j in df_next.columns:
-                    samples.append(name)
                 if norm:
-                    df_next_norm = self.normalize(df_next, mode=mode, **kwargs)
-                    df_norm = pd.concat([df_norm, df_next_norm], axis=1, sort=False)
+                    df_next = self.normalize(df_next, mode=mode, **kwargs)
+                
+                #Fill block of this dataset
+                block = _to_matrix(df_next)
+                if out == 'sparse':
+                    merged.append(sp.csc_matrix(block))
+                else:
+                    merged[:, bounds[i]:bounds[i+1]] = block.toarray() if sp.issparse(block) else block
             
             if plot:    
                 ax = axes[int(i/2), i%2]
-                if norm:
-                    ax.hist(df_next_norm.sum(), bins=100)
-                    ax.set_title(f'{name} normalized')
-                else:
-                    ax.hist(df_next.sum(), bins=100)
-                    ax.set_title(name)
+                ax.hist(np.asarray(block.sum(axis=0)).ravel(), bins=100)
+                ax.set_title(f'{name} normalized' if norm else name)
                 ax.set_ylabel('Frequency')
                 ax.set_xlabel('Sum molecule count')
         
         if plot:
             plt.tight_layout()
         
-        if norm:
-            return df_norm, np.array(samples)
+        if out == 'sparse':
+            merged = sp.hstack(merged, format='csc')
+        elif out == 'memmap':
+            merged.flush()
+        elif out == 'dataframe':
+            columns = np.concatenate([np.asarray(df_next.columns, dtype=object) for df_next in data])
+            merged = pd.DataFrame(merged, index=index, columns=columns, copy=False)
+        
+        if return_section_id:
+            return merged, section_id, names
         else:
-            return df_all, np.array(samples)
+            return merged, names[section_id]
     
     def cluster_mean(self, data: Any, labels: np.ndarray) -> Any:
         """Calculate cluster mean.
@@ -334,17 +479,7 @@ class RegionalizeMulti(Decomposition):
             [pd.DataFrame]: Pandas Dataframe with mean values for each label.
 
         """
-        unique_labels = np.unique(labels)
-        cluster_mean = pd.DataFrame(data=np.zeros((data.shape[0], len(unique_labels))), index = data.index,
-                                    columns=unique_labels)
-
-        #Loop over clusters
-        for l in unique_labels:
-            filt = labels == l
-            #Get mean expression of cluster
-            cluster_mean.loc[:, l] = data.loc[:, filt].mean(axis=1)
-
-        return cluster_mean
+        return label_aggregate(data, labels, func='mean')
     
     def make_cluster_correlation(self, data:dict, normalized:bool = True, method:str = 'pearson'):
         """
@@ -465,6 +600,92 @@ class RegionalizeMulti(Decomposition):
         
         return G
 
+    def _correlation_ready(self, df: Any, method: str = 'pearson') -> np.ndarray:
+        """Standardize the columns of a dataframe for correlation by a dot product.
+
+        Args:
+            df (pd.DataFrame): Dataframe with features in rows and clusters in
+                columns.
+            method (str, optional): "pearson" or "spearman". For "spearman"
+                the values are ranked first. Defaults to 'pearson'.
+
+        Returns:
+            np.ndarray: Array with columns that have zero mean and unit norm.
+        """
+        X = np.asarray(df, dtype=float)
+        if method == 'spearman':
+            X = rankdata(X, axis=0)
+        X = X - X.mean(axis=0)
+        length = np.linalg.norm(X, axis=0)
+        length[length == 0] = 1
+        return X / length
+
+    def similarity_network_assignment(self, data: dict, normalized: bool = True, cutoff: float = 0.7, 
+                                      method: str = 'pearson', n_next: int = 1, plot: bool = False):
+        """Link clusters of neighbouring datasets by optimal matching.
+
+        For every dataset the correlation between its clusters and the 
+        clusters of the next "n_next" datasets is calculated. Clusters are 
+        then matched one to one, so that the total correlation of the matches
+        is maximal, and matches above the cutoff are linked. Linking to more
+        than one next dataset prevents a single bad dataset from breaking the
+        linkage.
+
+        Args:
+            data (dict): Dictionary with the "regionalize()" results.
+            normalized (bool, optional): If True uses the normalized data that
+                was made by the "regionalize()" function. Defaults to True.
+            cutoff (float, optional): Cutoff correlation coefficient above 
+                which clusters will be linked. Defaults to 0.7.
+            method (str, optional): Correlation method to use. Choose from: 
+                "pearson", "kendall", "spearman". Defaults to "pearson" 
+            n_next (int, optional): Number of following datasets to link each
+                dataset to. Defaults to 1.
+            plot (bool, optional): If true plots the generated network.
+                Defaults to False.
+
+        Returns:
+            Networkx Network with edges between nodes that are correlated with
+            each other above the cutoff. Nodes are named 
+            '<dataset index>_<cluster label>' like '1_3' for dataset 1 
+            cluster 3.
+        """
+        target = 'df_norm' if normalized else 'df_mean'
+        frames = [data[d][target] for d in self.datasets_names]
+        index = frames[0].index
+        frames = [f if f.index.equals(index) else f.reindex(index, fill_value=0) for f in frames]
+        if method in ['pearson', 'spearman']:
+            ready = [self._correlation_ready(f, method) for f in frames]
+        elif method != 'kendall':
+            raise Exception(f'Method "{method}" not implemented, choose from "pearson", "kendall" or "spearman".')
+
+        G = nx.Graph()
+        for i in range(len(frames)):
+            for j in range(i + 1, min(i + 1 + n_next, len(frames))):
+                #Correlation block between the clusters of both datasets
+                if method == 'kendall':
+                    corr = np.array([[kendalltau(frames[i][c0], frames[j][c1])[0] for c1 in frames[j].columns] 
+                                     for c0 in frames[i].columns])
+                    corr = np.nan_to_num(corr)
+                else:
+                    corr = ready[i].T @ ready[j]
+                
+                #One to one matching with maximal total correlation
+                row, col = linear_sum_assignment(corr, maximize=True)
+                keep = corr[row, col] > cutoff
+                c0 = frames[i].columns[row[keep]]
+                c1 = frames[j].columns[col[keep]]
+                G.add_weighted_edges_from(zip([f'{i}_{l}' for l in c0], [f'{j}_{l}' for l in c1], 
+                                              corr[row[keep], col[keep]]), weight='value')
+        
+        #Plot
+        if plot:
+            fig = plt.figure(figsize=(10,10))
+            nx.draw(G, with_labels=True, node_color='orange', node_size=20, edge_color='gray', 
+                    linewidths=1, font_size=10,ax=plt.gca())
+        
+        return G
+
     def merge_labels(self, G, labels:list, reorder_labels:bool = True, data:list=None,
                      mode:str='APR') -> list:
         """Merge cluster labels based on network with linked clusters.
@@ -473,9 +694,10 @@ class RegionalizeMulti(Decomposition):
             G ([networkx]): Network with links between cluster labels that 
                 need to be merged. 
             labels (list): List of numpy arrays with the cluster labels for 
-                each dataset. Labels should have the format 
+                each dataset. Nodes in G should have the format 
                 '<dataset index>_<cluster label>' like '1_3' for dataset 1 
-                cluster 3. 
+                cluster 3. Internally labels are encoded as integers, the 
+                dataset offset plus the index of the local label.
             reorder_labels (bool, optional): If True the clsuter labels will be
                 reordered based on similarity. Uses (merged)cluster mean 
                 expression as input for SpectralEmbedding to order labels.
@@ -491,41 +713,27 @@ class RegionalizeMulti(Decomposition):
             dataset. Order is the same as self.datasets_names. 
         """
         
-        #make dictionary with new label for a group
-        merge_dict = {}
-        merged_clusters = []
-        for i, group in enumerate(nx.connected_components(G)):
-            for g in group:
-                merge_dict[g] = f'merge_{i}'
-                merged_clusters.append(g)
-        
-         
-        #Make labels to have a dataset index. Like '1_3' for dataset 1 cluster 3       
-        dataset_label = []
+        #Encode labels as integers: section offset + local label index
+        local_index, offsets, node_code = [], [0], {}
         for i, l in enumerate(labels):
-            dataset_label.append(np.array([f'{i}_{j}' for j in l]))
-            
-        #Replace original labels with merged label. 
-        merged_label = []
-        for dl in dataset_label:
-            dl_list = []
-            for l in dl:
-                if l in merged_clusters:
-                    dl_list.append(merge_dict[l])
-                else:
-                    dl_list.append(l)
-            merged_label.append(np.array(dl_list))
-        
-        #Change labels to integers
-        unique_labels = np.unique(np.concatenate(merged_label))
-        int_label_dict = dict(zip(unique_labels, range(unique_labels.shape[0])))
-        int_labels = []
-        for l in merged_label:
-            int_labels.append(np.array([int_label_dict[i] for i in l]))
+            unique_local, inverse = np.unique(np.asarray(l), return_inverse=True)
+            local_index.append(inverse.ravel())
+            node_code.update({f'{i}_{u}': offsets[-1] + j for j, u in enumerate(unique_local)})
+            offsets.append(offsets[-1] + unique_local.shape[0])
+        n_nodes = offsets[-1]
+        
+        #Lookup array from encoded label to connected component
+        edges = np.array([[node_code[a], node_code[b]] for a, b in G.edges() if a in node_code and b in node_code],
+                         dtype=int).reshape(-1, 2)
+        adjacency = sp.csr_matrix((np.ones(edges.shape[0]), (edges[:, 0], edges[:, 1])), shape=(n_nodes, n_nodes))
+        n_components, component = connected_components(adjacency, directed=False)
+        
+        #Replace labels with the component. Components are already 0..n-1
+        int_labels = [component[offsets[i] + li] for i, li in enumerate(local_index)]
             
         if reorder_labels:
             #Merge datasets
-            merged_data, samples = self.merge_norm(data, mode=mode)
+            merged_data, samples = self.merge_norm(data, mode=mode, out='array')
             #Merge labels
             all_labels = np.concatenate(int_labels)
             
@@ -533,21 +741,146 @@ class RegionalizeMulti(Decomposition):
             cluster_mean = self.cluster_mean(merged_data, all_labels)
             #Order clusters
             manifold = SpectralEmbedding(n_components=1).fit_transform(cluster_mean.T)
-            #even_spaced = np.linspace(0, 1, manifold.shape[0])
-            even_spaced = np.arange(manifold.shape[0])
-            even_spaced_dict = dict(zip(np.sort(manifold.ravel()), even_spaced))
-            manifold_even = np.array([even_spaced_dict[i] for i in manifold.ravel()])
-            manifold_even_dict = dict(zip(cluster_mean.columns, manifold_even))
+            #Rank of each cluster along the manifold
+            order = np.empty(n_components, dtype=int)
+            order[cluster_mean.columns.to_numpy()[np.argsort(manifold.ravel(), kind='stable')]] = np.arange(n_components)
             #Reassign labels
-            final_labels = []
-            for l in int_labels:
-                final_labels.append(np.array([manifold_even_dict[i] for i in l]))
+            final_labels = [order[l] for l in int_labels]
             
         else:
             final_labels = int_labels
 
         return final_labels
         
+    def joint_embedding_fit(self, data: list, mode: str = 'APR', n_components: int = 100, 
+                            samples_per_section: int = 5000, random_state: int = 0, **kwargs) -> IncrementalPCA:
+        """Fit one PCA on tiles of all datasets.
+
+        Datasets are normalized one at a time and the same number of tiles is
+        sampled from each, so that all datasets weigh equally and only one 
+        normalized dataset is in memory at once. The samples are fed to an
+        incremental PCA dataset by dataset.
+
+        Args:
+            data (list): List of hexbin dataframes where the order matches 
+                self.datasets_names.
+            mode (str, optional): Normalization mode, applied to each dataset
+                individually. See `normalize()`. Defaults to 'APR'.
+            n_components (int, optional): Number of components. 
+                Defaults to 100.
+            samples_per_section (int, optional): Number of tiles to sample 
+                from each dataset. Datasets with fewer tiles are used 
+                completely. Defaults to 5000.
+            random_state (int, optional): Random seed. Defaults to 0.
+
+        Kwargs:
+            Will be passed to the `normalize()` function.
+
+        Returns:
+            IncrementalPCA: Fitted Scikit-learn IncrementalPCA.
+        """
+        rng = np.random.default_rng(random_state)
+        n_features = data[0].shape[0]
+        n_total = sum([min(df.shape[1], samples_per_section) for df in data])
+        n_components = min(n_components, n_features, n_total)
+        ipca = IncrementalPCA(n_components=n_components)
+        
+        #Every batch needs at least n_components samples, keep one batch 
+        #pending so that the remainder can be added to the last batch
+        pending, buffer = None, []
+        for df in tqdm(data, desc='Fitting joint PCA'):
+            df = self.normalize(df, mode=mode, **kwargs) if mode != None else df
+            X = _to_matrix(df)
+            n = X.shape[1]
+            sample = np.sort(rng.choice(n, min(n, samples_per_section), replace=False))
+            X = X[:, sample]
+            buffer.append((X.toarray() if sp.issparse(X) else np.asarray(X)).T)
+            
+            if sum([b.shape[0] for b in buffer]) >= n_components:
+                if pending is not None:
+                    ipca.partial_fit(pending)
+                pending, buffer = np.vstack(buffer), []
+        
+        pending = np.vstack(([pending] if pending is not None else []) + buffer)
+        ipca.partial_fit(pending)
+        return ipca
+
+    def joint_embedding(self, data: list, mode: str = 'APR', n_components: int = 100, 
+                        samples_per_section: int = 5000, random_state: int = 0, 
+                        n_jobs: int = -1, **kwargs) -> Tuple[list, IncrementalPCA]:
+        """Embed the tiles of all datasets in one PCA space.
+
+        The PCA is fitted with `joint_embedding_fit()` after which the 
+        datasets are normalized and projected in parallel threads. 
+
+        Args:
+            data (list): List of hexbin dataframes where the order matches 
+                self.datasets_names.
+            mode (str, optional): Normalization mode, applied to each dataset
+                individually. See `normalize()`. Defaults to 'APR'.
+            n_components (int, optional): Number of components. 
+                Defaults to 100.
+            samples_per_section (int, optional): Number of tiles to sample 
+                from each dataset to fit the PCA. Defaults to 5000.
+            random_state (int, optional): Random seed. Defaults to 0.
+            n_jobs (int, optional): Number of datasets to project at the same
+                time. If -1 uses the number of CPUs. Defaults to -1.
+
+        Kwargs:
+            Will be passed to the `normalize()` function.
+
+        Returns:
+            Tuple[list, IncrementalPCA]: List with an array of shape 
+                (n_tiles, n_components) for each dataset, and the fitted PCA.
+        """
+        n_jobs = multiprocessing.cpu_count() if n_jobs == -1 else n_jobs
+        ipca = self.joint_embedding_fit(data, mode=mode, n_components=n_components, 
+                                        samples_per_section=samples_per_section, random_state=random_state, 
+                                        **kwargs)
+        
+        def project(df):
+            df = self.normalize(df, mode=mode, **kwargs) if mode != None else df
+            X = _to_matrix(df).T
+            return ipca.transform(X.toarray() if sp.issparse(X) else X)
+        
+        with ThreadPoolExecutor(max_workers=max(1, min(n_jobs, len(data)))) as executor:
+            embedding = list(executor.map(project, data))
+        return embedding, ipca
+
+    def _regionalize_joint_section(self, d: Any, df_hex: Any, hex_coord: np.ndarray, ipca: IncrementalPCA, 
+                                   spacing: float, normalization_mode: str, n_components: list, 
+                                   clust_dist_threshold: float, n_clusters: int, clust_neighbor_rings: int, 
+                                   smooth: bool, smooth_neighbor_rings: int, smooth_cycles: int, post_merge: bool, 
+                                   post_merge_t: float, clust_method: str, clust_resolution: float) -> dict:
+        """Project and cluster one dataset with a joint PCA.
+
+        Args:
+            d (Dataset): Dataset that the tiles belong to.
+            df_hex (pd.DataFrame): Dataframe with counts for each tile.
+            hex_coord (np.ndarray): Coordinates of the tiles.
+            ipca (IncrementalPCA): PCA fitted by `joint_embedding_fit()`.
+            Others: See `regionalize()`.
+
+        Returns:
+            dict: Regionalization result of the dataset, like `regionalize()`.
+        """
+        df_hex_norm = self.normalize(df_hex, mode=normalization_mode, clip=None) if normalization_mode != None else df_hex
+        X = _to_matrix(df_hex_norm).T
+        dr = ipca.transform(X.toarray() if sp.issparse(X) else X)
+        
+        labels = d.clust_hex_connected(dr[:, n_components[0] : n_components[1]], hex_coord, spacing=spacing, 
+                                       distance_threshold=clust_dist_threshold, n_clusters=n_clusters, 
+                                       neighbor_rings=clust_neighbor_rings, n_jobs=1, method=clust_method, 
+                                       resolution=clust_resolution)
+        labels, df_mean, df_norm = d._regionalize_post(df_hex, df_hex_norm, hex_coord, labels, spacing, smooth, 
+                                                       smooth_neighbor_rings, smooth_cycles, post_merge, 
+                                                       post_merge_t, order_labels=False, n_jobs=1)
+        return {'df_hex': df_hex,
+                'labels': labels,
+                'coordinates': hex_coord,
+                'df_mean': df_mean,
+                'df_norm': df_norm}
+
     def regionalize(self,
                     spacing: float, 
                     min_count: int,
@@ -563,10 +896,17 @@ class RegionalizeMulti(Decomposition):
                     post_merge: bool = False,
                     post_merge_t: float = 0.05,
                     smooth_cycles: int = 1,
+                    clust_method: str = 'ward',
+                    clust_resolution: float = 1.0,
+                    embedding: str = 'section',
+                    samples_per_section: int = 5000,
                     merge_labels: bool = True,
                     merge_cutoff: float = 0.7,
                     correlation_method = 'pearson',
-                    reorder_labels: bool = True) -> dict:
+                    merge_n_next: int = 1,
+                    reorder_labels: bool = True,
+                    parallel: str = 'threads',
+                    n_jobs: int = -1) -> dict:
         """Regionalize and cluster individual datasets.
 
        Args:
@@ -584,7 +924,8 @@ class RegionalizeMulti(Decomposition):
                 respectively. Also possible to not normalize, in which case the
                 input should be None. Usefull for LDA. Defaults to 'APR'.
             dimensionality_reduction (str, optional): Method for dimentionality
-                reduction. Implmented PCA, LDA. Defaults to 'PCA'.
+                reduction. Implmented PCA, LDA, NMF. LDA and NMF need
+                non-negative data. Defaults to 'PCA'.
             n_components (list, optional): Components to use for clustering.
                 In some cases the PCA component 0 signifies to total expression
                 which should be excluded for clustering. Defaults to [0, 100].
@@ -605,6 +946,19 @@ class RegionalizeMulti(Decomposition):
                 18 neigbors, etc. Defaults to 1.
             smooth_cycles (int, optional): Number of smoothing cycles.
                 Defaults to 1.
+            clust_method (str, optional): Clustering method, choose from 
+                "ward", "louvain" or "kmeans_ward". See 
+                `Regionalize.clust_hex_connected()`. Defaults to 'ward'.
+            clust_resolution (float, optional): Resolution for "louvain"
+                clustering. Defaults to 1.0.
+            embedding (str, optional): "section" to normalize and reduce each
+                dataset with its own PCA, or "joint" to project all datasets 
+                on one PCA that is fitted on tiles of all datasets, see
+                `joint_embedding()`. With "joint" the clusters of all datasets
+                live in the same space. Only PCA is supported for "joint".
+                Defaults to 'section'.
+            samples_per_section (int, optional): Number of tiles per dataset
+                to fit the joint PCA on. Defaults to 5000.
             merge_labels (bool, optional): If True, the cluster labels of the
                 regionalization of the individual sections are merged based on
                 correlation to link one dataset to the next. Defaults to True.
@@ -613,9 +967,18 @@ class RegionalizeMulti(Decomposition):
             correlation_method (str, optional): Correlation method to use for
                 mergin. Choose from: "pearson", "kendall", "spearman".
                 Defaults to "pearson".
+            merge_n_next (int, optional): Number of following datasets to link
+                the clusters of each dataset to when merging. Defaults to 1.
             reorder_labels (bool, optional): Reorder the labels so that similar
                 clusters get a label number that is close. Only works when 
                 "merge_labels" is set to True. Defaults to True.
+            parallel (str, optional): "threads" to regionalize the datasets 
+                with Dask threads, or "processes" to regionalize them in a 
+                process pool. With processes each worker reopens its dataset
+                and writes the result to the on-disk cache of that dataset,
+                from which it is then loaded. Defaults to 'threads'.
+            n_jobs (int, optional): Number of processes when "parallel" is 
+                "processes". If -1 uses the number of CPUs. Defaults to -1.
 
         Returns:
             Dict containing:
@@ -628,27 +991,72 @@ class RegionalizeMulti(Decomposition):
                 - labels_merged: Merged labels when "merge_labels" is True.
         """
         #regionalize individual datasets
-        results = {}
-        for d in self.datasets:
-            r = dask.delayed(d.regionalize)(spacing, min_count, feature_selection, normalization_mode, 
-                                            dimensionality_reduction, n_components, clust_dist_threshold, 
-                                            n_clusters, clust_neighbor_rings, smooth, smooth_neighbor_rings, 
-                                            smooth_cycles, post_merge, post_merge_t, order_labels=False, n_jobs=1)
-            results[d.dataset_name] = ({'df_hex': r[0],
-                                       'labels': r[1],
-                                       'coordinates': r[2],
-                                       'df_mean': r[3],
-                                       'df_norm': r[4]})
-        
-        with ProgressBar(): 
-            collection = dask.compute(results)
-        collection = collection[0]
+        if embedding == 'joint':
+            if dimensionality_reduction.lower() != 'pca':
+                raise Exception('Joint embedding is only implemented for PCA.')
+            hexbin = self.hexbin_multi(spacing, min_count, parallel=parallel, n_jobs=n_jobs, 
+                                       feature_selection=feature_selection)
+            df_hex = self.get_dict_item(hexbin, 'df_hex')
+            ipca = self.joint_embedding_fit(df_hex, mode=normalization_mode, n_components=n_components[1],
+                                            samples_per_section=samples_per_section, clip=None)
+            
+            results = {}
+            for d, df in zip(self.datasets, df_hex):
+                results[d.dataset_name] = dask.delayed(self._regionalize_joint_section)(
+                    d, df, hexbin[d.dataset_name]['coordinates'], ipca, spacing, normalization_mode, n_components, 
+                    clust_dist_threshold, n_clusters, clust_neighbor_rings, smooth, smooth_neighbor_rings, 
+                    smooth_cycles, post_merge, post_merge_t, clust_method, clust_resolution)
+            with ProgressBar():
+                collection = dask.compute(results)[0]
+        elif embedding != 'section':
+            raise Exception(f'Embedding "{embedding}" not implemented, choose from "section" or "joint".')
+        elif parallel == 'processes':
+            kwargs = {'spacing': spacing, 'min_count': min_count, 'feature_selection': feature_selection, 
+                      'normalization_mode': normalization_mode, 'dimensionality_reduction': dimensionality_reduction,
+                      'n_components': n_components, 'clust_dist_threshold': clust_dist_threshold, 
+                      'n_clusters': n_clusters, 'clust_neighbor_rings': clust_neighbor_rings, 'smooth': smooth,
+                      'smooth_neighbor_rings': smooth_neighbor_rings, 'smooth_cycles': smooth_cycles, 
+                      'post_merge': post_merge, 'post_merge_t': post_merge_t, 'clust_method': clust_method,
+                      'clust_resolution': clust_resolution, 'order_labels': False, 'n_jobs': 1}
+            run_sections(_regionalize_worker, self.datasets, kwargs, n_jobs=n_jobs)
+            
+            #Load results from cache
+            collection = {}
+            for d in self.datasets:
+                r = d.cache_load('regionalize', kwargs)
+                if r == None:
+                    raise Exception(f'Could not load regionalization result of {d.dataset_name} from cache.')
+                #Set the hexbin state of the dataset for plotting
+                d.hexbin_make(spacing, min_count, feature_selection=feature_selection, n_jobs=1)
+                collection[d.dataset_name] = {'df_hex': r[0],
+                                              'labels': r[1],
+                                              'coordinates': r[2],
+                                              'df_mean': r[3],
+                                              'df_norm': r[4]}
+        elif parallel == 'threads':
+            results = {}
+            for d in self.datasets:
+                r = dask.delayed(d.regionalize)(spacing, min_count, feature_selection, normalization_mode, 
+                                                dimensionality_reduction, n_components, clust_dist_threshold, 
+                                                n_clusters, clust_neighbor_rings, smooth, smooth_neighbor_rings, 
+                                                smooth_cycles, post_merge, post_merge_t, clust_method=clust_method,
+                                                clust_resolution=clust_resolution, order_labels=False, n_jobs=1)
+                results[d.dataset_name] = ({'df_hex': r[0],
+                                           'labels': r[1],
+                                           'coordinates': r[2],
+                                           'df_mean': r[3],
+                                           'df_norm': r[4]})
+        
+            with ProgressBar(): 
+                collection = dask.compute(results)
+            collection = collection[0]
+        else:
+            raise Exception(f'Parallel mode "{parallel}" not implemented, choose from "threads" or "processes".')
 
-        
         if merge_labels:
             #make similarity network based on correlation
-            G = self.similarity_network_correlation(collection, normalized=True, cutoff=merge_cutoff, 
-                                        method=correlation_method, plot=False)
+            G = self.similarity_network_assignment(collection, normalized=True, cutoff=merge_cutoff, 
+                                                   method=correlation_method, n_next=merge_n_next, plot=False)
             
             #Merge labels
             merged_labels = self.merge_labels(G, self.get_dict_item(collection, 'labels'),
@@ -679,20 +1087,10 @@ class RegionalizeMulti(Decomposition):
         """
         labels_merged = self.get_dict_item(reg, 'labels_merged')
         labels_merged_concat = np.concatenate(labels_merged)
-        unique_labels = np.unique(labels_merged_concat)
         
         data, samples = self.merge_norm(self.get_dict_item(reg, 'df_hex'), mode=mode)
-        
-        cluster_mean = pd.DataFrame(data=np.zeros((data.shape[0], len(unique_labels))), index = data.index,
-                                    columns=unique_labels)
-        #return cluster_mean, data
-        #Loop over clusters
-        for l in unique_labels:
-            filt = labels_merged_concat == l
-            #Get mean expression of cluster
-            cluster_mean.loc[:, l] = data.loc[:, filt].mean(axis=1)
 
-        return cluster_mean
+        return label_aggregate(data, labels_merged_concat, func='mean')
     
     
         
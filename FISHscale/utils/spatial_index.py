@@ -0,0 +1,376 @@
+from os import path, makedirs, replace
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.spatial import KDTree
+from itertools import chain
+from typing import Any, Union
+
+
+class SpatialIndex:
+    """Index of the coordinates of all molecules, bucketed by gene.
+
+    The XY coordinates of all molecules are stored in one array, sorted by
+    gene in the order of the genes, and within a gene sorted along a coarse
+    spatial grid so that molecules that are close in space are close in
+    memory. The molecules of gene i are the rows offsets[i] to offsets[i+1].
+
+    The arrays are saved as .npy files in the FISHscale data folder and
+    memory mapped when loaded, so that a new session does not need to read
+    the parsed data again. KDTrees of all molecules or of single genes are
+    build when first queried and then kept in memory.
+    """
+
+    def __init__(self, points: np.ndarray, offsets: np.ndarray, genes: np.ndarray, fingerprint: str = None):
+        """Make index.
+
+        Args:
+            points (np.ndarray): Array with shape (n_molecules, 2) with the XY
+                coordinates, grouped per gene.
+            offsets (np.ndarray): Array with the start of each gene in points,
+                and the total number of molecules as last value.
+            genes (np.ndarray): Gene names in the order of the groups.
+            fingerprint (str, optional): Fingerprint of the dataset the index
+                is made from. Defaults to None.
+        """
+        self.points = points
+        self.offsets = np.asarray(offsets)
+        self.genes = np.asarray(genes)
+        self.fingerprint = fingerprint
+        self.gene_index = {g: i for i, g in enumerate(self.genes)}
+        self._gene_code = None
+        self._trees = {}
+
+    @classmethod
+    def build(cls, points: list, genes: np.ndarray, fingerprint: str = None, n_buckets: int = 1024) -> 'SpatialIndex':
+        """Build the index from the coordinates of each gene.
+
+        Args:
+            points (list): List with for each gene an array with shape
+                (n_molecules, 2) with the XY coordinates.
+            genes (np.ndarray): Gene names in the same order as points.
+            fingerprint (str, optional): Fingerprint of the dataset. Defaults
+                to None.
+            n_buckets (int, optional): Number of grid cells along the largest
+                axis that are used for the spatial sorting within a gene.
+                Defaults to 1024.
+
+        Returns:
+            SpatialIndex: Index of all molecules.
+        """
+        offsets = np.concatenate([[0], np.cumsum([p.shape[0] for p in points])]).astype('int64')
+        points = np.vstack([np.asarray(p, dtype='float64').reshape(-1, 2) for p in points])
+
+        #Sort within gene along a coarse row major grid
+        if points.shape[0] > 0:
+            xy_min = points.min(axis=0)
+            cell_size = max((points.max(axis=0) - xy_min).max() / n_buckets, np.finfo('float64').tiny)
+            cell = ((points - xy_min) // cell_size).astype('int64')
+            gene_code = np.repeat(np.arange(len(genes)), np.diff(offsets))
+            order = np.lexsort((cell[:, 0], cell[:, 1], gene_code))
+            points = points[order]
+
+        return cls(points, offsets, genes, fingerprint=fingerprint)
+
+    @staticmethod
+    def _files(folder: str) -> dict:
+        return {'points': path.join(folder, 'points.npy'),
+                'offsets': path.join(folder, 'offsets.npy'),
+                'genes': path.join(folder, 'genes.npy'),
+                'fingerprint': path.join(folder, 'fingerprint.txt')}
+
+    def save(self, folder: str):
+        """Save the index as .npy files.
+
+        Files are written to a temporary file first, and the fingerprint is
+        written last, so that a half written index is never loaded.
+
+        Args:
+            folder (str): Folder to save to.
+        """
+        makedirs(folder, exist_ok=True)
+        files = self._files(folder)
+        for name, array in [('points', self.points), ('offsets', self.offsets), ('genes', self.genes.astype('str'))]:
+            tmp_file = files[name] + f'.{time.time_ns()}.tmp.npy'
+            np.save(tmp_file, np.asarray(array))
+            replace(tmp_file, files[name])
+        tmp_file = files['fingerprint'] + f'.{time.time_ns()}.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(str(self.fingerprint))
+        replace(tmp_file, files['fingerprint'])
+
+    @classmethod
+    def load(cls, folder: str, fingerprint: str = None, mmap: bool = True) -> Union['SpatialIndex', None]:
+        """Load a saved index.
+
+        Args:
+            folder (str): Folder with the saved index.
+            fingerprint (str, optional): If given, the index is only loaded if
+                it has been made from a dataset with the same fingerprint.
+                Defaults to None.
+            mmap (bool, optional): If True, memory maps the coordinates
+                instead of reading them in RAM. Defaults to True.
+
+        Returns:
+            Union[SpatialIndex, None]: Index, or None if there is no valid
+                index in the folder.
+        """
+        files = cls._files(folder)
+        try:
+            with open(files['fingerprint'], 'r') as f:
+                saved_fingerprint = f.read()
+            if fingerprint != None and saved_fingerprint != str(fingerprint):
+                return None
+            points = np.load(files['points'], mmap_mode='r' if mmap else None)
+            offsets = np.load(files['offsets'])
+            genes = np.load(files['genes'])
+        except (FileNotFoundError, ValueError, EOFError):
+            return None
+        return cls(points, offsets, genes, fingerprint=saved_fingerprint)
+
+    @property
+    def n_genes(self) -> int:
+        return self.genes.shape[0]
+
+    @property
+    def gene_code(self) -> np.ndarray:
+        """Gene code of each molecule, the position of the gene in genes."""
+        if self._gene_code is None:
+            self._gene_code = np.repeat(np.arange(self.n_genes, dtype='int64'), np.diff(self.offsets))
+        return self._gene_code
+
+    def _gene_i(self, gene: Union[str, int]) -> int:
+        if isinstance(gene, (int, np.integer)):
+            return int(gene)
+        if gene not in self.gene_index:
+            raise Exception(f'Given gene: "{gene}" can not be found in the spatial index.')
+        return self.gene_index[gene]
+
+    def gene_points(self, gene: Union[str, int], frame: bool = False) -> Any:
+        """Coordinates of the molecules of a gene.
+
+        Args:
+            gene (Union[str, int]): Gene name or position.
+            frame (bool, optional): If True, returns a Pandas Dataframe with
+                "x" and "y" columns. If False returns a (memory mapped) view of
+                the points. Defaults to False.
+
+        Returns:
+            Any: Array with shape (n_molecules, 2) or Dataframe.
+        """
+        i = self._gene_i(gene)
+        points = self.points[self.offsets[i]:self.offsets[i+1]]
+        if frame:
+            return pd.DataFrame(np.asarray(points), columns=['x', 'y'])
+        return points
+
+    def tree(self, gene: Union[str, int] = None) -> KDTree:
+        """KDTree of all molecules or of the molecules of one gene.
+
+        The tree is build on first use and kept in memory. The indices
+        returned by the tree are the positions in points, or in
+        gene_points() for a single gene.
+
+        Args:
+            gene (Union[str, int], optional): Gene name or position. If None
+                uses all molecules. Defaults to None.
+
+        Returns:
+            KDTree: scipy.spatial.KDTree.
+        """
+        key = None if gene is None else self._gene_i(gene)
+        if key not in self._trees:
+            points = self.points if key is None else self.gene_points(key)
+            self._trees[key] = KDTree(np.asarray(points))
+        return self._trees[key]
+
+    def _gene_filter(self, genes: Any) -> Union[np.ndarray, None]:
+        if genes is None:
+            return None
+        if isinstance(genes, (str, int, np.integer)):
+            genes = [genes]
+        return np.array([self._gene_i(g) for g in genes], dtype='int64')
+
+    def query_ball_point(self, x: np.ndarray, radius: float, genes: Any = None, workers: int = -1) -> list:
+        """Find the molecules within the radius of query points.
+
+        Args:
+            x (np.ndarray): Array with shape (n, 2) with query points.
+            radius (float): Search radius.
+            genes (Any, optional): Gene name or list of genes. If given, only
+                returns molecules of these genes. If a single gene is given,
+                the tree of that gene is used. Defaults to None.
+            workers (int, optional): Number of workers for the query. -1 is
+                all processors. Defaults to -1.
+
+        Returns:
+            list: For each query point an array with the positions of the
+                neighbouring molecules in points.
+        """
+        codes = self._gene_filter(genes)
+        if codes is not None and codes.shape[0] == 1:
+            neighbours = self.tree(codes[0]).query_ball_point(x, radius, workers=workers)
+            return [np.asarray(n, dtype='int64') + self.offsets[codes[0]] for n in neighbours]
+        neighbours = self.tree().query_ball_point(x, radius, workers=workers)
+        neighbours = [np.asarray(n, dtype='int64') for n in neighbours]
+        if codes is not None:
+            keep = np.isin(np.arange(self.n_genes), codes)
+            neighbours = [n[keep[self.gene_code[n]]] for n in neighbours]
+        return neighbours
+
+    def _query_chunks(self, x: np.ndarray, radius: float, workers: int = -1, chunk_size: int = 100000,
+                      max_neighbours: int = 2000000):
+        """Split query points in chunks with a limited number of neighbours.
+
+        The number of neighbours of every query point is counted first,
+        which does not make lists of indices. The chunks are then cut so
+        that the neighbour lists of one chunk hold at most "max_neighbours"
+        indices, or a single query point.
+
+        Args:
+            x (np.ndarray): Array with shape (n, 2) with query points.
+            radius (float): Search radius.
+            workers (int, optional): Number of workers for the query. -1 is
+                all processors. Defaults to -1.
+            chunk_size (int, optional): Maximum number of query points in a
+                chunk. Defaults to 100000.
+            max_neighbours (int, optional): Maximum number of neighbours in
+                a chunk. Defaults to 2000000.
+
+        Yields:
+            Tuple[int, int]: Start and stop of the chunk in x.
+        """
+        tree = self.tree()
+        for start in range(0, x.shape[0], chunk_size):
+            stop = min(start + chunk_size, x.shape[0])
+            lengths = tree.query_ball_point(np.asarray(x[start:stop]), radius, workers=workers, return_length=True)
+            cumulative = np.cumsum(lengths)
+            sub_start = 0
+            while sub_start < stop - start:
+                offset = cumulative[sub_start - 1] if sub_start > 0 else 0
+                sub_stop = np.searchsorted(cumulative, offset + max_neighbours, side='right')
+                sub_stop = max(sub_stop, sub_start + 1)
+                yield start + sub_start, start + sub_stop
+                sub_start = sub_stop
+
+    def count_neighbours(self, x: np.ndarray, radius: Union[float, list], genes: Any = None, workers: int = -1,
+                         chunk_size: int = 100000, max_neighbours: int = 2000000) -> Any:
+        """Count the molecules of every gene within the radius of query points.
+
+        The query points are processed in chunks, so that the neighbour 
+        lists of a chunk hold at most "max_neighbours" indices. This bounds
+        the memory for large radii and dense data.
+
+        For multiple radii the tree is queried once with the largest radius.
+        The neighbours are binned in the shells between consecutive radii
+        by their distance, and the counts of the shells are summed to get
+        the counts within each radius. The neighbour budget of the chunks is
+        then counted at the largest radius.
+
+        Args:
+            x (np.ndarray): Array with shape (n, 2) with query points.
+            radius (Union[float, list]): Search radius or list of radii.
+            genes (Any, optional): Gene name or list of genes to count. If
+                None, counts all genes. Defaults to None.
+            workers (int, optional): Number of workers for the query. -1 is
+                all processors. Defaults to -1.
+            chunk_size (int, optional): Maximum number of query points to
+                query at once. Defaults to 100000.
+            max_neighbours (int, optional): Maximum number of neighbours that
+                are listed at once. Defaults to 2000000.
+
+        Returns:
+            Any: Sparse csr matrix with shape (n, n_genes) with the counts.
+                With a gene filter, the columns follow the order of the given
+                genes. For a list of radii, a list with a matrix for each
+                radius in the given order.
+        """
+        multi = isinstance(radius, (list, tuple, np.ndarray))
+        radii = np.atleast_1d(np.asarray(radius, dtype='float64'))
+        radii_sorted = np.unique(radii)
+
+        codes = self._gene_filter(genes)
+        column = np.arange(self.n_genes) if codes is None else np.full(self.n_genes, -1, dtype='int64')
+        if codes is not None:
+            column[codes] = np.arange(codes.shape[0])
+        n_columns = self.n_genes if codes is None else codes.shape[0]
+        tree = self.tree()
+
+        counts = [[] for _ in radii_sorted]
+        for start, stop in self._query_chunks(x, radii_sorted[-1], workers=workers, chunk_size=chunk_size,
+                                              max_neighbours=max_neighbours):
+            x_chunk = np.asarray(x[start:stop])
+            neighbours = tree.query_ball_point(x_chunk, radii_sorted[-1], workers=workers)
+            lengths = np.fromiter(map(len, neighbours), dtype=np.int64, count=stop - start)
+            neighbours = np.fromiter(chain.from_iterable(neighbours), dtype=np.int64, count=lengths.sum())
+            rows = np.repeat(np.arange(stop - start), lengths)
+            cols = column[self.gene_code[neighbours]]
+            keep = cols >= 0
+            rows, cols, neighbours = rows[keep], cols[keep], neighbours[keep]
+
+            #Shell of each neighbour, the first radius that includes it
+            if radii_sorted.shape[0] > 1:
+                neighbour_points = np.asarray(self.points[neighbours])
+                dist = np.square(neighbour_points[:, 0] - x_chunk[rows, 0])
+                dist += np.square(neighbour_points[:, 1] - x_chunk[rows, 1])
+                del neighbour_points
+                #Squared distances against squared radii
+                shell = np.searchsorted(np.square(radii_sorted), dist, side='left')
+                shell = np.minimum(shell, radii_sorted.shape[0] - 1)
+                del dist
+            else:
+                shell = np.zeros(rows.shape[0], dtype='int64')
+
+            #Cumulative counts over the shells, duplicate entries are summed
+            cumulative = sp.csr_matrix((stop - start, n_columns))
+            for k in range(radii_sorted.shape[0]):
+                in_shell = shell == k
+                cumulative = cumulative + sp.csr_matrix((np.ones(in_shell.sum()), (rows[in_shell], cols[in_shell])),
+                                                        shape=(stop - start, n_columns))
+                counts[k].append(cumulative)
+
+        if x.shape[0] == 0:
+            counts = [sp.csr_matrix((0, n_columns)) for _ in radii_sorted]
+        else:
+            counts = [sp.vstack(c, format='csr') for c in counts]
+        counts = [counts[k] for k in np.searchsorted(radii_sorted, radii)]
+        return counts if multi else counts[0]
+
+
+class SpatialIndexing:
+    """Persistent spatial index of a dataset, see SpatialIndex."""
+
+    def spatial_index(self, rebuild: bool = False) -> SpatialIndex:
+        """Get the spatial index of all molecules.
+
+        The index is kept on the dataset, and saved in the "spatial_index"
+        folder in the FISHscale data folder. It is only reused when it has
+        been made from the same parsed data and (temporary) coordinates,
+        otherwise it is rebuild.
+
+        Args:
+            rebuild (bool, optional): If True, always rebuilds the index.
+                Defaults to False.
+
+        Returns:
+            SpatialIndex: Index with the molecules in the order of
+                self.unique_genes.
+        """
+        fingerprint = self._cache_fingerprint() if hasattr(self, '_cache_fingerprint') else None
+        folder = path.join(self.FISHscale_data_folder, 'spatial_index')
+
+        index = getattr(self, '_spatial_index', None)
+        if not rebuild and index is not None and fingerprint != None and index.fingerprint == fingerprint:
+            return index
+        if not rebuild and fingerprint != None:
+            index = SpatialIndex.load(folder, fingerprint=fingerprint)
+        else:
+            index = None
+
+        if index is None:
+            points = [self.get_gene(g).to_numpy() for g in self.unique_genes]
+            index = SpatialIndex.build(points, np.asarray(self.unique_genes), fingerprint=fingerprint)
+            index.save(folder)
+        self._spatial_index = index
+        return index
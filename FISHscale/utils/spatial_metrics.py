@@ -54,7 +54,7 @@ class SpatialMetrics:
 
     def ripleyk_calc(self, r: Union[float, List], genes: Union[np.ndarray, List, str] = [],
                     sample_shape: str='circle', boundary_correct: bool=False, CSR_Normalise: bool=False,
-                    re_calculate: bool=False):
+                    re_calculate: bool=False, cache: bool=True):
 
         #Check input
         if isinstance(r, int) or isinstance(r, float):
@@ -71,9 +71,22 @@ class SpatialMetrics:
             raise Exception('Sample_shape not valid: {sample_shape}, Choose either "circle" or "rectangle".')
 
         #Collect genes
-        if genes == []:
+        if len(genes) == 0:
             genes = self.unique_genes
 
+        #Check cache
+        cache_params = {'r': r, 'genes': list(genes), 'sample_shape': sample_shape, 
+                        'boundary_correct': boundary_correct, 'CSR_Normalise': CSR_Normalise}
+        requested_r, requested_genes = r, genes
+        if cache and not re_calculate and hasattr(self, 'cache_load'):
+            cached = self.cache_load('ripleyk_calc', cache_params)
+            if cached != None:
+                if not hasattr(self, 'ripleyk'):
+                    self.ripleyk = {}
+                for g in cached:
+                    self.ripleyk.setdefault(g, {}).update(cached[g])
+                return
+
         #Make dictionary
         if not hasattr(self, 'ripleyk'):
             self.ripleyk = {g : {} for g in genes}
@@ -85,9 +98,12 @@ class SpatialMetrics:
                 if g not in self.ripleyk:
                     self.ripleyk[g] = {}
 
+        #Read the points from the spatial index if there is one
+        index = self.spatial_index() if hasattr(self, 'spatial_index') else None
         lazy_result = []
         for g in genes:
-            lr = dask.delayed(_ripleyk_calc) (r, sample_size, self.get_gene(g), boundary_correct, CSR_Normalise)
+            xy = self.get_gene(g) if index is None else index.gene_points(g, frame=True)
+            lr = dask.delayed(_ripleyk_calc) (r, sample_size, xy, boundary_correct, CSR_Normalise)
             lazy_result.append(lr)
         futures = dask.persist(*lazy_result, num_workers=1, num_threads=self.cpu_count)
         result = dask.compute(*futures)
@@ -100,6 +116,10 @@ class SpatialMetrics:
         else:
             for g, res in zip(genes, result):
                 self.ripleyk[g][r[0]] = res    
+        
+        if cache and hasattr(self, 'cache_save'):
+            to_save = {g: {i: self.ripleyk[g][i] for i in requested_r} for g in requested_genes}
+            self.cache_save('ripleyk_calc', cache_params, to_save)
     
     def plot_ripleyk_r(self, r: float, frac: float = 0.05):
         """Helper function to pick r value.
@@ -35,6 +35,7 @@ setup(
 		'ripleyk',
 		'scikit-image',
 		'dask[distributed]',
+		'python-igraph',
 	],
 
 	author="Linnarsson Lab",